@@ -0,0 +1,222 @@
+"""
+This module provides the admin interface of Repeater, a WSGI application
+served on admin_port (see main.py). Requests must be authorized with
+"Authorization: Bearer <admin_token>" header. Responses are JSON.
+
+GET /destinations - state of delivery to each remote host (lane)
+POST /pause - stop delivering (new requests are still queued)
+POST /resume - start delivering again
+POST /drain - deliver right away, even if the remote host was failing
+    (the backoff starts over)
+POST /move - move queued requests aside ("park" them), e.g. requests of
+    a hook whose endpoint is down, so requests of other hooks are delivered
+POST /replay - move parked requests back to the end of the queue
+POST /purge - delete queued requests (parked ones with parked=1)
+POST /reload - read hooks from the config file again and start using
+    them (as on SIGHUP, see Repeater.reload)
+
+POST requests act on all remote hosts, unless `destination` (dst_host)
+or `hook` parameter is given. Requests are moved, replayed or purged
+if they are for `hook` (if given) and were received between `since`
+and `until` (Unix time, if given).
+
+Pausing is local to the Repeater process; with lease_backend = redis
+pause all processes. Queues are edited only when they are stored in
+Redis (queue_backend = redis or tiered, requests kept in memory by the
+latter are not edited).
+"""
+
+import hmac
+import json
+
+import webob
+import webob.exc
+
+from repeater.application import (
+    QueueBusy,
+    received_at,
+    route_table,
+)
+from repeater.log import webhook_logger
+
+PARKED = '%s:parked'
+
+
+class AdminApp(object):
+
+    def __init__(self, repeater, registry, reload=None):
+        self.repeater = repeater
+        self.reload = reload  # raises ValueError if hooks are not valid
+        self.token = registry.settings['admin_token']
+        self.editor = registry.get_queue_editor()
+        self.actions = {
+            '/pause': self._pause,
+            '/resume': self._resume,
+            '/drain': self._drain,
+            '/move': self._move,
+            '/replay': self._replay,
+            '/purge': self._purge,
+        }
+
+    def __call__(self, environ, start_response):
+        req = webob.Request(environ)
+        resp = self._handle(req)
+        return resp(environ, start_response)
+
+    def _handle(self, request):
+        if not self._authorized(request):
+            response = webob.exc.HTTPUnauthorized()
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        if request.path_info == '/destinations':
+            if request.method != 'GET':
+                return webob.exc.HTTPMethodNotAllowed()
+            return self._response([
+                status
+                for name in sorted(self.repeater.hosts)
+                for status in self.repeater.status(name)
+            ])
+        if request.path_info == '/reload':
+            if request.method != 'POST':
+                return webob.exc.HTTPMethodNotAllowed()
+            return self._reload()
+        action = self.actions.get(request.path_info)
+        if not action:
+            return webob.exc.HTTPNotFound()
+        if request.method != 'POST':
+            return webob.exc.HTTPMethodNotAllowed()
+        try:
+            handlers = self._handlers(request.params)
+            match = self._match(request.params)
+        except (KeyError, ValueError) as error:
+            return webob.exc.HTTPBadRequest(str(error))
+        webhook_logger.info('Admin request: %s %s' % (
+            request.path_info,
+            request.query_string
+        ))
+        try:
+            return self._response([
+                action(handler, match, request.params)
+                for handler in handlers
+            ])
+        except QueueBusy as error:
+            return webob.exc.HTTPConflict(str(error))
+        except NotImplementedError as error:
+            return webob.exc.HTTPNotImplemented(str(error))
+
+    def _authorized(self, request):
+        scheme, _, token = request.headers.get(
+            'Authorization', ''
+        ).partition(' ')
+        return scheme.lower() == 'bearer' and \
+            hmac.compare_digest(token.strip(), self.token)
+
+    def _response(self, destinations):
+        return self._json({'destinations': destinations})
+
+    def _json(self, data):
+        response = webob.Response()
+        response.content_type = 'application/json'
+        response.body = json.dumps(data, sort_keys=True)
+        return response
+
+    def _reload(self):
+        if not self.reload:
+            return webob.exc.HTTPNotImplemented('Reload is not available')
+        webhook_logger.info('Admin request: /reload')
+        try:
+            self.reload()
+        except ValueError as error:
+            return webob.exc.HTTPBadRequest(str(error))
+        return self._json({'hooks': sorted(self.repeater.hooks)})
+
+    def _handlers(self, params):
+        hosts = self.repeater.hosts
+        destination = params.get('destination')
+        hook = params.get('hook')
+        if hook:
+            if hook not in self.repeater.hooks:
+                raise KeyError('Unknown hook: %s' % hook)
+            dst_host = self.repeater.hooks[hook]['dst_host']
+            if destination and destination != dst_host:
+                raise ValueError('Hook %s is not for %s' % (
+                    hook,
+                    destination
+                ))
+            destination = dst_host
+        if not destination:
+            return [
+                handler
+                for name in sorted(hosts)
+                for handler in self.repeater.handlers(name)
+            ]
+        if destination not in hosts:
+            raise KeyError('Unknown destination: %s' % destination)
+        return self.repeater.handlers(destination)
+
+    def _match(self, params):
+        routes = None
+        if params.get('hook'):
+            routes = route_table([
+                self.repeater.hooks[params['hook']]['src_path']
+            ])
+        since = float(params['since']) if params.get('since') else None
+        until = float(params['until']) if params.get('until') else None
+
+        def match(req):
+            if routes is not None and routes.get(req.path_info) is None:
+                return False
+            if since is None and until is None:
+                return True
+            received = received_at(req)
+            if received is None:
+                return False  # queued by older version
+            return (since is None or received >= since) and \
+                (until is None or received < until)
+        return match
+
+    def _pause(self, handler, match, params):
+        handler.pause()
+        return handler.status()
+
+    def _resume(self, handler, match, params):
+        handler.resume()
+        return handler.status()
+
+    def _drain(self, handler, match, params):
+        handler.drain()
+        return handler.status()
+
+    def _move(self, handler, match, params):
+        return self._edit(handler, 'moved', lambda name: (
+            name,
+            PARKED % name
+        ), match)
+
+    def _replay(self, handler, match, params):
+        return self._edit(handler, 'replayed', lambda name: (
+            PARKED % name,
+            name
+        ), match)
+
+    def _purge(self, handler, match, params):
+        parked = params.get('parked') in ('1', 'true', 'yes', 'on')
+        return self._edit(handler, 'purged', lambda name: (
+            PARKED % name if parked else name,
+            None
+        ), match)
+
+    def _edit(self, handler, result, queues, match):
+        # `queues(name)` returns source and target queue of the handler
+        if not self.editor:
+            raise NotImplementedError(
+                'Queues of this queue_backend can not be edited'
+            )
+
+        def move(name):
+            source, target = queues(name)
+            return self.editor.move(source, target, match)
+        return {
+            'destination': handler.host,
+            result: handler.edit(move),
+        }
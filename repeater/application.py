@@ -2,60 +2,236 @@
 Main webhook-repeater application module.
 """
 
+import collections
 import cPickle as pickle
-import hmac
+import functools
+import json
+import json.decoder
 import StringIO as stringio
 import logging
+import zlib
 
 import webob
 import webob.exc
-import wsgiproxy.app
 
 from zope.interface import implementer
 
+from repeater.body_store import read_chunks
+from repeater.circuit_breaker import (
+    CLOSED,
+    OPEN,
+    CircuitBreaker,
+)
 from repeater.log import webhook_logger
 from repeater.interfaces import IRequestSerializer
+from repeater.ip_matcher import (
+    AddressMatcher,
+    client_address,
+)
+from repeater.metrics import MetricsApp
+from repeater.routing import (
+    RouteConflict,
+    RouteTrie,
+    TemplateProxy,
+    template_names,
+)
+from repeater.signing import HEADER as SIGNATURE_HEADER
 
 
-def sign_request(request, secret):
+def received_at(request):
     """
-    Method sign request by provided secret.
+    Method returns time (see IConcurrencyUtils.now) when Repeater received
+    the request or None if it is not known (requests queued by older
+    versions).
     """
-    body = request.body  # by purpose to compute missing content_length
-    msg = request.content_type + str(request.content_length) + body
-    sig = hmac.new(secret, msg).hexdigest()
-    request.headers['X-REPEATER-SIG'] = sig
-    return request
+    received = request.environ.get('repeater.received')
+    if isinstance(received, float):
+        return received
+    return None
+
+
+class QueueBusy(Exception):
+    # The queue can't be edited now (see QueueHandler.edit)
+    pass
 
 
 def check_remote_address(hosts, remote_address):
     """
-    Method check if remote address is correct
+    Method check if remote address is correct. `hosts` is AddressMatcher
+    (see hook_matcher) or a string, which is compiled for this check only.
     """
-    ip_address = generate_inet_aton(remote_address)
-    for host in hosts.split(','):
-        try:
-            net_str, bits = host.split('/')
-        except ValueError:
-            net_str = host
-            bits = 32
-        net_address = generate_inet_aton(net_str)
-        mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
-        if (ip_address & mask) == (net_address & mask):
-            return True
-    return False
+    if not isinstance(hosts, AddressMatcher):
+        hosts = AddressMatcher(hosts)
+    return remote_address in hosts
+
+
+def hook_matcher(hook_spec):
+    """
+    Method returns AddressMatcher of hook's src_host, the one compiled when
+    the config was loaded (see parse_hooks) if there is one.
+    """
+    matcher = hook_spec.get('src_matcher')
+    if matcher is None:
+        matcher = AddressMatcher(hook_spec['src_host'])
+    return matcher
+
+
+# How many bytes of the body are searched for the JSON ordering key
+ORDER_KEY_PREFIX = 64 * 1024
+
+
+def ordering_key(spec):
+    """
+    Method returns function which extracts ordering key from request.
+    `spec` is "header:<header name>" or "json:<dotted.path>" (e.g.
+    "json:issue.key"). The function returns None when request has no key.
+    JSON field is looked for in the first ORDER_KEY_PREFIX bytes of the
+    body only.
+    """
+    source, _, name = spec.partition(':')
+    if source == 'header':
+        def header_key(request):
+            return request.headers.get(name)
+        return header_key
+    elif source == 'json':
+        path = name.split('.')
+
+        def json_key(request):
+            if not request.is_body_readable:
+                return None
+            request.make_body_seekable()
+            size = request.content_length or 0
+            prefix = ''.join(read_chunks(
+                request.body_file,
+                min(size, ORDER_KEY_PREFIX)
+            ))
+            request.body_file_raw.seek(0)
+            value = json_field(prefix, path, size <= ORDER_KEY_PREFIX)
+            if value is None:
+                return None
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            return str(value)
+        return json_key
+    raise ValueError('Unknown ordering key source: %s' % spec)
 
 
-def generate_inet_aton(address):
+def json_field(string, path, complete=True):
     """
-    Method converts the Internet host `address` from the IPv4
-    numbers-and-dots notation into binary form (in network byte order)
-    Returns nonzero if the `address` is valid, zero if not.
+    Method returns value of the field given by `path` (list of names of
+    nested fields) of JSON object `string` or None if there is no such
+    field. Only objects the path goes through are parsed, up to the field,
+    so `string` may be cut after it (`complete` is False then).
     """
+    decoder = json.JSONDecoder()
+    skip = json.decoder.WHITESPACE.match
+    pos = 0
     try:
-        return int(''.join(['%02x' % int(x) for x in address.split('.')]), 16)
-    except AttributeError:
-        return 0
+        for field in path:
+            pos = skip(string, pos).end()
+            if string[pos:pos + 1] != '{':
+                return None
+            pos += 1
+            while True:
+                pos = skip(string, pos).end()
+                if string[pos:pos + 1] != '"':
+                    return None
+                key, pos = json.decoder.scanstring(string, pos + 1)
+                pos = skip(string, pos).end()
+                if string[pos:pos + 1] != ':':
+                    return None
+                pos = skip(string, pos + 1).end()
+                if key == field:
+                    break
+                _, pos = decoder.raw_decode(string, pos)
+                pos = skip(string, pos).end()
+                if string[pos:pos + 1] != ',':
+                    return None
+                pos += 1
+        value, end = decoder.raw_decode(string, pos)
+    except ValueError:
+        return None
+    if not complete and end >= len(string):
+        return None  # e.g. a number may go on behind the cut
+    return value
+
+
+# Durability levels of hooks, when the sender gets its response:
+# right away, the request is queued in the background (see IngestBuffer);
+# when the queue stored the request (the default);
+# when the request is stored and copied to Redis replicas.
+ASYNC = 'async'
+STORED = 'stored'
+REPLICATED = 'replicated'
+DURABILITY = (ASYNC, STORED, REPLICATED)
+
+
+def parse_durability(name):
+    """
+    Method returns durability level given by `name` (see DURABILITY).
+    Raises ValueError if it is not known.
+    """
+    if name not in DURABILITY:
+        raise ValueError('Unknown durability: %s' % name)
+    return name
+
+
+def destination_rate(hook_specs, settings):
+    """
+    Method returns (rate, burst) of deliveries to the remote host
+    shared by given hooks. The most restrictive of rates and bursts set
+    in the hooks is used. If none is set, the `rate` and `burst` settings
+    are used; if `rate` is not set either, one request per `timeout`
+    seconds is allowed. Rate 0 means no limit.
+    """
+    rates = [spec['rate'] for spec in hook_specs if 'rate' in spec]
+    bursts = [spec['burst'] for spec in hook_specs if 'burst' in spec]
+    if rates:
+        rate = min(rates, key=lambda rate: rate or float('inf'))
+    elif settings.get('rate') is not None:
+        rate = settings['rate']
+    else:
+        timeout = settings.get('timeout')
+        rate = 1. / timeout if timeout else 0
+    burst = min(bursts) if bursts else settings.get('burst', 1)
+    return rate, burst
+
+
+def lane_name(host, lane):
+    """
+    Method returns name of the queue of given lane of the remote host
+    (see PartitionedQueueHandler)
+    """
+    if not lane:
+        return host
+    return '%s#%d' % (host, lane)
+
+
+def destination_probe(hook_specs, settings):
+    """
+    Method returns spec of the health probe of the remote host shared by
+    given hooks (see probe.py): the first one set in the hooks (so sort
+    them to get the same one every time) or the `probe` setting.
+    """
+    for spec in hook_specs:
+        if spec.get('probe'):
+            return spec['probe']
+    return settings.get('probe', 'off')
+
+
+def route_table(paths):
+    """
+    Method returns RouteTrie mapping paths of requests to given source
+    paths (patterns, see routing.py). Of equivalent patterns the first
+    one is used.
+    """
+    routes = RouteTrie()
+    for path in paths:
+        try:
+            routes.add(path, path)
+        except RouteConflict:
+            pass
+    return routes
 
 
 @implementer(IRequestSerializer)
@@ -65,6 +241,7 @@ class RequestSerializer(object):
         env['wsgi.input'] = stringio.StringIO(
             env['X-REPEATER-BODY']
         )
+        env['webob.is_body_seekable'] = True
         return webob.Request(env)
 
     def dumps(self, req):
@@ -80,63 +257,486 @@ class RequestSerializer(object):
 class QueueHandler(object):
     # This is a so-called queue handler. We got one for each remote host:port.
     # It stores requests addressed for endpoints on the host:port
-    # and delivers them when possible.
+    # and delivers them when possible: in its own thread/coroutine (see
+    # _handle) or, if the registry provides a scheduler, in steps run by
+    # the scheduler (see _step).
 
-    def __init__(self, host, proxies, registry):
+    def __init__(self, host, proxies, registry, rate_limiter, hooks=None,
+                 probe=None):
         self.host = host
         self.proxies = proxies
+        self.routes = route_table(proxies)
         self.requests = registry.construct_request_queue(host)
+        self.lease = registry.construct_lease(host)
         self.handler = None
         self.concurrency = registry.get_concurrency_utils()
         self.lock = self.concurrency.semaphore()
-        self.backoff = registry.settings['backoff_timeout']
-        self.max_backoff = registry.settings['backoff_max_timeout']
-        self.timeout = registry.settings['timeout']
+        self.breaker = CircuitBreaker(
+            probe,
+            registry.settings['backoff_timeout'],
+            registry.settings['backoff_max_timeout'],
+            registry.settings.get('probe_interval', 5),
+            registry.settings.get('backoff_jitter', 0.1)
+        )
+        self.rate_limiter = rate_limiter
+        self.body_store = registry.get_body_store()
+        self.cut_through = registry.settings.get('cut_through', False)
+        self.cut_through_budget = registry.settings.get(
+            'cut_through_budget', 1
+        )
+        self.cut_through_lock = self.concurrency.semaphore()
+        self.failing = False
+        self.current_backoff = 0
+        self.head_received = None
+        self.paused = False
+        # set by pause() and drain() to end waiting of the breaker early
+        self.wakeup = self.concurrency.event()
+        # set while no handler is running
+        self.idle = self.concurrency.event()
+        self.idle.set()
+        self.stop_timeout = registry.settings.get('http_timeout', 30)
+        self.scheduler = registry.get_scheduler()
+        self.batch = registry.settings.get('scheduler_batch', 10)
+        # state kept between steps, see _step
+        self.leased = False
+        self.due = None
+        self.open_wait = None
+        self.reserved = False
+        # when the token reserved by a cut-through that fell back to the
+        # queue is due, see _reserve
+        self.reserved_due = None
+        self._init_metrics(registry.get_metrics(), hooks or {})
+
+    def _init_metrics(self, metrics, hooks):
+        # `hooks` maps source paths to hook names
+        host = self.host
+        self.attempts = metrics.counter(
+            'repeater_delivery_attempts_total',
+            'Attempts to deliver a request',
+            ('destination', )
+        ).labels(host)
+        self.failures = metrics.counter(
+            'repeater_delivery_failures_total',
+            'Failed attempts to deliver a request',
+            ('destination', )
+        ).labels(host)
+        self.delivered_total = metrics.counter(
+            'repeater_requests_delivered_total',
+            'Delivered requests',
+            ('hook', 'destination')
+        )
+        self.delivered = {}
+        self._label_delivered(self.proxies, hooks)
+        self.delivery_duration = metrics.histogram(
+            'repeater_delivery_duration_seconds',
+            'Time it took to deliver a request (the successful attempt)',
+            ('destination', )
+        ).labels(host)
+        self.delivery_lag = metrics.histogram(
+            'repeater_delivery_lag_seconds',
+            'Time from receiving a request until it was delivered',
+            ('destination', )
+        ).labels(host)
+        metrics.gauge(
+            'repeater_backoff_seconds',
+            'Current wait before the next attempt after failures',
+            ('destination', ),
+            lambda: [((host, ), self.current_backoff)]
+        )
+        metrics.gauge(
+            'repeater_circuit_open',
+            'Whether deliveries are suspended after failures',
+            ('destination', ),
+            lambda: [((host, ), int(self.breaker.state != CLOSED))]
+        )
+        metrics.gauge(
+            'repeater_queue_depth',
+            'Number of queued requests',
+            ('destination', ),
+            lambda: [((host, ), len(self.requests))]
+        )
+        metrics.gauge(
+            'repeater_queue_oldest_age_seconds',
+            'Age of the request being delivered by this process',
+            ('destination', ),
+            self._oldest_age
+        )
+
+    def _label_delivered(self, paths, hooks):
+        for path in paths:
+            self.delivered[path] = self.delivered_total.labels(
+                hooks.get(path, ''),
+                self.host
+            )
+
+    def _oldest_age(self):
+        received = self.head_received
+        if received is None:
+            return [((self.host, ), 0)]
+        return [((self.host, ), max(self.concurrency.now() - received, 0))]
+
+    def start(self):
+        """
+        Start delivering requests if any are queued (e.g. the backlog from
+        the last run). Pushing a request starts delivering as well.
+        """
         if self.requests:
             self._start()
 
-    def push(self, request):
-        self.requests.append(request)
+    def reconfigure(self, proxies, rate_limiter, hooks=None, probe=None):
+        """
+        Use changed hooks of the remote host (see Repeater.reload). The
+        queue, the lease and the backoff are kept. Requests queued for
+        removed source paths are still delivered by their former proxies.
+        """
+        merged = dict(self.proxies)
+        merged.update(proxies)
+        self.routes = route_table(
+            list(proxies) + sorted(set(merged) - set(proxies))
+        )
+        self.proxies = merged
+        self._label_delivered(proxies, hooks or {})
+        self.rate_limiter = rate_limiter
+        self.breaker.probe = probe
+
+    def pause(self):
+        """
+        Stop delivering requests (after the attempt in progress), new
+        requests are still queued. Only this process pauses, other
+        Repeater processes may take the queue over (see lease.py).
+        """
+        self.paused = True
+        self._wake()
+
+    def resume(self):
+        self.paused = False
+        self._start()
+
+    def drain(self):
+        """
+        Resume delivering and try the next request right away, even when
+        the handler waits after failures. The backoff starts over.
+        """
+        self.paused = False
+        self.failing = False
+        self.breaker.reset()
+        if self.open_wait is not None:
+            self.due = self.open_wait = None
+        self._wake()
         self._start()
 
+    def edit(self, func):
+        """
+        Call func(name), where `name` is the name of the queue, while no
+        request of the queue is being delivered (by any process) and
+        return its result. Raises QueueBusy if the handler doesn't stop
+        in time or another process delivers requests of the queue.
+        """
+        paused = self.paused
+        self.pause()
+        try:
+            if not self.idle.wait(self.stop_timeout):
+                raise QueueBusy('Delivery to %s did not stop' % self.host)
+            if not self.lease.acquire():
+                raise QueueBusy('Queue %s is delivered by another '
+                                'process' % self.host)
+            try:
+                self.requests.reload()
+                return func(self.host)
+            finally:
+                self._release_lease()
+        finally:
+            if not paused:
+                self.resume()
+
+    def status(self):
+        return {
+            'destination': self.host,
+            'paused': self.paused,
+            'failing': self.failing,
+            'circuit': self.breaker.state,
+            'backoff': self.current_backoff,
+            'delivering': self.handler is not None,
+        }
+
+    def push(self, request, replicas=0):
+        try:
+            if self.cut_through:
+                with self.cut_through_lock:
+                    if self._deliver_directly(request):
+                        return
+                    self.requests.append(request, replicas)
+            else:
+                self.requests.append(request, replicas)
+        except IOError:
+            # Replicas did not confirm the request, but it is queued
+            self._start()
+            raise
+        self._start()
+
+    def _deliver_directly(self, request):
+        # Cut-through: if nothing waits for the remote host and the last
+        # delivery succeeded, the request is forwarded right away instead
+        # of being stored in the queue and read back by the handler.
+        # If it fails or takes longer than self.cut_through_budget seconds
+        # the caller stores it, so the sender gets its response only when
+        # the request is delivered or stored. Pushes wait for each other
+        # (self.cut_through_lock), so requests keep their order.
+        with self.lock:
+            if self.handler or self.failing or self.paused:
+                return False
+        if not self.lease.acquire():
+            return False
+        try:
+            self.requests.reload()
+            if self.requests:
+                return False
+            # If the rate limit is reached, the handler waits for its turn
+            # using the token reserved here
+            wait = self.rate_limiter.reserve()
+            if wait:
+                self.reserved_due = self.concurrency.now() + wait
+                return False
+            with self.concurrency.timeout(self.cut_through_budget):
+                delivered = self._forward(request)
+        finally:
+            self._release_lease()
+        if not delivered:
+            self.failing = True
+            request.body_file_raw.seek(0)
+        else:
+            self._release_body(request)
+        return delivered
+
     def _start(self):
         with self.lock:
-            if not self.handler:
-                self.handler = self.concurrency.spawn(self._handle)
+            if not self.handler and not self.paused:
+                self.idle.clear()
+                if self.scheduler:
+                    self.handler = self._step
+                    self.scheduler.schedule(self._step)
+                else:
+                    self.handler = self.concurrency.spawn(self._handle)
 
-    def _handle(self):
-        # This is executed in separate thread/coroutine
-        # It tries to empty request queue. We wait self.timeout seconds
-        # between to requests (we don't want to kill Intranet). In case
-        # of remote endpoint failure we wait self.backoff seconds and double
-        # that on each consecutive failure (until we reach self.max_backoff).
-        # When queue is empty we simply exists.
+    def _wake(self):
+        # End waiting of the handler early
+        if not self.scheduler:
+            self.wakeup.set()
+            return
+        with self.lock:
+            if self.handler:
+                self.scheduler.schedule(self._step)
+
+    def _step(self):
+        # This is run by the scheduler instead of _handle. It delivers up
+        # to self.batch requests (so other hosts get their turn) while it
+        # holds the lease of the queue and returns how long to wait before
+        # the next step. Waits for the rate limiter, the circuit breaker
+        # and other Repeater processes are not slept through, they are
+        # returned instead (split by the lease heartbeat, so the lease is
+        # kept meanwhile). When there is nothing to deliver it returns None
+        # and releases the lease.
+        if self.handler is None:
+            return None  # woken up after it stopped
+        delay = None
         try:
-            backoff = 0
-            while self.requests:
-                if backoff:
-                    self.concurrency.sleep(backoff)
-                while self.requests:
-                    req = self.requests.top()
-                    logging.info('Trying to forward request: '
-                                 '%s' % req.path)
-                    if self._forward(req):
-                        self.requests.pop()
-                        backoff = self.backoff
-                        if self.requests:
-                            self.concurrency.sleep(self.timeout)
-                    else:
-                        break
-                backoff = 2 * backoff if backoff else self.backoff
-                if backoff > self.max_backoff:
-                    backoff = self.max_backoff
+            delay = self._deliver_batch()
+        except Exception as error:
+            webhook_logger.exception('Delivery step failed with unexcepted '
+                                     'error\n{}'.format(error))
+        if delay is None:
+            if self.leased:
+                self.leased = False
+                self._release_lease()
             with self.lock:
                 self.handler = None
+                self.idle.set()
+        return delay
+
+    def _deliver_batch(self):
+        if self.paused or not self.requests:
+            return None
+        if self.leased and not self._keep_lease():
+            self.leased = False
+        if not self.leased:
+            if not self.lease.acquire():
+                return self.lease.ttl
+            self.leased = True
+            self.requests.reload()
+        if self.due is not None:
+            wait = self.due - self.concurrency.now()
+            if wait > 0:
+                return self._step_wait(wait)
+            self.due = None
+            if self.open_wait is not None:
+                self.breaker.waited(self.open_wait)
+                self.open_wait = None
+        for _ in range(self.batch):
+            if self.paused or not self.requests:
+                return None
+            if self.breaker.state == OPEN:
+                self.current_backoff = self.breaker.backoff
+                self.open_wait = self.breaker.next_wait()
+                return self._step_wait(self.open_wait, True)
+            req = self.requests.top()
+            self.head_received = received_at(req)
+            if not self.reserved:
+                wait = self._reserve()
+                if wait:
+                    self.reserved = True
+                    return self._step_wait(wait, True)
+            self.reserved = False
+            logging.info('Trying to forward request: '
+                         '%s' % req.path)
+            if self._forward(req):
+                self.requests.pop()
+                self.head_received = None
+                self._release_body(req)
+                self.failing = False
+                self.breaker.success()
+                self.current_backoff = 0
+                if not self._keep_lease():
+                    self.leased = False
+                    return 0
+            else:
+                self.failing = True
+                self.breaker.failure()
+        # let other hosts have their turn
+        return 0 if self.requests else None
+
+    def _step_wait(self, sec, start=False):
+        if start:
+            self.due = self.concurrency.now() + sec
+        heartbeat = self.lease.heartbeat
+        return min(sec, heartbeat) if heartbeat else sec
+
+    def _handle(self):
+        # This is executed in separate thread/coroutine
+        # It tries to empty request queue, but only while it holds the lease
+        # of the queue. If another Repeater process holds it, we check again
+        # when the lease may expire. When queue is empty we simply exists.
+        try:
+            while self.requests and not self.paused:
+                if not self.lease.acquire():
+                    self.wakeup.clear()
+                    self._nap(self.lease.ttl, self.wakeup)
+                    continue
+                try:
+                    self.requests.reload()
+                    self._deliver()
+                finally:
+                    self._release_lease()
         except Exception as error:
             webhook_logger.exception('Greenlet failed with unexcepted '
                                      'error\n{}'.format(error))
-            with self.lock:
-                self.handler = None
+        with self.lock:
+            self.handler = None
+            self.idle.set()
+
+    def _deliver(self):
+        # Before each request we wait as long as self.rate_limiter says
+        # (we don't want to kill Intranet). In case of remote endpoint
+        # failure the circuit breaker opens and we wait until it lets
+        # next attempt through (see circuit_breaker.py).
+        # We return when queue is empty, the lease was lost or the handler
+        # was paused.
+        while self.requests:
+            if self.breaker.state == OPEN and not self._wait_half_open():
+                return
+            while self.requests:
+                if self.paused:
+                    return
+                req = self.requests.top()
+                self.head_received = received_at(req)
+                wait = self._reserve()
+                if wait and not self._sleep(wait):
+                    return
+                logging.info('Trying to forward request: '
+                             '%s' % req.path)
+                if self._forward(req):
+                    self.requests.pop()
+                    self.head_received = None
+                    self._release_body(req)
+                    self.failing = False
+                    self.breaker.success()
+                    self.current_backoff = 0
+                    if not self._keep_lease():
+                        return
+                else:
+                    self.failing = True
+                    self.breaker.failure()
+                    break
+
+    def _wait_half_open(self):
+        # Wait while the circuit breaker is open, it probes the remote
+        # host meanwhile. pause() and drain() end the wait early.
+        # Returns False if the lease was lost or the handler was paused.
+        breaker = self.breaker
+        self.current_backoff = breaker.backoff
+        self.wakeup.clear()
+        while breaker.state == OPEN:
+            sec = breaker.next_wait()
+            if not self._sleep(sec, self.wakeup):
+                return False
+            if self.paused:
+                return False
+            if not self.wakeup.is_set():
+                breaker.waited(sec)
+        return True
+
+    def _release_lease(self):
+        # Acknowledgements of delivered requests kept locally (see
+        # PrefetchingRedisQueue) are written while the lease is still held,
+        # so the next holder doesn't deliver the requests again
+        try:
+            self.requests.flush()
+        finally:
+            self.lease.release()
+
+    def _release_body(self, req):
+        # Body of a large request is kept in the body store (see
+        # binary_serializer.py), it is not needed anymore.
+        key = req.environ.get('repeater.body_key')
+        if not key:
+            return
+        try:
+            self.body_store.release(key)
+        except Exception as error:
+            webhook_logger.warn('Releasing body %s failed: %s' % (key, error))
+
+    def _reserve(self):
+        # Returns seconds to wait before the next delivery. A token
+        # reserved by _deliver_directly is used instead of a new one.
+        due, self.reserved_due = self.reserved_due, None
+        if due is None:
+            return self.rate_limiter.reserve()
+        return max(due - self.concurrency.now(), 0)
+
+    def _sleep(self, sec, wakeup=None):
+        # Sleep, but keep the lease. Returns False if it was lost.
+        # The sleep ends early when `wakeup` (event) is set.
+        heartbeat = self.lease.heartbeat
+        while heartbeat and sec > heartbeat:
+            if self._nap(heartbeat, wakeup):
+                return self._keep_lease()
+            sec -= heartbeat
+            if not self._keep_lease():
+                return False
+        self._nap(sec, wakeup)
+        return self._keep_lease()
+
+    def _nap(self, sec, wakeup):
+        # Returns True if woken up
+        if wakeup is None:
+            self.concurrency.sleep(sec)
+            return False
+        return wakeup.wait(sec)
+
+    def _keep_lease(self):
+        if self.lease.keep():
+            return True
+        webhook_logger.warn('Lost lease of queue %s' % self.host)
+        return False
 
     def _forward(self, request):
         """
@@ -145,13 +745,165 @@ class QueueHandler(object):
         can be forwarded. If connection errors occur such request
         should be processed once again.
         """
+        self.attempts.inc()
+        start = self.concurrency.now()
+        path = self.routes.get(request.path_info, request.path_info)
         try:
-            proxy = self.proxies[request.path_info]
+            proxy = self.proxies[path]
             request.get_response(proxy)
-            return True
         except IOError as e:
+            self.failures.inc()
             webhook_logger.warn('IOError: %s' % str(e))
             return False
+        now = self.concurrency.now()
+        self.delivery_duration.observe(now - start)
+        received = received_at(request)
+        if received is not None:
+            self.delivery_lag.observe(max(now - received, 0))
+        self.delivered[path].inc()
+        return True
+
+
+class PartitionedQueueHandler(object):
+    # Queue handler which spreads requests for one remote host:port among
+    # `lanes` independent queue handlers. Requests with the same ordering
+    # key always go to the same lane, so they are delivered in order, while
+    # requests with different keys may be delivered concurrently. Requests
+    # without key go to the first lane, which uses the same queue as
+    # QueueHandler would, so no backlog is lost when lanes are enabled.
+    # All lanes share the same rate limiter.
+
+    queue_handler = QueueHandler  # for tests
+
+    def __init__(self, host, proxies, keys, lanes, registry, rate_limiter,
+                 hooks=None, probe=None, handlers=()):
+        # `handlers` are existing queue handlers of the first lanes (see
+        # Repeater.reload), the others are constructed
+        self.host = host
+        self.keys = keys
+        self.routes = route_table(keys)
+        self.lanes = list(handlers[:lanes])
+        for lane in range(len(self.lanes), lanes):
+            self.lanes.append(self.queue_handler(
+                lane_name(host, lane),
+                proxies,
+                registry,
+                rate_limiter,
+                hooks=hooks,
+                probe=probe
+            ))
+
+    def start(self):
+        for lane in self.lanes:
+            lane.start()
+
+    def reconfigure(self, proxies, keys, rate_limiter, hooks=None,
+                    probe=None):
+        self.keys = keys
+        self.routes = route_table(keys)
+        for lane in self.lanes:
+            lane.reconfigure(proxies, rate_limiter, hooks=hooks, probe=probe)
+
+    def push(self, request, replicas=0):
+        self.lanes[self._lane(request)].push(request, replicas)
+
+    def _lane(self, request):
+        key_func = self.keys.get(
+            self.routes.get(request.path_info, request.path_info)
+        )
+        key = key_func(request) if key_func else None
+        if key is None:
+            return 0
+        return (zlib.crc32(key) & 0xffffffff) % len(self.lanes)
+
+
+class IngestBuffer(object):
+    # Requests of hooks with durability = async are answered right away
+    # and put here; a coroutine pushes them to their queues in the order
+    # they were received. At most `size` requests wait in the buffer:
+    # when it is full, put() waits until there is room (senders take turns
+    # in the order they came), so the order is kept and the sender waits
+    # about as with durability = stored. Requests in the buffer are lost if
+    # the process dies.
+
+    def __init__(self, size, registry, push):
+        self.size = size
+        self.push = push  # push(host name, hook name, request)
+        self.concurrency = registry.get_concurrency_utils()
+        self.lock = self.concurrency.semaphore()
+        self.requests = collections.deque()
+        self.waiting = collections.deque()  # events of put() waiting for room
+        self.draining = False
+        metrics = registry.get_metrics()
+        self.full = metrics.counter(
+            'repeater_ingest_buffer_full_total',
+            'Asynchronous requests which waited as the buffer was full'
+        ).labels()
+        self.failed = metrics.counter(
+            'repeater_ingest_failed_total',
+            'Asynchronous requests lost as pushing them to the queue failed',
+            ('hook', )
+        )
+        metrics.gauge(
+            'repeater_ingest_buffer_requests',
+            'Asynchronous requests answered, but not queued yet',
+            (),
+            lambda: [((), len(self.requests))]
+        )
+        metrics.gauge(
+            'repeater_ingest_buffer_capacity',
+            'How many asynchronous requests may wait to be queued',
+            (),
+            lambda: [((), self.size)]
+        )
+
+    def put(self, host_name, hook_name, request):
+        room = None
+        with self.lock:
+            if len(self.requests) >= self.size or self.waiting:
+                self.full.inc()
+                room = self.concurrency.event()
+                self.waiting.append(room)
+        if room is not None:
+            # set when it is the first one waiting and there is room
+            room.wait()
+        with self.lock:
+            if room is not None:
+                self.waiting.popleft()
+            self.requests.append((host_name, hook_name, request))
+            self._let_in()
+            if self.draining:
+                return
+            self.draining = True
+        self.concurrency.spawn(self._drain)
+
+    def __len__(self):
+        return len(self.requests)
+
+    def _drain(self):
+        # This is executed in separate thread/coroutine
+        # The request is removed after it is pushed, so it is counted
+        # in the occupancy until then
+        while True:
+            with self.lock:
+                if not self.requests:
+                    self.draining = False
+                    return
+                host_name, hook_name, request = self.requests[0]
+            try:
+                self.push(host_name, hook_name, request)
+            except Exception as error:
+                self.failed.labels(hook_name).inc()
+                webhook_logger.exception(
+                    'Queueing request of %s failed\n%s' % (hook_name, error)
+                )
+            with self.lock:
+                self.requests.popleft()
+                self._let_in()
+
+    def _let_in(self):
+        if self.waiting and len(self.requests) < self.size:
+            self.waiting[0].set()
 
 
 class Repeater(object):
@@ -159,38 +911,354 @@ class Repeater(object):
     # 2. Repeater has one queue per destination (host:port)
     # 3. Each incoming request is put in proper destination queue based
     #    on PATH_INFO
-    # 4. When request is forwarded it is signed using secret
+    # 4. When request is forwarded it is signed using secret (see
+    #    signing.py)
 
     queue_handler = QueueHandler  # for tests
-    proxy = wsgiproxy.app.WSGIProxyApp  # for tests
+    partitioned_queue_handler = PartitionedQueueHandler  # for tests
 
     def __init__(self, hooks, registry):
         self.registry = registry
-        self.secret = registry.settings['secret']
-        self.paths = {}
+        self.hooks = hooks
+        self.signer = registry.get_request_signer()
+        self.sign_digest = registry.settings.get('sign_digest', 'md5')
+        self.max_body_size = registry.settings.get('max_body_size', 0)
+        self.trusted_proxies = AddressMatcher(
+            registry.settings.get('trusted_proxies', '')
+        )
+        self.concurrency = registry.get_concurrency_utils()
+        # Fanned out requests share their body only if queues are in Redis,
+        # other backends get copies of the request (see _fan_out)
+        self.body_store = None
+        if registry.settings.get('queue_backend', 'redis') == 'redis':
+            self.body_store = registry.get_body_store()
+        metrics = registry.get_metrics()
+        self.metrics_path = registry.settings.get('metrics_path', '')
+        self.metrics_app = MetricsApp(metrics)
+        self.accepted_total = metrics.counter(
+            'repeater_requests_accepted_total',
+            'Requests accepted for delivery',
+            ('hook', )
+        )
+        self.rejected = metrics.counter(
+            'repeater_requests_rejected_total',
+            'Rejected requests (hook is empty if the path is unknown)',
+            ('hook', 'code')
+        )
+        self.unreplicated = metrics.counter(
+            'repeater_requests_unreplicated_total',
+            'Requests queued, but not confirmed by replicas in time',
+            ('hook', )
+        )
+        self.durability = registry.settings.get('durability', STORED)
+        self.durability_replicas = registry.settings.get(
+            'durability_replicas',
+            1
+        )
+        self.ingest = IngestBuffer(
+            registry.settings.get('ingest_buffer_size', 1000),
+            registry,
+            self._push
+        )
+        # remote host -> its queue handler, constructed when the first
+        # request is pushed to it or its backlog is found (see queue())
+        self.queues = {}
+        # remote host -> lock held while its queue handler is constructed
+        self.constructing = {}
+        # remote host -> its queue handlers (lanes), see admin.py
+        self.destinations = {}
+        # remote host -> its settings the queue handler was constructed
+        # with (see _queue_config)
+        self.configs = {}
+        self.proxies = {}
+        self._route(hooks)
+        self.lanes = registry.settings.get('lanes', 1)
+        self.startup_stagger = registry.settings.get('startup_stagger', 0.1)
+        self.concurrency.spawn(self._start_backlog)
+
+    def _route(self, hooks):
+        # Set up hooks, proxies (hook name -> ((URL, source path), proxy),
+        # reusing those with the same URL and source path), hosts (remote
+        # host -> names of its hooks) and paths (RouteTrie, source path ->
+        # (allowed source hosts, [(remote host, hook name)]), see
+        # routing.py; hooks with fan_out share the source path).
+        # They are replaced at once, so requests being received meanwhile
+        # see either old or new hooks.
         proxies = {}
         hosts = {}
+        targets = {}
         for hook_name, hook_spec in hooks.items():
 
             dst_host = hook_spec['dst_host']
             dst_path = hook_spec['dst_path']
-            proxies[hook_name] = self.proxy('%s%s' % (dst_host, dst_path))
+            src_path = hook_spec['src_path']
+            href = '%s%s' % (dst_host, dst_path)
+            if self.proxies.get(hook_name, (None, None))[0] == \
+                    (href, src_path):
+                proxies[hook_name] = self.proxies[hook_name]
+            elif template_names(dst_path):
+                proxies[hook_name] = ((href, src_path), TemplateProxy(
+                    src_path,
+                    href,
+                    self.registry.construct_proxy
+                ))
+            else:
+                proxies[hook_name] = (
+                    (href, src_path),
+                    self.registry.construct_proxy(href)
+                )
 
             if dst_host not in hosts:
                 hosts[dst_host] = [hook_name]
             else:
                 hosts[dst_host].append(hook_name)
 
-        for host_name, hook_names in hosts.items():
-            queue_proxies = {
-                hooks[hook_name]['src_path']: proxies[hook_name]
-                for hook_name in hook_names
+            targets.setdefault(src_path, []).append((dst_host, hook_name))
+
+        paths = RouteTrie()
+        for src_path, path_targets in targets.items():
+            path_targets.sort(key=lambda target: target[1])
+            src_hosts = hook_matcher(hooks[path_targets[0][1]])
+            paths.add(src_path, (src_hosts, path_targets))
+
+        self.accepted = {
+            hook_name: self.accepted_total.labels(hook_name)
+            for hook_name in hooks
+        }
+        self.hooks = hooks
+        self.proxies = proxies
+        self.hosts = hosts
+        self.paths = paths
+
+    def reload(self, hooks):
+        """
+        Start using changed hooks without stopping. Queue handlers of remote
+        hosts whose hooks are unchanged are kept as they are. Handlers of
+        changed ones are reconfigured, so their queues, connections and
+        backoff are kept; requests queued for removed hooks are still
+        delivered. Handlers of removed remote hosts deliver what is queued.
+        When lanes of a remote host are enabled or disabled (order_key is
+        set or unset), the handler without lanes is the first lane and
+        other lanes deliver what is queued after they are disabled.
+        """
+        old_hooks = self.hooks
+        old_hosts = self.hosts
+        self._route(hooks)
+        for host_name in list(self.queues):
+            hook_names = sorted(self.hosts.get(host_name, []))
+            if not hook_names or (
+                hook_names == sorted(old_hosts.get(host_name, [])) and
+                all(hooks[name] == old_hooks[name] for name in hook_names)
+            ):
+                continue
+            self._reconfigure_queue(host_name)
+        added = sorted(set(self.hosts) - set(old_hosts))
+        if added:
+            self.concurrency.spawn(
+                functools.partial(self._start_backlog, added)
+            )
+        webhook_logger.info('Hooks reloaded: %s' % ', '.join(sorted(hooks)))
+
+    def queue(self, host_name):
+        """
+        Returns queue handler of the remote host, it is constructed on
+        first use.
+        """
+        queue = self.queues.get(host_name)
+        if queue is None:
+            # Constructing may switch to other threads/coroutines (e.g. on
+            # a call to Redis), which must not construct another one
+            lock = self.constructing.get(host_name)
+            if lock is None:
+                lock = self.constructing[host_name] = \
+                    self.concurrency.semaphore()
+            with lock:
+                queue = self.queues.get(host_name)
+                if queue is None:
+                    queue = self.queues[host_name] = \
+                        self._construct_queue(host_name)
+        return queue
+
+    def handlers(self, host_name):
+        """
+        Returns queue handlers (lanes) of the remote host
+        """
+        self.queue(host_name)
+        return self.destinations[host_name]
+
+    def status(self, host_name):
+        """
+        Returns state of delivery to the remote host, one for each lane.
+        Its queue handler is not constructed: without one nothing is being
+        delivered to the remote host yet.
+        """
+        handlers = self.destinations.get(host_name)
+        if handlers is not None:
+            return [handler.status() for handler in handlers]
+        return [
+            {
+                'destination': name,
+                'paused': False,
+                'failing': False,
+                'circuit': CLOSED,
+                'backoff': 0,
+                'delivering': False,
             }
-            queue = self.queue_handler(host_name, queue_proxies, registry)
-            for hook_name in hook_names:
-                src_path = hooks[hook_name]['src_path']
-                src_hosts = hooks[hook_name]['src_host']
-                self.paths[src_path] = (src_hosts, queue)
+            for name in self._queue_names(host_name)
+        ]
+
+    def _queue_config(self, host_name):
+        # Settings of the queue handler of the remote host given by its
+        # hooks (order keys are kept as specs, so configs can be compared)
+        hooks = self.hooks
+        hook_names = sorted(self.hosts[host_name])
+        hook_specs = [hooks[hook_name] for hook_name in hook_names]
+        return {
+            'rate': destination_rate(hook_specs, self.registry.settings),
+            'probe': destination_probe(hook_specs, self.registry.settings),
+            'proxies': {
+                hooks[hook_name]['src_path']: self.proxies[hook_name][1]
+                for hook_name in hook_names
+            },
+            'hooks': {
+                hooks[hook_name]['src_path']: hook_name
+                for hook_name in hook_names
+            },
+            'keys': {
+                hooks[hook_name]['src_path']: hooks[hook_name]['order_key']
+                for hook_name in hook_names
+                if hooks[hook_name].get('order_key')
+            },
+        }
+
+    def _partitioned(self, config):
+        return self.lanes > 1 and bool(config['keys'])
+
+    def _construct_queue(self, host_name):
+        registry = self.registry
+        config = self.configs[host_name] = self._queue_config(host_name)
+        rate, burst = config['rate']
+        rate_limiter = registry.construct_rate_limiter(
+            host_name,
+            rate,
+            burst
+        )
+        probe = registry.construct_probe(host_name, config['probe'])
+        if self._partitioned(config):
+            queue = self.partitioned_queue_handler(
+                host_name,
+                config['proxies'],
+                self._keys(config),
+                self.lanes,
+                registry,
+                rate_limiter,
+                hooks=config['hooks'],
+                probe=probe
+            )
+            self.destinations[host_name] = queue.lanes
+        else:
+            queue = self.queue_handler(
+                host_name,
+                config['proxies'],
+                registry,
+                rate_limiter,
+                hooks=config['hooks'],
+                probe=probe
+            )
+            self.destinations[host_name] = [queue]
+        return queue
+
+    def _reconfigure_queue(self, host_name):
+        registry = self.registry
+        old = self.configs[host_name]
+        config = self.configs[host_name] = self._queue_config(host_name)
+        queue = self.queues[host_name]
+        handlers = self.destinations[host_name]
+        rate_limiter = handlers[0].rate_limiter
+        if config['rate'] != old['rate']:
+            rate, burst = config['rate']
+            rate_limiter = registry.construct_rate_limiter(
+                host_name,
+                rate,
+                burst
+            )
+        probe = handlers[0].breaker.probe
+        if config['probe'] != old['probe']:
+            probe = registry.construct_probe(host_name, config['probe'])
+        if self._partitioned(config) and self._partitioned(old):
+            queue.reconfigure(
+                config['proxies'],
+                self._keys(config),
+                rate_limiter,
+                hooks=config['hooks'],
+                probe=probe
+            )
+            return
+        # Handlers are never replaced, so each queue is delivered by one
+        # handler only: when lanes are enabled, the handler without lanes
+        # becomes the first lane; when they are disabled, it takes new
+        # requests and other lanes deliver what they have queued (they are
+        # used again if lanes are enabled again).
+        for handler in handlers:
+            handler.reconfigure(
+                config['proxies'],
+                rate_limiter,
+                hooks=config['hooks'],
+                probe=probe
+            )
+        if not self._partitioned(config):
+            self.queues[host_name] = handlers[0]
+            return
+        queue = self.queues[host_name] = self.partitioned_queue_handler(
+            host_name,
+            config['proxies'],
+            self._keys(config),
+            self.lanes,
+            registry,
+            rate_limiter,
+            hooks=config['hooks'],
+            probe=probe,
+            handlers=handlers
+        )
+        self.destinations[host_name] = queue.lanes
+        queue.start()
+
+    def _keys(self, config):
+        return {
+            path: ordering_key(spec) for path, spec in config['keys'].items()
+        }
+
+    def _queue_names(self, host_name):
+        # Names of queues of the remote host, one for each lane
+        if self.lanes > 1 and any(
+            self.hooks[hook_name].get('order_key')
+            for hook_name in self.hosts[host_name]
+        ):
+            return [
+                lane_name(host_name, lane) for lane in range(self.lanes)
+            ]
+        return [host_name]
+
+    def _start_backlog(self, host_names=None):
+        # This is executed in separate thread/coroutine
+        # Queues holding requests from the last run are found at once
+        # (e.g. in one round trip to Redis), then their handlers are
+        # started one by one, `startup_stagger` seconds apart, so remote
+        # hosts are not flooded by all the backlog at once.
+        try:
+            names = {}
+            for host_name in host_names or self.hosts:
+                for name in self._queue_names(host_name):
+                    names[name] = host_name
+            backlog = self.registry.find_backlog(sorted(names))
+            hosts = sorted(set(names[name] for name in backlog))
+            for i, host_name in enumerate(hosts):
+                if i and self.startup_stagger:
+                    self.concurrency.sleep(self.startup_stagger)
+                self.queue(host_name).start()
+        except Exception as error:
+            webhook_logger.exception('Starting delivery of the backlog '
+                                     'failed\n{}'.format(error))
 
     def __call__(self, environ, start_response):
         req = webob.Request(environ)
@@ -198,22 +1266,137 @@ class Repeater(object):
         return resp(environ, start_response)
 
     def _handle(self, request):
-        hosts, queue = self.paths.get(request.path_info, (None, None))
+        if self.metrics_path and request.path_info == self.metrics_path:
+            return self.metrics_app.response()
+        hosts, targets = self.paths.get(
+            request.path_info,
+            (None, [(None, '')])
+        )
+        hook_names = [hook_name for _, hook_name in targets]
         if not hosts:
             webhook_logger.error(
                 "hosts is empty! Is config file ok? Request path info was: "
                 "%s. Please check webhook settings in Jira." % request.path_info
             )
-            return webob.exc.HTTPNotFound()
-        address = request.headers.get('X-Forwarded-For', request.remote_addr)
-        if not check_remote_address(hosts, address):
+            return self._reject(hook_names, webob.exc.HTTPNotFound())
+        address = client_address(
+            request.remote_addr,
+            request.headers.get('X-Forwarded-For'),
+            self.trusted_proxies
+        )
+        if address not in hosts:
             webhook_logger.error("access denied, remote_address:%s but "
                                  "expected: %s" % (address, hosts))
-            return webob.exc.HTTPForbidden()
-        request = sign_request(request.copy(), self.secret)
-        queue.push(request)
+            return self._reject(hook_names, webob.exc.HTTPForbidden())
+        # Bodies without Content-Length are checked once they are read
+        # (large bodies are spooled to temporary files by webob)
+        if self._too_large(request):
+            return self._reject(
+                hook_names,
+                webob.exc.HTTPRequestEntityTooLarge()
+            )
+        request = request.copy()
+        if self._too_large(request):
+            return self._reject(
+                hook_names,
+                webob.exc.HTTPRequestEntityTooLarge()
+            )
+        request.environ['repeater.received'] = self.concurrency.now()
+        # Signatures of all hooks are computed in one pass over the body
+        digests = [
+            self.hooks[hook_name].get('sign_digest', self.sign_digest)
+            for _, hook_name in targets
+        ]
+        sigs = self.signer.sign(request, digests)
+        if len(targets) > 1:
+            requests = self._fan_out(request, len(targets))
+        else:
+            requests = [request]
+        replicated = True
+        for (host_name, hook_name), target_request, digest in zip(
+            targets,
+            requests,
+            digests
+        ):
+            target_request.headers[SIGNATURE_HEADER] = sigs[digest]
+            if not self._push(host_name, hook_name, target_request, True):
+                replicated = False
+            self.accepted[hook_name].inc()
+        if not replicated:
+            # The request is queued, but the sender should retry as it could
+            # be lost with the Redis master. It is queued for all fanned out
+            # hooks already, so the retry delivers it twice to each of them
+            # (see durability in config.ini).
+            return webob.exc.HTTPServiceUnavailable(
+                'Request not confirmed by Redis replicas'
+            )
         response = webob.Response()
         response.status = '200 OK'
         response.content_type = 'text/plain'
         response.body = 'OK'
         return response
+
+    def _push(self, host_name, hook_name, request, received=False):
+        # Queue the request as the durability of the hook says: `received`
+        # requests of async hooks go to the ingest buffer. Returns False if
+        # replicas did not confirm the request.
+        hook_spec = self.hooks.get(hook_name, {})
+        durability = hook_spec.get('durability', self.durability)
+        if durability == ASYNC and received:
+            self.ingest.put(host_name, hook_name, request)
+            return True
+        replicas = 0
+        if durability == REPLICATED:
+            replicas = hook_spec.get(
+                'durability_replicas',
+                self.durability_replicas
+            )
+        try:
+            self.queue(host_name).push(request, replicas)
+        except IOError as error:
+            if not replicas:
+                raise
+            webhook_logger.warning(str(error))
+            self.unreplicated.labels(hook_name).inc()
+            return False
+        return True
+
+    def _reject(self, hook_names, response):
+        for hook_name in hook_names:
+            self.rejected.labels(hook_name, str(response.status_code)).inc()
+        return response
+
+    def _fan_out(self, request, count):
+        # Returns `count` requests sharing the body of `request`: it is put
+        # in the body store once and queue entries of all of them refer to
+        # it (see binary_serializer.py), so it is not written `count`
+        # times. The body is deleted once all of them were delivered.
+        size = request.content_length or 0
+        if self.body_store and size:
+            try:
+                key = self.body_store.put(request.body_file_raw, size, count)
+            except Exception as error:
+                webhook_logger.warn('Storing shared body failed: %s' % error)
+            else:
+                requests = []
+                for _ in range(count):
+                    environ = dict(request.environ)
+                    environ['repeater.body_key'] = key
+                    environ['wsgi.input'] = self.body_store.open(key, size)
+                    requests.append(webob.Request(environ))
+                return requests
+            request.body_file_raw.seek(0)
+        return [request] + [request.copy() for _ in range(count - 1)]
+
+    def _too_large(self, request):
+        if not self.max_body_size or request.content_length is None:
+            return False
+        if request.content_length <= self.max_body_size:
+            return False
+        webhook_logger.warn(
+            'Request body too large: %d bytes, path info was: %s' % (
+                request.content_length,
+                request.path_info
+            )
+        )
+        return True
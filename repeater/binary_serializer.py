@@ -0,0 +1,185 @@
+"""
+This module provides compact binary request serializer.
+See interfaces.py for documentation.
+
+Only the parts of the request needed to forward it are stored:
+
+    magic (2 bytes) | version (1 byte) | received timestamp (double)
+    method | url scheme | server name | server port | server protocol
+    script name | path info | query string | remote address
+    number of headers | (header name | header value) * number of headers
+    body
+
+Each string is prefixed with its length (see FIELD, HEADER and BODY
+for the length formats). All numbers are in network byte order.
+
+Bodies longer than `spool_threshold` bytes are put in the body store
+(see body_store.py) instead, as well as bodies shared by requests for
+several remote hosts. Such entries have version SPOOLED_VERSION
+and end with the body length (see SPOOLED_BODY) and the key of the body
+in the store (prefixed with its length as other fields).
+
+Entries written by the pickle based RequestSerializer are still readable,
+so queues filled by older versions can be drained.
+"""
+
+import StringIO as stringio
+import struct
+import sys
+import time
+
+import webob
+from zope.interface import implementer
+
+from repeater.application import RequestSerializer
+from repeater.interfaces import IRequestSerializer
+
+MAGIC = 'WR'
+VERSION = 1
+SPOOLED_VERSION = 2
+
+PREFIX = struct.Struct('!2sBd')
+FIELD = struct.Struct('!H')
+HEADER = struct.Struct('!HI')
+BODY = struct.Struct('!I')
+SPOOLED_BODY = struct.Struct('!Q')
+
+FIELDS = (
+    'REQUEST_METHOD',
+    'wsgi.url_scheme',
+    'SERVER_NAME',
+    'SERVER_PORT',
+    'SERVER_PROTOCOL',
+    'SCRIPT_NAME',
+    'PATH_INFO',
+    'QUERY_STRING',
+    'REMOTE_ADDR',
+)
+
+# Not prefixed by HTTP_ but still sent as headers
+HEADERS = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+
+
+class SerializationError(ValueError):
+    pass
+
+
+@implementer(IRequestSerializer)
+class BinaryRequestSerializer(object):
+
+    legacy_serializer = RequestSerializer
+
+    def __init__(self, body_store=None, spool_threshold=0):
+        self.legacy = self.legacy_serializer()
+        self.body_store = body_store
+        self.spool_threshold = spool_threshold
+
+    def dumps(self, req):
+        env = req.environ
+        headers = [
+            (key, env[key]) for key in env
+            if key.startswith('HTTP_') or key in HEADERS
+        ]
+        # Bodies shared by several requests (see Repeater._fan_out) are
+        # in the body store already
+        spooled = bool(self.body_store and (
+            env.get('repeater.body_key') or
+            self.spool_threshold and
+            (req.content_length or 0) > self.spool_threshold
+        ))
+        parts = [PREFIX.pack(
+            MAGIC,
+            SPOOLED_VERSION if spooled else VERSION,
+            env.get('repeater.received') or time.time()
+        )]
+        for key in FIELDS:
+            value = env.get(key, '')
+            parts.append(FIELD.pack(len(value)))
+            parts.append(value)
+        parts.append(FIELD.pack(len(headers)))
+        for key, value in headers:
+            parts.append(HEADER.pack(len(key), len(value)))
+            parts.append(key)
+            parts.append(value)
+        if spooled:
+            key = self._spool(req)
+            parts.append(SPOOLED_BODY.pack(req.content_length))
+            parts.append(FIELD.pack(len(key)))
+            parts.append(key)
+        else:
+            body = req.body
+            parts.append(BODY.pack(len(body)))
+            parts.append(body)
+        return ''.join(parts)
+
+    def _spool(self, req):
+        # A request read from the queue already has its body in the store
+        key = req.environ.get('repeater.body_key')
+        if not key:
+            req.make_body_seekable()
+            key = self.body_store.put(req.body_file_raw, req.content_length)
+            req.body_file_raw.seek(0)
+        return key
+
+    def loads(self, string):
+        if not string.startswith(MAGIC):
+            return self.legacy.loads(string)
+        try:
+            return self._loads(string)
+        except struct.error as e:
+            raise SerializationError('Truncated request: %s' % e)
+
+    def _loads(self, string):
+        _, version, received = PREFIX.unpack_from(string)
+        if version not in (VERSION, SPOOLED_VERSION):
+            raise SerializationError(
+                'Unsupported request format version: %s' % version
+            )
+        offset = PREFIX.size
+        env = {
+            'wsgi.version': (1, 0),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'webob.is_body_seekable': True,
+            'repeater.received': received,
+        }
+        for key in FIELDS:
+            size, = FIELD.unpack_from(string, offset)
+            offset += FIELD.size
+            env[key] = string[offset:offset + size]
+            offset += size
+        count, = FIELD.unpack_from(string, offset)
+        offset += FIELD.size
+        for _ in xrange(count):
+            key_size, value_size = HEADER.unpack_from(string, offset)
+            offset += HEADER.size
+            key = string[offset:offset + key_size]
+            offset += key_size
+            env[key] = string[offset:offset + value_size]
+            offset += value_size
+        if version == SPOOLED_VERSION:
+            return self._load_spooled(env, string, offset)
+        size, = BODY.unpack_from(string, offset)
+        offset += BODY.size
+        body = string[offset:offset + size]
+        if len(body) != size:
+            raise SerializationError('Truncated request body')
+        env['wsgi.input'] = stringio.StringIO(body)
+        return webob.Request(env)
+
+    def _load_spooled(self, env, string, offset):
+        if not self.body_store:
+            raise SerializationError('Request body is spooled, but there '
+                                     'is no body store')
+        size, = SPOOLED_BODY.unpack_from(string, offset)
+        offset += SPOOLED_BODY.size
+        key_size, = FIELD.unpack_from(string, offset)
+        offset += FIELD.size
+        key = string[offset:offset + key_size]
+        if len(key) != key_size:
+            raise SerializationError('Truncated request body key')
+        env['repeater.body_key'] = key
+        env['wsgi.input'] = self.body_store.open(key, size)
+        return webob.Request(env)
@@ -0,0 +1,132 @@
+"""
+This module provides storage of large request bodies.
+See interfaces.py for documentation.
+
+Bodies longer than `body_spool_threshold` bytes are not stored in the
+queue entries (see binary_serializer.py). RedisBodyStore keeps them in
+Redis lists of CHUNK_SIZE long chunks, so they are written and read back
+one chunk at a time and the memory used by a request doesn't depend on
+its size. The body is kept `body_retention` seconds after the request is
+delivered, as the queue may deliver it once again if the process dies.
+
+A body shared by requests for several remote hosts (fan-out, see
+Repeater._fan_out) is stored once with the number of its references in
+"<key>:refs". Each delivered (or deleted) request releases one of them,
+the body expires when the last one is released.
+"""
+
+import uuid
+
+import redis
+from zope.interface import implementer
+
+from repeater.interfaces import IBodyStore
+
+CHUNK_SIZE = 64 * 1024
+REFS = '%s:refs'
+
+
+def read_chunks(body_file, size, chunk_size=CHUNK_SIZE):
+    """
+    Method yields `size` bytes read from `body_file` in chunks.
+    """
+    while size > 0:
+        chunk = body_file.read(min(size, chunk_size))
+        if not chunk:
+            raise IOError('Body is shorter than expected (%d bytes '
+                          'missing)' % size)
+        size -= len(chunk)
+        yield chunk
+
+
+class ChunkedBody(object):
+    # Read-only file-like object, it fetches the chunks of a body stored by
+    # RedisBodyStore when they are read. Only the current chunk is kept.
+
+    def __init__(self, redis, key, size, chunk_size=CHUNK_SIZE):
+        self.redis = redis
+        self.key = key
+        self.size = size
+        self.chunk_size = chunk_size
+        self.pos = 0
+        self.index = None
+        self.chunk = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.size - self.pos:
+            size = self.size - self.pos
+        parts = []
+        while size > 0:
+            index, offset = divmod(self.pos, self.chunk_size)
+            if index != self.index:
+                self.chunk = self.redis.lindex(self.key, index)
+                if self.chunk is None:
+                    raise IOError('Body %s is missing' % self.key)
+                self.index = index
+            part = self.chunk[offset:offset + size]
+            if not part:
+                raise IOError('Body %s is truncated' % self.key)
+            parts.append(part)
+            self.pos += len(part)
+            size -= len(part)
+        return ''.join(parts)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+
+    def tell(self):
+        return self.pos
+
+
+@implementer(IBodyStore)
+class RedisBodyStore(object):
+
+    chunked_body = ChunkedBody  # for tests
+    redis_mod = redis  # for tests
+    key_prefix = 'repeater:body:'
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.retention = registry.settings.get('body_retention', 3600)
+        self.redis = None
+
+    def _redis(self):
+        # Connect lazily, the store is not used unless bodies are spooled
+        if not self.redis:
+            settings = self.registry.settings
+            self.redis = self.redis_mod.Redis(
+                host=settings['redis_host'],
+                port=settings['redis_port'],
+                db=settings['redis_db']
+            )
+        return self.redis
+
+    def put(self, body_file, size, refs=1):
+        key = self.key_prefix + uuid.uuid4().hex
+        redis = self._redis()
+        try:
+            for chunk in read_chunks(body_file, size):
+                redis.rpush(key, chunk)
+            if refs > 1:
+                redis.set(REFS % key, refs)
+        except Exception:
+            redis.delete(key, REFS % key)
+            raise
+        return key
+
+    def open(self, key, size):
+        return self.chunked_body(self._redis(), key, size)
+
+    def release(self, key):
+        redis = self._redis()
+        # Bodies with a single reference have no counter, DECR makes it -1
+        if redis.decr(REFS % key) > 0:
+            return
+        pipe = redis.pipeline()
+        pipe.delete(REFS % key)
+        pipe.expire(key, self.retention)
+        pipe.execute()
@@ -0,0 +1,96 @@
+"""
+This module provides circuit breaker of deliveries to one remote host
+(see QueueHandler). Its states are:
+
+- closed - requests are delivered one after another,
+- open - the last delivery failed, nothing is sent until the backoff
+  passes (it starts at backoff_timeout and doubles after each
+  consecutive failure up to backoff_max_timeout; each wait is shortened
+  by random part of the backoff, at most `jitter`, so hosts and processes
+  failing at once don't retry at once). Meanwhile the remote
+  host is checked by the probe (if any, see probe.py) every
+  `probe_interval` seconds,
+- half-open - the backoff passed or the probe succeeded, so one request
+  is sent: if it is delivered the circuit closes, otherwise it opens
+  again with doubled backoff.
+
+If the request sent after a successful probe is not delivered, the probe
+can't be trusted (e.g. the host accepts connections, but not requests),
+so the next backoff is waited out without probing.
+"""
+
+import random
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    random = random.random  # for tests
+
+    def __init__(self, probe, backoff, max_backoff, probe_interval,
+                 jitter=0):
+        self.probe = probe
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_interval = probe_interval
+        self.jitter = jitter
+        self.state = CLOSED
+        self.backoff = 0
+        self.remaining = 0  # of the backoff
+        self.probed = False  # the circuit was half-opened by the probe
+        self.probing = True
+
+    def success(self):
+        self.state = CLOSED
+        self.backoff = 0
+        self.probing = True
+
+    def failure(self):
+        if self.backoff:
+            self.backoff = min(2 * self.backoff, self.max_backoff)
+        else:
+            self.backoff = self.base_backoff
+        self.probing = not (self.state == HALF_OPEN and self.probed)
+        self.state = OPEN
+        self.remaining = self.backoff
+        if self.jitter:
+            self.remaining -= self.backoff * self.jitter * self.random()
+
+    def reset(self):
+        # Try a request at once, the next backoff starts over
+        if self.state == OPEN:
+            self._half_open(False)
+            self.backoff = 0
+            self.probing = True
+
+    def next_wait(self):
+        """
+        Returns how long to wait in the open state before calling waited()
+        """
+        if self._probes():
+            return min(self.probe_interval, self.remaining)
+        return self.remaining
+
+    def waited(self, sec):
+        """
+        Called after waiting `sec` seconds in the open state, it probes
+        the remote host if it is time to do so. Returns True if the
+        circuit was half-opened.
+        """
+        self.remaining -= sec
+        if self.remaining <= 0:
+            self._half_open(False)
+        elif self._probes() and self.probe.check():
+            self._half_open(True)
+        return self.state == HALF_OPEN
+
+    def _probes(self):
+        return bool(self.probe and self.probing and self.probe_interval)
+
+    def _half_open(self, probed):
+        self.state = HALF_OPEN
+        self.probed = probed
+        self.remaining = 0
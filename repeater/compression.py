@@ -0,0 +1,141 @@
+"""
+This module provides request serializer which compresses stored requests.
+See interfaces.py for documentation.
+
+Requests are serialized by BinaryRequestSerializer; entries longer than
+`compression_threshold` bytes are compressed and stored as:
+
+    magic (2 bytes) | codec tag (1 byte) | compressed entry
+
+Other entries (short ones, those which didn't get smaller and those
+written before compression was enabled) are stored as they are, so
+queues with mixed entries are readable. zlib is always available, lz4 is
+used if the `lz4` package is installed.
+"""
+
+import collections
+import zlib
+
+from zope.interface import implementer
+
+from repeater.binary_serializer import (
+    BinaryRequestSerializer,
+    SerializationError,
+)
+from repeater.interfaces import IRequestSerializer
+from repeater.log import webhook_logger
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+MAGIC = 'WC'
+
+Codec = collections.namedtuple('Codec', 'tag compress decompress')
+
+
+def codecs(level):
+    result = {
+        'zlib': Codec(
+            'z',
+            lambda string: zlib.compress(string, level),
+            zlib.decompress
+        ),
+    }
+    if lz4:
+        result['lz4'] = Codec('4', lz4.block.compress, lz4.block.decompress)
+    return result
+
+
+class CompressionStats(object):
+
+    def __init__(self):
+        self.entries = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.cpu_time = 0.
+
+    def add(self, raw_size, stored_size, cpu_time):
+        self.entries += 1
+        if stored_size < raw_size:
+            self.compressed += 1
+        self.raw_bytes += raw_size
+        self.stored_bytes += stored_size
+        self.cpu_time += cpu_time
+
+    def ratio(self):
+        if not self.stored_bytes:
+            return 1.
+        return float(self.raw_bytes) / self.stored_bytes
+
+    def __str__(self):
+        return (
+            '%d entries (%d compressed), compression ratio %.2f, '
+            '%.1f us of CPU per entry' % (
+                self.entries,
+                self.compressed,
+                self.ratio(),
+                self.cpu_time / max(self.entries, 1) * 1e6
+            )
+        )
+
+
+@implementer(IRequestSerializer)
+class CompressingRequestSerializer(object):
+
+    serializer_class = BinaryRequestSerializer  # for tests
+    stats_interval = 1000  # entries between logged stats
+
+    def __init__(self, registry):
+        settings = registry.settings
+        # Bodies are spooled to Redis only if queues are kept there as well
+        body_store = None
+        if settings.get('queue_backend', 'redis') in ('redis', 'tiered'):
+            body_store = registry.get_body_store()
+        self.serializer = self.serializer_class(
+            body_store,
+            settings.get('body_spool_threshold', 0)
+        )
+        self.codecs = codecs(settings.get('compression_level', 6))
+        self.by_tag = {
+            codec.tag: codec for codec in self.codecs.values()
+        }
+        name = settings.get('compression', 'zlib')
+        if name not in self.codecs and name != 'off':
+            webhook_logger.warn(
+                'Compression %s is not available, zlib is used' % name
+            )
+            name = 'zlib'
+        self.codec = self.codecs.get(name)
+        self.threshold = settings.get('compression_threshold', 1024)
+        self.stats = CompressionStats()
+        # compression doesn't yield, so it is (nearly) all CPU time
+        self.clock = registry.get_concurrency_utils().now
+
+    def dumps(self, req):
+        string = self.serializer.dumps(req)
+        if not self.codec or len(string) < self.threshold:
+            return string
+        start = self.clock()
+        compressed = MAGIC + self.codec.tag + self.codec.compress(string)
+        if len(compressed) >= len(string):
+            compressed = string
+        self.stats.add(len(string), len(compressed), self.clock() - start)
+        if self.stats.entries % self.stats_interval == 0:
+            webhook_logger.info('Compression: %s' % self.stats)
+        return compressed
+
+    def loads(self, string):
+        if string.startswith(MAGIC):
+            codec = self.by_tag.get(string[len(MAGIC)])
+            if not codec:
+                raise SerializationError(
+                    'Unsupported compression: %r' % string[len(MAGIC)]
+                )
+            try:
+                string = codec.decompress(string[len(MAGIC) + 1:])
+            except Exception as e:
+                raise SerializationError('Corrupted request: %s' % e)
+        return self.serializer.loads(string)
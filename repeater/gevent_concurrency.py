@@ -2,13 +2,19 @@
 This module provides utilities for concurrency. See interfaces.py
 for documentation.
 """
+import socket
+import time
+
 import gevent
+import gevent.event
 import gevent.lock
 import gevent.monkey
 from zope.interface import implementer
 
 from repeater.interfaces import (
     IConcurrencyUtils,
+    IEvent,
+    IFuture,
     ISemaphore,
 )
 
@@ -28,11 +34,54 @@ class GEventSemaphore(object):
         self.sem.release()
 
 
+@implementer(IFuture)
+class GEventFuture(object):
+
+    gevent_mod = gevent
+
+    def __init__(self):
+        self.result = self.gevent_mod.event.AsyncResult()
+
+    def set(self, value=None):
+        self.result.set(value)
+
+    def set_exception(self, exception):
+        self.result.set_exception(exception)
+
+    def get(self):
+        return self.result.get()
+
+
+@implementer(IEvent)
+class GEventEvent(object):
+
+    gevent_mod = gevent
+
+    def __init__(self):
+        self.event = self.gevent_mod.event.Event()
+
+    def set(self):
+        self.event.set()
+
+    def clear(self):
+        self.event.clear()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def wait(self, sec=None):
+        self.event.wait(sec)
+        return self.event.is_set()
+
+
 @implementer(IConcurrencyUtils)
 class GEventConcurrencyUtils(object):
 
     gevent_mod = gevent
+    time_mod = time
     semaphore_class = GEventSemaphore
+    future_class = GEventFuture
+    event_class = GEventEvent
 
     def __init__(self):
         # need this because of wsgiproxy (which use httplib)
@@ -41,10 +90,29 @@ class GEventConcurrencyUtils(object):
         self.gevent_mod.monkey.patch_ssl()
 
     def spawn(self, func):
-        self.gevent_mod.spawn(func)
+        return self.gevent_mod.spawn(func)
 
     def semaphore(self):
         return self.semaphore_class()
 
+    def future(self):
+        return self.future_class()
+
+    def event(self):
+        return self.event_class()
+
     def sleep(self, sec):
         self.gevent_mod.sleep(sec)
+
+    def now(self):
+        return self.time_mod.time()
+
+    def timeout(self, sec):
+        return self.gevent_mod.Timeout(sec, socket.timeout('timed out'))
+
+    def signal(self, signum, func):
+        # gevent.signal was renamed to gevent.signal_handler in gevent 1.5
+        handler = getattr(self.gevent_mod, 'signal_handler', None)
+        if handler is None:
+            handler = self.gevent_mod.signal
+        handler(signum, func)
@@ -0,0 +1,366 @@
+"""
+End-to-end load benchmark. Repeater (with the queue backend chosen by
+--set queue_backend=...) and a sink standing for the remote host are run
+in this process. Requests are sent to Repeater according to a load
+profile and the results are written as JSON:
+
+- ingest_rps - requests accepted by Repeater per second,
+- ingest_latency_ms - percentiles of the time from when a request was
+  scheduled to be sent until Repeater responded (so a slow Repeater
+  doesn't hide its latency by slowing the load down),
+- delivery_lag_ms - percentiles of the time from when a request was
+  scheduled until the sink received it,
+- backlog, drain_s, drain_rps - requests not delivered yet when the load
+  ended (or when the sink came back after the outage) and how fast they
+  were delivered.
+
+Profiles: "steady" (--rate requests per second), "burst" (--burst-size
+requests every --burst-interval seconds, like Jira sends them after bulk
+changes) and "outage" (steady, but the sink is down from --outage-start
+for --outage-length seconds).
+
+The default queue backend is "memory"; Redis backends need Redis running
+(set redis_host/redis_port/redis_db to a disposable database).
+
+$ python -m repeater.helpers.bench_load -p outage -d 20 -o base.json
+$ python -m repeater.helpers.bench_load -p outage -d 20 -o new.json
+$ python -m repeater.helpers.bench_load --compare base.json new.json
+"""
+import argparse
+import httplib
+import json
+import logging
+import socket
+import sys
+import time
+
+import gevent
+import gevent.pool
+import gevent.wsgi
+
+from repeater.application import Repeater
+from repeater.main import (
+    APP_OPTIONS,
+    parse_settings,
+)
+from repeater.registry import bootstrap
+
+# Settings which differ from the defaults of the application, so the
+# benchmark measures Repeater and not the rate limit or backoff.
+BENCH_SETTINGS = {
+    'secret': 'bench',
+    'queue_backend': 'memory',
+    'rate': '0',
+    'backoff_timeout': '1',
+    'backoff_max_timeout': '2',
+}
+
+# (metric, True if higher is better)
+METRICS = [
+    ('ingest_rps', True),
+    ('ingest_latency_ms.p50', False),
+    ('ingest_latency_ms.p95', False),
+    ('ingest_latency_ms.p99', False),
+    ('delivery_lag_ms.p50', False),
+    ('delivery_lag_ms.p95', False),
+    ('delivery_lag_ms.p99', False),
+    ('delivery_lag_ms.max', False),
+    ('drain_rps', True),
+    ('lost', False),
+]
+
+
+def percentiles(values):
+    # Nearest-rank percentiles, in milliseconds
+    if not values:
+        return None
+    values = sorted(values)
+    result = {}
+    for name, rank in [('p50', 50), ('p95', 95), ('p99', 99)]:
+        index = max(int(round(rank / 100. * len(values))) - 1, 0)
+        result[name] = values[index] * 1e3
+    result['max'] = values[-1] * 1e3
+    return result
+
+
+def schedule(args):
+    # Offsets (in seconds from the start) at which requests are sent
+    if args.profile == 'burst':
+        offsets = []
+        start = 0.
+        while start < args.duration:
+            offsets.extend([start] * args.burst_size)
+            start += args.burst_interval
+        return offsets
+    return [
+        i / args.rate for i in xrange(int(args.rate * args.duration))
+    ]
+
+
+class Sink(object):
+    # Remote host, records when each request arrived
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.lags = {}
+        self.duplicates = 0
+
+    def __call__(self, environ, start_response):
+        now = self.clock()
+        environ['wsgi.input'].read()
+        request_id = environ.get('HTTP_X_BENCH_ID')
+        if request_id in self.lags:
+            self.duplicates += 1
+        else:
+            self.lags[request_id] = now - float(
+                environ['HTTP_X_BENCH_SCHEDULED']
+            )
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', '2'),
+        ])
+        return ['OK']
+
+
+class Client(object):
+    # Sends requests to Repeater, keeps connections open between them
+
+    def __init__(self, port, body, clock):
+        self.port = port
+        self.body = body
+        self.clock = clock
+        self.connections = []
+        self.latencies = []
+        self.accepted = 0
+        self.rejected = 0
+        self.last_response = None
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        conn.connect()
+        # Don't wait for delayed ACKs, the client shouldn't slow Repeater
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def send(self, request_id, scheduled):
+        conn = self.connections.pop() if self.connections else None
+        try:
+            if not conn:
+                conn = self.connect()
+            conn.request('POST', '/bench', self.body, {
+                'Content-Type': 'application/json',
+                'X-Bench-Id': str(request_id),
+                'X-Bench-Scheduled': repr(scheduled),
+            })
+            response = conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, IOError):
+            if conn:
+                conn.close()
+            self.rejected += 1
+            return
+        self.connections.append(conn)
+        self.last_response = self.clock()
+        if response.status == 200:
+            self.accepted += 1
+            self.latencies.append(self.last_response - scheduled)
+        else:
+            self.rejected += 1
+
+
+def serve(app, port=0):
+    server = gevent.wsgi.WSGIServer(('127.0.0.1', port), app, log=None)
+    server.start()
+    return server
+
+
+def run(args, overrides, clock=time.time):
+    settings = dict(BENCH_SETTINGS, **overrides)
+    settings = parse_settings(argparse.Namespace(), settings, APP_OPTIONS)
+    registry = bootstrap(settings)
+
+    sink = Sink(clock)
+    sink_servers = [serve(sink)]
+    sink_port = sink_servers[0].address[1]
+    hooks = {
+        'bench': {
+            'src_host': '127.0.0.1',
+            'src_path': '/bench',
+            'dst_host': 'http://127.0.0.1:%d' % sink_port,
+            'dst_path': '/sink',
+        },
+    }
+    repeater_server = serve(Repeater(hooks, registry))
+    client = Client(
+        repeater_server.address[1],
+        json.dumps({'body': 'x' * max(args.body_size - 12, 0)}),
+        clock
+    )
+
+    start = clock()
+    recovered = [start]
+
+    def outage():
+        gevent.sleep(args.outage_start)
+        sink_servers[-1].stop()
+        gevent.sleep(args.outage_length)
+        recovered[0] = clock()
+        sink_servers.append(serve(sink, sink_port))
+
+    if args.profile == 'outage':
+        outage_greenlet = gevent.spawn(outage)
+    pool = gevent.pool.Pool(args.concurrency)
+    for request_id, offset in enumerate(schedule(args)):
+        scheduled = start + offset
+        delay = scheduled - clock()
+        if delay > 0:
+            gevent.sleep(delay)
+        pool.spawn(client.send, request_id, scheduled)
+    pool.join()
+    if args.profile == 'outage':
+        outage_greenlet.join()
+
+    drain_start = max(clock(), recovered[0])
+    delivered = len(sink.lags)
+    backlog = client.accepted - delivered
+    while len(sink.lags) < client.accepted and \
+            clock() - drain_start < args.drain_timeout:
+        gevent.sleep(0.01)
+    drain_s = clock() - drain_start if backlog > 0 else 0.
+    drained = len(sink.lags) - delivered
+
+    repeater_server.stop()
+    for server in sink_servers:
+        server.stop()
+
+    ingest_s = (client.last_response or start) - start
+    return {
+        'profile': args.profile,
+        'settings': overrides,
+        'requests': client.accepted + client.rejected,
+        'accepted': client.accepted,
+        'rejected': client.rejected,
+        'ingest_rps': client.accepted / ingest_s if ingest_s else None,
+        'ingest_latency_ms': percentiles(client.latencies),
+        'delivered': len(sink.lags),
+        'duplicates': sink.duplicates,
+        'lost': client.accepted - len(sink.lags),
+        'delivery_lag_ms': percentiles(sink.lags.values()),
+        'backlog': backlog,
+        'drain_s': drain_s,
+        'drain_rps': drained / drain_s if drain_s else None,
+    }
+
+
+def metric(result, name):
+    for key in name.split('.'):
+        result = (result or {}).get(key)
+    return result
+
+
+def compare(base, new, threshold, stdout):
+    """
+    Write the metrics of both runs and their change. Returns the number
+    of metrics which got worse by more than `threshold` percent.
+    """
+    regressions = 0
+    stdout.write('%-24s %12s %12s %10s\n' % (
+        'metric', 'base', 'new', 'change'
+    ))
+    for name, higher_is_better in METRICS:
+        old_value = metric(base, name)
+        new_value = metric(new, name)
+        if old_value is None or new_value is None:
+            stdout.write('%-24s %12s %12s\n' % (name, old_value, new_value))
+            continue
+        if old_value:
+            change = (new_value - old_value) * 100. / old_value
+        else:
+            change = 0. if not new_value else float('inf')
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold:
+            flag = ' worse'
+            regressions += 1
+        stdout.write('%-24s %12.2f %12.2f %+9.1f%%%s\n' % (
+            name,
+            old_value,
+            new_value,
+            change,
+            flag
+        ))
+    return regressions
+
+
+def parse_overrides(values):
+    overrides = {}
+    for value in values:
+        key, sep, val = value.partition('=')
+        if not sep:
+            raise ValueError('Expected key=value, got %s' % value)
+        overrides[key.strip()] = val.strip()
+    return overrides
+
+
+def main(argv=sys.argv, stdout=sys.stdout):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-p',
+        '--profile',
+        choices=['steady', 'burst', 'outage'],
+        default='steady'
+    )
+    parser.add_argument('-d', '--duration', type=float, default=10.)
+    parser.add_argument('-r', '--rate', type=float, default=200.)
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('-s', '--body-size', type=int, default=2048)
+    parser.add_argument('--burst-size', type=int, default=500)
+    parser.add_argument('--burst-interval', type=float, default=5.)
+    parser.add_argument('--outage-start', type=float, default=None)
+    parser.add_argument('--outage-length', type=float, default=None)
+    parser.add_argument('--drain-timeout', type=float, default=60.)
+    parser.add_argument(
+        '--set',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='Repeater setting (see config.ini), may be repeated'
+    )
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument(
+        '--compare',
+        nargs=2,
+        metavar=('BASE', 'NEW'),
+        help='Compare results of two runs instead of running'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=10.,
+        help='Percent by which a metric may get worse (with --compare)'
+    )
+    args = parser.parse_args(argv[1:])
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        return 1 if compare(base, new, args.threshold, stdout) else 0
+
+    if args.outage_start is None:
+        args.outage_start = args.duration / 4.
+    if args.outage_length is None:
+        args.outage_length = args.duration / 4.
+    logging.basicConfig(level=logging.WARNING)
+    result = run(args, parse_overrides(args.set))
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    stdout.write(output + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""
+Measure how long it takes to find the hook of a request by its path as the
+number of routes grows (see routing.py).
+
+$ python -m repeater.helpers.bench_routes -n 10000 -r 100,1000,10000,50000
+"""
+import argparse
+import random
+import sys
+import timeit
+
+from repeater.routing import RouteTrie
+
+# Route kinds, each one is a third of the routes
+KINDS = [
+    # exact path, the only kind supported before
+    ('exact', '/secret%d/Hogarth Jira/ZADAR', '/secret%d/Hogarth Jira/ZADAR'),
+    # one hook for all projects of a Jira
+    ('template', '/secret%d/{jira}/{project}', '/secret%d/Jira %d/HOG'),
+    # everything under the prefix
+    ('prefix', '/prefix%d/*', '/prefix%d/Hogarth Jira/HOG/1'),
+]
+
+
+def make_routes(count):
+    routes = RouteTrie()
+    for i in xrange(count):
+        name, pattern, _ = KINDS[i % len(KINDS)]
+        routes.add(pattern % i, name)
+    return routes
+
+
+def make_paths(count, number):
+    rand = random.Random(count)
+    paths = {name: [] for name, _, _ in KINDS}
+    for _ in xrange(number):
+        i = rand.randrange(count)
+        name, _, path = KINDS[i % len(KINDS)]
+        paths[name].append(path % ((i, ) * path.count('%d')))
+    return paths
+
+
+def bench(routes, paths):
+    # Returns the best time of looking one path up (in seconds)
+    paths = list(paths)
+    return min(timeit.repeat(
+        lambda: routes.match(paths.pop()),
+        number=1,
+        repeat=len(paths)
+    ))
+
+
+def main(argv=sys.argv, stdout=sys.stdout):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='Lookups of each kind of route')
+    parser.add_argument('-r', '--routes', default='10,100,1000,10000,50000',
+                        help='Comma separated numbers of routes')
+    args = parser.parse_args(argv[1:])
+
+    stdout.write('%-10s' % 'routes')
+    for name, _, _ in KINDS:
+        stdout.write(' %14s' % ('%s [us]' % name))
+    stdout.write('\n')
+    for count in [int(count) for count in args.routes.split(',')]:
+        routes = make_routes(count)
+        paths = make_paths(count, args.number * len(KINDS))
+        stdout.write('%-10d' % count)
+        for name, _, _ in KINDS:
+            if paths[name]:
+                stdout.write(' %14.2f' % (bench(routes, paths[name]) * 1e6))
+            else:
+                stdout.write(' %14s' % '-')
+        stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
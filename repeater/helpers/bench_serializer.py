@@ -0,0 +1,120 @@
+"""
+Compare request serializers: time of dumps/loads and size of an entry.
+
+$ python -m repeater.helpers.bench_serializer -n 10000 -s 4096
+"""
+import argparse
+import json
+import sys
+import timeit
+
+import webob
+
+from repeater.application import RequestSerializer
+from repeater.binary_serializer import BinaryRequestSerializer
+from repeater.compression import (
+    CompressingRequestSerializer,
+    codecs,
+)
+
+
+class Settings(object):
+    # Stands for the registry, CompressingRequestSerializer needs only
+    # settings and the clock (bodies are not spooled, there is no body
+    # store)
+
+    def __init__(self, **settings):
+        self.settings = settings
+
+    def get_body_store(self):
+        return None
+
+    def get_concurrency_utils(self):
+        return self
+
+    def now(self):
+        return timeit.default_timer()
+
+
+def compressing(codec):
+    return lambda: CompressingRequestSerializer(
+        Settings(compression=codec, compression_threshold=0)
+    )
+
+
+SERIALIZERS = [
+    ('pickle', RequestSerializer),
+    ('binary', BinaryRequestSerializer),
+] + [
+    ('binary+%s' % codec, compressing(codec)) for codec in sorted(codecs(6))
+]
+
+
+def make_request(body_size):
+    # Similar to what Jira sends and gevent.pywsgi puts into environ
+    body = json.dumps({
+        'webhookEvent': 'jira:issue_updated',
+        'issue': {'key': 'ZADAR-1', 'fields': {'description': ''}},
+    })
+    body = body.replace('""', '"%s"' % ('x' * max(body_size - len(body), 0)))
+    req = webob.Request.blank(
+        '/super_secret_jira_key/Hogarth Jira/ZADAR',
+        method='POST',
+        headers={
+            'Content-Type': 'application/json; charset=UTF-8',
+            'User-Agent': 'Atlassian HttpClient 0.23.0 / JIRA-6.4.12',
+            'X-Forwarded-For': '10.0.0.1',
+            'X-REPEATER-SIG': '65a415c101d8103bc3866bfe9d5dc818',
+            'Connection': 'close',
+        },
+        remote_addr='127.0.0.1'
+    )
+    req.environ.update({
+        'SERVER_SOFTWARE': 'gevent/1.0 Python/2.7',
+        'GATEWAY_INTERFACE': 'CGI/1.1',
+        'REMOTE_PORT': '51234',
+        'RAW_URI': req.path_qs,
+    })
+    req.body = body
+    return req
+
+
+def bench(serializer_class, request, number):
+    serializer = serializer_class()
+    requests = [request.copy() for _ in xrange(number)]
+    dumps_time = min(timeit.repeat(
+        lambda: serializer.dumps(requests.pop()), number=1, repeat=number
+    ))
+    string = serializer.dumps(request.copy())
+    loads_time = min(timeit.repeat(
+        lambda: serializer.loads(string), number=1, repeat=number
+    ))
+    return {
+        'dumps_us': dumps_time * 1e6,
+        'loads_us': loads_time * 1e6,
+        'bytes': len(string),
+    }
+
+
+def main(argv=sys.argv, stdout=sys.stdout):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=10000)
+    parser.add_argument('-s', '--body-size', type=int, default=2048)
+    args = parser.parse_args(argv[1:])
+
+    request = make_request(args.body_size)
+    stdout.write('%-12s %12s %12s %10s\n' % (
+        'format', 'dumps [us]', 'loads [us]', 'bytes'
+    ))
+    for name, serializer_class in SERIALIZERS:
+        result = bench(serializer_class, request, args.number)
+        stdout.write('%-12s %12.2f %12.2f %10d\n' % (
+            name,
+            result['dumps_us'],
+            result['loads_us'],
+            result['bytes'],
+        ))
+
+
+if __name__ == '__main__':
+    main()
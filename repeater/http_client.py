@@ -0,0 +1,187 @@
+"""
+This module provides WSGI applications which forward requests to remote
+hosts. See interfaces.py for documentation.
+
+PooledProxyApp keeps HTTP/1.1 connections to each remote host open and
+reuses them for consecutive deliveries, so we don't pay for TCP (and TLS)
+handshake on each request.
+"""
+
+import httplib
+import socket
+import urllib
+import urlparse
+
+import wsgiproxy.app
+from zope.interface import implementer
+
+from repeater.interfaces import IProxyConstructor
+from repeater.log import webhook_logger
+
+# See RFC 2616, section 13.5.1
+HOP_BY_HOP = frozenset([
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+])
+
+CONNECTIONS = {
+    'http': httplib.HTTPConnection,
+    'https': httplib.HTTPSConnection,
+}
+
+
+class ConnectionPool(object):
+    # Idle connections to one remote host. Connections are created when
+    # there is no idle one, so the pool never blocks; at most `size`
+    # connections are kept after use, those idle longer than
+    # `idle_timeout` seconds are closed.
+
+    connections = CONNECTIONS  # for tests
+
+    def __init__(self, scheme, netloc, size, idle_timeout, timeout, clock):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.clock = clock
+        self.idle = []
+
+    def get(self):
+        """
+        Returns (connection, reused)
+        """
+        now = self.clock()
+        while self.idle:
+            conn, released = self.idle.pop()
+            if now - released < self.idle_timeout:
+                return conn, True
+            conn.close()
+        return self.connect(), False
+
+    def connect(self):
+        return self.connections[self.scheme](
+            self.netloc,
+            timeout=self.timeout
+        )
+
+    def put(self, conn):
+        if len(self.idle) < self.size:
+            self.idle.append((conn, self.clock()))
+        else:
+            conn.close()
+
+
+class PooledProxyApp(object):
+    # Forwards request to `href` + PATH_INFO using pooled connections.
+    # Connection errors are reported as IOError (see QueueHandler).
+
+    def __init__(self, href, pool):
+        self.path = urlparse.urlsplit(href).path.rstrip('/')
+        self.pool = pool
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = self.path + urllib.quote(environ.get('PATH_INFO', ''))
+        if environ.get('QUERY_STRING'):
+            path = '%s?%s' % (path, environ['QUERY_STRING'])
+        headers = self._request_headers(environ)
+        body = environ.get('wsgi.input')
+        conn, reused = self.pool.get()
+        try:
+            response, content = self._send(conn, method, path, body, headers)
+        except IOError as e:
+            if not reused or isinstance(e, socket.timeout):
+                # After timeout the remote host may be still processing
+                # the request, so we don't send it once again at once.
+                raise
+            # The remote host may have closed idle connection meanwhile,
+            # so try once again with a new one.
+            webhook_logger.debug('Reused connection failed: %s' % e)
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            conn = self.pool.connect()
+            response, content = self._send(conn, method, path, body, headers)
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.put(conn)
+        start_response(
+            '%s %s' % (response.status, response.reason),
+            [
+                (key, value) for key, value in response.getheaders()
+                if key.lower() not in HOP_BY_HOP
+            ]
+        )
+        return [content]
+
+    def _send(self, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            return response, response.read()
+        except socket.timeout:
+            conn.close()
+            raise
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            raise IOError(str(e))
+
+    def _request_headers(self, environ):
+        headers = {}
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                name = key[5:].replace('_', '-').title()
+                if name.lower() not in HOP_BY_HOP:
+                    headers[name] = value
+        # Same forwarding headers as wsgiproxy adds
+        if environ.get('HTTP_HOST'):
+            headers['X-Forwarded-Server'] = environ['HTTP_HOST']
+        if environ.get('wsgi.url_scheme'):
+            headers['X-Forwarded-Scheme'] = environ['wsgi.url_scheme']
+        headers['Host'] = self.pool.netloc
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        headers['Content-Length'] = environ.get('CONTENT_LENGTH') or '0'
+        remote_addr = environ.get('REMOTE_ADDR')
+        forwarded = headers.get('X-Forwarded-For')
+        if remote_addr and forwarded:
+            headers['X-Forwarded-For'] = '%s, %s' % (forwarded, remote_addr)
+        elif remote_addr:
+            headers['X-Forwarded-For'] = remote_addr
+        return headers
+
+
+@implementer(IProxyConstructor)
+class ProxyConstructor(object):
+
+    connection_pool = ConnectionPool
+    pooled_proxy = PooledProxyApp
+    wsgi_proxy = wsgiproxy.app.WSGIProxyApp
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.pools = {}
+
+    def __call__(self, href):
+        settings = self.registry.settings
+        if settings.get('http_client', 'pooled') == 'wsgiproxy':
+            return self.wsgi_proxy(href)
+        url = urlparse.urlsplit(href)
+        key = (url.scheme, url.netloc)
+        if key not in self.pools:
+            self.pools[key] = self.connection_pool(
+                url.scheme,
+                url.netloc,
+                settings.get('http_pool_size', 4),
+                settings.get('http_pool_idle_timeout', 60),
+                settings.get('http_timeout', 30),
+                self.registry.get_concurrency_utils().now
+            )
+        return self.pooled_proxy(href, self.pools[key])
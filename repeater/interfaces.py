@@ -11,7 +11,10 @@
 # interface. Objects provide interfaces that their classes implement.
 
 
-from zope.interface import Interface
+from zope.interface import (
+    Attribute,
+    Interface,
+)
 
 
 class IServerConstructor(Interface):
@@ -43,6 +46,8 @@ class IConcurrencyUtils(Interface):
         Spawn the new thread that will execute given function
 
         func - function to execute in new thread
+
+        Returns the new thread
         """
 
     def semaphore():
@@ -59,6 +64,42 @@ class IConcurrencyUtils(Interface):
         sec - time in seconds (as float) to wait
         """
 
+    def now():
+        """
+        Returns current time in seconds (as float)
+        """
+
+    def future():
+        """
+        Construct new future
+
+        Returns an implementation of IFuture
+        """
+
+    def event():
+        """
+        Construct new event (not set)
+
+        Returns an implementation of IEvent
+        """
+
+    def timeout(sec):
+        """
+        Construct context manager which interrupts its block after given
+        time by raising socket.timeout (IOError) in it
+
+        sec - time in seconds (as float)
+        """
+
+    def signal(signum, func):
+        """
+        Call given function (in new thread) whenever the process receives
+        given signal
+
+        signum - signal number (e.g. signal.SIGHUP)
+        func - function to call without arguments
+        """
+
 
 class ISemaphore(Interface):
 
@@ -73,6 +114,49 @@ class ISemaphore(Interface):
         """
 
 
+class IFuture(Interface):
+
+    def set(value=None):
+        """
+        Set the result and wake up all threads waiting for it.
+        """
+
+    def set_exception(exception):
+        """
+        Set the exception and wake up all threads waiting for the result.
+        """
+
+    def get():
+        """
+        Wait for the result and return it (or raise the exception).
+        """
+
+
+class IEvent(Interface):
+
+    def set():
+        """
+        Set the event and wake up all threads waiting for it.
+        """
+
+    def clear():
+        """
+        Reset the event, so next waits wait again.
+        """
+
+    def is_set():
+        """
+        Returns True if and only if the event is set
+        """
+
+    def wait(sec=None):
+        """
+        Wait until the event is set, but at most `sec` seconds (if given).
+
+        Returns True if the event is set
+        """
+
+
 class IRequestQueueConstructor(Interface):
 
     def __call__(self, name):
@@ -82,6 +166,15 @@ class IRequestQueueConstructor(Interface):
         Returns newly created queue
         """
 
+    def backlog(names):
+        """
+        Find which of the queues with given names may hold requests (e.g.
+        left by the last run) without constructing them, in as few round
+        trips as possible
+
+        Returns set of the names
+        """
+
 
 class IRequestQueue(Interface):
 
@@ -89,11 +182,15 @@ class IRequestQueue(Interface):
     FIFO queue that stores requests
     """
 
-    def append(req):
+    def append(req, replicas=0):
         """
         Add new request to the end of the queue
 
         req - request to append to queue
+        replicas - if not 0, return only when the request is copied to this
+            many replicas of the storage (Redis WAIT); raises IOError if
+            they do not confirm it in time. Storages without replicas
+            ignore it.
         """
 
     def pop():
@@ -111,6 +208,136 @@ class IRequestQueue(Interface):
         Returns True if and only if the queue is not empty
         """
 
+    def __len__():
+        """
+        Returns number of requests in the queue (used by metrics, it may
+        ask the storage)
+        """
+
+    def reload():
+        """
+        Forget requests cached locally (if any), they will be read from
+        the storage again. Called when the queue could have been changed
+        by another process.
+        """
+
+    def flush():
+        """
+        Write changes kept locally (e.g. acknowledgements of popped
+        requests) to the storage. Called before another process may use
+        the queue.
+        """
+
+
+class IRateLimiterConstructor(Interface):
+
+    def __call__(name, rate, burst):
+        """
+        Construct rate limiter for given destination
+
+        name - name of the destination (limiters with the same name may
+               share the budget)
+        rate - allowed number of requests per second (0 means no limit)
+        burst - how many requests may be sent at once
+
+        Returns IRateLimiter provider
+        """
+
+
+class IRateLimiter(Interface):
+
+    def reserve():
+        """
+        Reserve the right to send one request.
+
+        Returns time in seconds (as float) to wait before the request
+        may be sent, 0 if it may be sent immediately
+        """
+
+
+class IProxyConstructor(Interface):
+
+    def __call__(href):
+        """
+        Construct WSGI application which forwards requests to href with
+        PATH_INFO of the request appended. Connection errors are raised
+        as IOError.
+
+        href - scheme, host, port and path prefix of the remote endpoint
+
+        Returns WSGI application
+        """
+
+
+class IProbeConstructor(Interface):
+
+    def __call__(href, spec):
+        """
+        Construct health probe of remote host
+
+        href - URL of the remote host (dst_host)
+        spec - what the probe does (see probe.py)
+
+        Returns IProbe provider or None if `spec` is empty or "off"
+        """
+
+
+class IProbe(Interface):
+
+    def check():
+        """
+        Check the remote host, it should be cheap (e.g. TCP connect).
+
+        Returns True if the host seems to accept requests
+        """
+
+
+class ILeaseConstructor(Interface):
+
+    def __call__(name):
+        """
+        Construct lease of the queue with given name
+
+        Returns ILease provider
+        """
+
+
+class ILease(Interface):
+
+    """
+    Only the process which holds the lease of a queue may deliver requests
+    from it.
+    """
+
+    ttl = Attribute("""
+        Time in seconds after which the lease, if not renewed, may be taken
+        over by another process (None if it never expires)
+    """)
+
+    heartbeat = Attribute("""
+        The lease should be kept (see keep) at least every `heartbeat`
+        seconds (None if it is not needed)
+    """)
+
+    def acquire():
+        """
+        Try to take the lease.
+
+        Returns True if the lease is held now
+        """
+
+    def keep():
+        """
+        Renew the lease, if needed.
+
+        Returns False if the lease was lost
+        """
+
+    def release():
+        """
+        Give up the lease (if it is still held)
+        """
+
 
 class IRequestSerializer(Interface):
 
@@ -131,3 +358,118 @@ class IRequestSerializer(Interface):
 
         Returns string representation of given request
         """
+
+
+class IRequestSigner(Interface):
+
+    def sign(request, digests=None):
+        """
+        Compute signatures of the request (its content type, content length
+        and body) by given digests in a single pass over the body.
+
+        request - request to sign, its body is left at the beginning
+        digests - names of digests (e.g. "sha256"), by default the one
+            given by settings
+
+        Returns dict digest name -> signature
+        """
+
+
+class IBodyStore(Interface):
+
+    """
+    Stores bodies of large requests outside of the queue entries, so they
+    are never kept in memory as a whole.
+    """
+
+    def put(body_file, size, refs=1):
+        """
+        Store `size` bytes read from `body_file`, chunk by chunk. The body
+        is shared by `refs` requests, each of them releases it.
+
+        Returns key of the stored body
+        """
+
+    def open(key, size):
+        """
+        Open the body stored under `key`.
+
+        Returns seekable file-like object reading the body chunk by chunk
+        """
+
+    def release(key):
+        """
+        The request was delivered, its body may be deleted once all
+        requests sharing it released it.
+        """
+
+
+class IMetrics(Interface):
+
+    """
+    Metrics of the application, they are exposed in Prometheus text format.
+    Metrics with the same name are shared, e.g. `counter(name, ...)` called
+    by several queue handlers returns the same counter.
+    """
+
+    def counter(name, doc, labelnames=()):
+        """
+        Returns counter, `counter.labels(*values).inc(amount=1)` counts
+        """
+
+    def histogram(name, doc, labelnames=(), buckets=None):
+        """
+        Returns histogram, `histogram.labels(*values).observe(value)`
+        counts the observed value in its bucket (upper bounds of the
+        buckets are `buckets`, if not given default ones are used)
+        """
+
+    def gauge(name, doc, labelnames, collect):
+        """
+        Add gauge collector, `collect()` is called when metrics are
+        rendered and returns iterable of (label values, value)
+        """
+
+    def render():
+        """
+        Returns metrics in Prometheus text format
+        """
+
+
+class IQueueEditor(Interface):
+
+    """
+    Bulk operations on queued requests (see admin.py). Nothing may be
+    delivered from the edited queues meanwhile, see QueueHandler.edit.
+    """
+
+    def move(source, target, match):
+        """
+        Move requests for which `match(req)` returns True from the end of
+        the queue named `source` to the end of the queue named `target`
+        (if `target` is None, they are deleted). Order of the requests is
+        kept. Requests appended to `source` meanwhile are not moved.
+
+        Returns number of moved requests. Raises QueueBusy if the queue
+        changed otherwise meanwhile (moved requests may stay in `source`
+        as well then).
+        """
+
+
+class IScheduler(Interface):
+
+    """
+    Runs delivery steps of many queue handlers on a bounded pool of
+    workers, instead of a thread/coroutine per remote host (see
+    QueueHandler._step).
+    """
+
+    def schedule(task, delay=0):
+        """
+        Run `task` after `delay` seconds, or sooner if it is already
+        scheduled sooner. If the task is running, it is run again after
+        it returns (at the earliest of both times).
+
+        task - function returning how long (in seconds) to wait before
+            running it again or None when it has nothing to do
+        """
@@ -0,0 +1,136 @@
+"""
+Matching IP addresses (IPv4 and IPv6) against lists of networks.
+
+Networks are compiled into binary tries (one per address family), so
+checking an address costs at most one step per bit of the address,
+no matter how many networks are listed.
+"""
+
+import binascii
+import socket
+
+IPV4_MAPPED_PREFIX = '\x00' * 10 + '\xff\xff'
+
+
+def parse_address(address):
+    """
+    Method converts IPv4 or IPv6 address into (number of bits, integer).
+    IPv4-mapped IPv6 addresses (::ffff:a.b.c.d) are treated as IPv4.
+    Raises ValueError if `address` is not valid.
+    """
+    address = address.strip()
+    try:
+        packed = socket.inet_pton(socket.AF_INET, address)
+    except (socket.error, UnicodeError):
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, address)
+        except (socket.error, UnicodeError):
+            raise ValueError('Invalid IP address: %r' % address)
+        if packed.startswith(IPV4_MAPPED_PREFIX):
+            packed = packed[len(IPV4_MAPPED_PREFIX):]
+    return len(packed) * 8, int(binascii.hexlify(packed), 16)
+
+
+def parse_network(network):
+    """
+    Method converts network ("address" or "address/prefix length")
+    into (number of bits, integer, prefix length).
+    Raises ValueError if `network` is not valid.
+    """
+    address, _, prefix = network.strip().partition('/')
+    bits, value = parse_address(address)
+    if not prefix:
+        return bits, value, bits
+    try:
+        prefix = int(prefix)
+    except ValueError:
+        prefix = -1
+    if not 0 <= prefix <= bits:
+        raise ValueError('Invalid network: %r' % network)
+    return bits, value, prefix
+
+
+class AddressMatcher(object):
+    # Set of networks given as comma separated string, e.g.
+    # "127.0.0.1, 192.168.1.0/24, 2001:db8::/32". Use `address in matcher`
+    # to check whether the address belongs to any of them.
+
+    # Each trie node is a list [child for bit 0, child for bit 1, matches];
+    # `matches` is True when a network ends at the node.
+
+    def __init__(self, networks):
+        self.networks = networks
+        self.tries = {32: [None, None, False], 128: [None, None, False]}
+        self.size = 0
+        for network in networks.split(','):
+            if network.strip():
+                self._add(*parse_network(network))
+                self.size += 1
+
+    def _add(self, bits, value, prefix):
+        node = self.tries[bits]
+        for shift in xrange(bits - 1, bits - 1 - prefix, -1):
+            if node[2]:
+                return  # covered by a wider network already
+            bit = (value >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[:] = [None, None, True]
+
+    def __contains__(self, address):
+        if not address:
+            return False
+        try:
+            bits, value = parse_address(address)
+        except ValueError:
+            return False
+        node = self.tries[bits]
+        shift = bits
+        while not node[2]:
+            if not shift:
+                return False
+            shift -= 1
+            node = node[(value >> shift) & 1]
+            if node is None:
+                return False
+        return True
+
+    def __nonzero__(self):
+        return self.size > 0
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.networks
+
+    def __eq__(self, other):
+        # Hooks are compared on reload, see Repeater.reload
+        if not isinstance(other, AddressMatcher):
+            return NotImplemented
+        return self.networks == other.networks
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def client_address(remote_addr, forwarded_for, trusted_proxies):
+    """
+    Method returns address of the client which sent the request.
+
+    Addresses from X-Forwarded-For header (`forwarded_for`) are checked
+    from the right; each one is accepted only if it was added by one of
+    `trusted_proxies` (AddressMatcher). If no proxies are trusted, the
+    last address from the header is used (if any).
+    """
+    chain = [
+        address.strip() for address in (forwarded_for or '').split(',')
+        if address.strip()
+    ]
+    if not trusted_proxies:
+        return chain[-1] if chain else remote_addr
+    address = remote_addr
+    while chain and address in trusted_proxies:
+        address = chain.pop()
+    return address
@@ -0,0 +1,135 @@
+"""
+This module provides leases which decide which Repeater process delivers
+requests from a queue. See interfaces.py for documentation.
+
+LocalLease is always granted, it is enough when only one Repeater process
+uses the Redis database. RedisLease lets many processes share the queues:
+the lease is a Redis key with expiration time holding the token of its
+owner. The owner renews it while delivering requests; if it stops doing
+so (e.g. the process died) another process takes the lease over after
+`lease_ttl` seconds.
+"""
+
+import os
+import socket
+import uuid
+
+import redis
+from zope.interface import implementer
+
+from repeater.interfaces import (
+    ILease,
+    ILeaseConstructor,
+)
+
+# KEYS[1] - lease key, ARGV[1] - token, ARGV[2] - ttl in milliseconds
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1] - lease key, ARGV[1] - token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+@implementer(ILease)
+class LocalLease(object):
+
+    ttl = None
+    heartbeat = None
+
+    def acquire(self):
+        return True
+
+    def keep(self):
+        return True
+
+    def release(self):
+        pass
+
+
+@implementer(ILease)
+class RedisLease(object):
+
+    def __init__(self, name, ttl, token, redis, scripts, clock):
+        self.key = 'repeater:lease:%s' % name
+        self.ttl = ttl
+        self.heartbeat = ttl / 3.
+        self.token = token
+        self.redis = redis
+        self.renew_script, self.release_script = scripts
+        self.clock = clock
+        self.renewed = None
+
+    def acquire(self):
+        ttl = int(self.ttl * 1000)
+        if self.redis.set(self.key, self.token, px=ttl, nx=True) or \
+                self.renew_script(keys=[self.key], args=[self.token, ttl]):
+            self.renewed = self.clock()
+            return True
+        return False
+
+    def keep(self):
+        if self.renewed is None:
+            return False
+        now = self.clock()
+        if now - self.renewed < self.heartbeat:
+            return True
+        ttl = int(self.ttl * 1000)
+        if self.renew_script(keys=[self.key], args=[self.token, ttl]):
+            self.renewed = now
+            return True
+        self.renewed = None
+        return False
+
+    def release(self):
+        self.renewed = None
+        self.release_script(keys=[self.key], args=[self.token])
+
+
+@implementer(ILeaseConstructor)
+class LeaseConstructor(object):
+
+    local_lease = LocalLease
+    redis_lease = RedisLease
+    redis_mod = redis
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.redis = None
+        self.scripts = None
+        self.token = '%s:%d:%s' % (
+            socket.gethostname(),
+            os.getpid(),
+            uuid.uuid4().hex
+        )
+
+    def __call__(self, name):
+        settings = self.registry.settings
+        if settings.get('lease_backend', 'local') != 'redis':
+            return self.local_lease()
+        if not self.redis:
+            self.redis = self.redis_mod.Redis(
+                host=settings['redis_host'],
+                port=settings['redis_port'],
+                db=settings['redis_db']
+            )
+            self.scripts = (
+                self.redis.register_script(RENEW_SCRIPT),
+                self.redis.register_script(RELEASE_SCRIPT),
+            )
+        return self.redis_lease(
+            name,
+            settings.get('lease_ttl', 10),
+            self.token,
+            self.redis,
+            self.scripts,
+            self.registry.get_concurrency_utils().now
+        )
@@ -1,18 +1,107 @@
 import argparse as argparse
 import ConfigParser as configparser
 import logging.config
+import signal
 import sys
 
 from repeater.application import Repeater as _Repeater
+from repeater.application import (
+    ordering_key,
+    parse_durability,
+)
+from repeater.ip_matcher import AddressMatcher
+from repeater.log import webhook_logger
+from repeater.admin import AdminApp
+from repeater.metrics import MetricsApp
+from repeater.probe import parse_probe
 from repeater.registry import bootstrap as _bootstrap
+from repeater.signing import parse_digest
+from repeater.routing import (
+    RouteConflict,
+    RouteTrie,
+    route_names,
+    template_names,
+)
 
 nodefault = object()
 
+APP_OPTIONS = [
+    ('compression', 'zlib', str),
+    ('compression_threshold', 1024, int),
+    ('compression_level', 6, int),
+    ('max_body_size', 0, int),
+    ('body_spool_threshold', 1024 * 1024, int),
+    ('body_retention', 3600, int),
+    ('redis_host', 'localhost', str),
+    ('redis_port', 6379, int),
+    ('redis_db', 0, int),
+    ('redis_prefetch', 100, int),
+    ('redis_ack_batch', 10, int),
+    ('redis_commit_window', 0, float),
+    ('redis_commit_batch', 100, int),
+    ('redis_inflight', False, bool),
+    ('redis_visibility_timeout', 300, int),
+    ('queue_backend', 'redis', str),
+    ('wal_dir', 'wal', str),
+    ('wal_segment_size', 16 * 1024 * 1024, int),
+    ('wal_fsync_batch', 1, int),
+    ('wal_fsync_interval', 1, float),
+    ('memory_queue_size', 100, int),
+    ('memory_queue_max_age', 1, float),
+    ('memory_queue_max_unsynced', 1000, int),
+    ('backoff_timeout', 60, int),
+    ('backoff_max_timeout', 3600, int),
+    ('backoff_jitter', 0.1, float),
+    ('probe', 'off', str),
+    ('probe_interval', 5, float),
+    ('probe_timeout', 5, float),
+    ('timeout', 1, int),
+    ('rate', None, float),
+    ('burst', 1, int),
+    ('rate_limit_backend', 'local', str),
+    ('http_client', 'pooled', str),
+    ('http_pool_size', 4, int),
+    ('http_pool_idle_timeout', 60, int),
+    ('http_timeout', 30, int),
+    ('lease_backend', 'local', str),
+    ('lease_ttl', 10, int),
+    ('lanes', 1, int),
+    ('startup_stagger', 0.1, float),
+    ('scheduler', 'greenlet', str),
+    ('scheduler_workers', 100, int),
+    ('scheduler_batch', 10, int),
+    ('cut_through', False, bool),
+    ('cut_through_budget', 1, float),
+    ('durability', 'stored', str),
+    ('durability_replicas', 1, int),
+    ('durability_timeout', 1, float),
+    ('ingest_buffer_size', 1000, int),
+    ('trusted_proxies', '', str),
+    ('metrics_path', '', str),
+    ('metrics_port', 0, int),
+    ('admin_port', 0, int),
+    ('admin_host', '127.0.0.1', str),
+    ('admin_token', '', str),
+    ('admin_chunk_size', 1000, int),
+    ('sign_digest', 'md5', str),
+    ('secret', nodefault, str)
+]
+
 
 class ConfigError(Exception):
     pass
 
 
+def parse_bool(option, val):
+    if val in ['1', 'yes', 'on', 'true']:
+        return True
+    elif val in ['0', 'no', 'off', 'false']:
+        return False
+    raise ConfigError(
+        'Expected boolean for option %s; got %s' % (option, val)
+    )
+
+
 def parse_settings(args, config, options):
     settings = {}
     for option, default, _type in options:
@@ -22,17 +111,7 @@ def parse_settings(args, config, options):
         elif option in config:
             val = config[option]
             if _type is bool:
-                if val in ['1', 'yes', 'on', 'true']:
-                    val = True
-                elif val in ['0', 'no', 'off', 'false']:
-                    val = False
-                else:
-                    raise ConfigError(
-                        'Expected boolean for option %s; got %s' % (
-                            option,
-                            val
-                        )
-                    )
+                val = parse_bool(option, val)
             else:
                 try:
                     val = _type(val)
@@ -55,7 +134,7 @@ def parse_settings(args, config, options):
 def parse_hooks(config_parser):
     hook_params = ['src_host', 'src_path', 'dst_host', 'dst_path']
     hooks = {}
-    paths = {}
+    routes = RouteTrie()
     for section in config_parser.sections():
         if section.startswith('hook:'):
             hook = section[5:]
@@ -68,24 +147,134 @@ def parse_hooks(config_parser):
                             param, hook)
                     )
             hook_spec = hooks[hook]
+            try:
+                hook_spec['src_matcher'] = AddressMatcher(
+                    hook_spec['src_host']
+                )
+            except ValueError as e:
+                raise ConfigError('Error: %s for hook "%s"\n' % (e, hook))
+            if hook_spec.get('order_key'):
+                try:
+                    ordering_key(hook_spec['order_key'])
+                except ValueError as e:
+                    raise ConfigError(
+                        'Error: %s for hook "%s"\n' % (e, hook)
+                    )
+            if hook_spec.get('sign_digest'):
+                try:
+                    parse_digest(hook_spec['sign_digest'])
+                except ValueError as e:
+                    raise ConfigError(
+                        'Error: %s for hook "%s"\n' % (e, hook)
+                    )
+            if hook_spec.get('durability'):
+                try:
+                    parse_durability(hook_spec['durability'])
+                except ValueError as e:
+                    raise ConfigError(
+                        'Error: %s for hook "%s"\n' % (e, hook)
+                    )
+            if hook_spec.get('probe'):
+                try:
+                    parse_probe(hook_spec['probe'])
+                except ValueError as e:
+                    raise ConfigError(
+                        'Error: %s for hook "%s"\n' % (e, hook)
+                    )
+            for param, _type in [
+                ('rate', float),
+                ('burst', int),
+                ('durability_replicas', int),
+            ]:
+                if param in hook_spec:
+                    try:
+                        hook_spec[param] = _type(hook_spec[param])
+                    except ValueError:
+                        raise ConfigError(
+                            'Error: expected %s for parameter "%s" of hook '
+                            '"%s"; got %s\n' % (
+                                _type.__name__,
+                                param,
+                                hook,
+                                hook_spec[param]
+                            )
+                        )
             src_path = hook_spec['src_path']
             if not src_path.startswith('/'):
                 src_path = hook_spec['src_path'] = '/%s' % src_path
-            if src_path in paths:
+            if 'fan_out' in hook_spec:
+                hook_spec['fan_out'] = parse_bool(
+                    'fan_out of hook %s' % hook,
+                    hook_spec['fan_out']
+                )
+            try:
+                routes.add(src_path, [hook])
+            except RouteConflict as e:
+                # Hooks with fan_out may share the source path
+                if not fan_out(hook_spec, [hooks[name] for name in e.value]):
+                    raise ConfigError(
+                        'Conflict: source path redefined: %s, %s, %s\n' % (
+                            src_path,
+                            hook,
+                            ', '.join(e.value)
+                        )
+                    )
+                e.value.append(hook)
+            except ValueError as e:
+                raise ConfigError('Error: %s for hook "%s"\n' % (e, hook))
+            missing = set(template_names(hook_spec['dst_path'])) - \
+                set(route_names(src_path))
+            if missing:
                 raise ConfigError(
-                    'Conflict: source path redefined: %s, %s, %s\n' % (
-                        src_path,
-                        hook,
-                        paths[src_path]
+                    'Error: dst_path uses %s not captured by src_path for '
+                    'hook "%s"\n' % (
+                        ', '.join('{%s}' % name for name in sorted(missing)),
+                        hook
                     )
                 )
-            else:
-                paths[src_path] = hook_spec
     if not hooks:
         raise ConfigError('Error: No hooks defined\n')
     return hooks
 
 
+def fan_out(hook_spec, others):
+    # Hooks may share the source path if all of them have fan_out set, the
+    # same path and source hosts, and different remote hosts
+    return all(
+        hook_spec.get('fan_out') and other.get('fan_out') and
+        hook_spec['src_path'] == other['src_path'] and
+        hook_spec['src_host'] == other['src_host'] and
+        hook_spec['dst_host'] != other['dst_host']
+        for other in others
+    )
+
+
+def reloader(path, app, config_parser, parse_hooks):
+    """
+    Returns function which reads hooks from config file again and makes
+    the app use them. It raises ValueError if they are not valid (the app
+    keeps the old ones then).
+    """
+    def reload():
+        parser = config_parser()
+        parser.read([path])
+        try:
+            hooks = parse_hooks(parser)
+        except ConfigError as e:
+            raise ValueError(str(e).strip())
+        app.reload(hooks)
+    return reload
+
+
+def reload_on_signal(reload):
+    def handler():
+        try:
+            reload()
+        except ValueError as e:
+            webhook_logger.error('Hooks not reloaded: %s' % e)
+    return handler
+
+
 def main(
         argv=sys.argv,
         stderr=sys.stderr,
@@ -136,30 +325,62 @@ def main(
             config = {}
         server_cfg = parse_settings(args, config, server_options)
 
-        app_options = [
-            ('redis_host', 'localhost', str),
-            ('redis_port', 6379, int),
-            ('redis_db', 0, int),
-            ('backoff_timeout', 60, int),
-            ('backoff_max_timeout', 3600, int),
-            ('timeout', 1, int),
-            ('secret', nodefault, str)
-        ]
         if parser.has_section('app'):
             config = dict(parser.items('app'))
         else:
             config = {}
-        app_cfg = parse_settings(args, config, app_options)
+        app_cfg = parse_settings(args, config, APP_OPTIONS)
+        try:
+            AddressMatcher(app_cfg['trusted_proxies'])
+        except ValueError as e:
+            raise ConfigError('Error: %s in trusted_proxies' % e)
+        try:
+            parse_probe(app_cfg['probe'])
+        except ValueError as e:
+            raise ConfigError('Error: %s in probe' % e)
+        try:
+            parse_digest(app_cfg['sign_digest'])
+        except ValueError as e:
+            raise ConfigError('Error: %s in sign_digest' % e)
+        try:
+            parse_durability(app_cfg['durability'])
+        except ValueError as e:
+            raise ConfigError('Error: %s in durability' % e)
+        if app_cfg['admin_port'] and not app_cfg['admin_token']:
+            raise ConfigError('Error: admin_token is required by admin_port')
 
         hooks = parse_hooks(parser)
 
         registry = bootstrap(app_cfg)
         app = repeater(hooks, registry)
+        reload = reloader(args.config, app, config_parser, parse_hooks)
+        registry.get_concurrency_utils().signal(
+            signal.SIGHUP,
+            reload_on_signal(reload)
+        )
         server = registry.construct_server(
             app,
             server_cfg['host'],
             server_cfg['port']
         )
+        if app_cfg['metrics_port']:
+            metrics_server = registry.construct_server(
+                MetricsApp(registry.get_metrics()),
+                server_cfg['host'],
+                app_cfg['metrics_port']
+            )
+            registry.get_concurrency_utils().spawn(
+                metrics_server.serve_forever
+            )
+        if app_cfg['admin_port']:
+            admin_server = registry.construct_server(
+                AdminApp(app, registry, reload=reload),
+                app_cfg['admin_host'],
+                app_cfg['admin_port']
+            )
+            registry.get_concurrency_utils().spawn(
+                admin_server.serve_forever
+            )
         server.serve_forever()
     except ConfigError as e:
         stderr.write('%s\n' % str(e))
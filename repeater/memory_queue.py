@@ -0,0 +1,273 @@
+"""
+This module provides queues kept in memory. See interfaces.py for
+documentation.
+
+MemoryQueue keeps requests only in memory, they are lost when the process
+stops. It is meant for tests and benchmarks.
+
+TieredQueue keeps the requests in memory as long as they are delivered
+quickly and spills them to the Redis queue otherwise. The durability
+policy says when they are spilled:
+
+- when there are more than `memory_queue_size` requests in memory for
+  the destination,
+- when the oldest of them waits longer than `memory_queue_max_age`
+  seconds,
+- when the delivery of a request is retried (i.e. the destination is
+  failing),
+- when there are more than `memory_queue_max_unsynced` requests in memory
+  for all destinations together.
+
+The request being delivered stays in memory until the delivery ends
+(or until it is retried, but not if next requests were spilled meanwhile).
+Apart from it, at most `memory_queue_max_unsynced` requests received
+within last `memory_queue_max_age` seconds may be lost if the process
+dies. While there are requests in Redis, new requests are stored in Redis
+as well, so they are delivered in order.
+"""
+
+import collections
+
+from zope.interface import implementer
+
+from repeater.interfaces import (
+    IRequestQueue,
+    IRequestQueueConstructor,
+)
+from repeater.log import webhook_logger
+from repeater.redis_queue import RedisQueueConstructor
+
+
+@implementer(IRequestQueue)
+class MemoryQueue(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = collections.deque()
+        self.head = None
+
+    def append(self, req, replicas=0):
+        self.requests.append(req)
+
+    def pop(self):
+        if self.requests:
+            self.requests.popleft()
+            self.head = None
+
+    def top(self):
+        if not self.requests:
+            raise IndexError('Queue %s is empty' % self.name)
+        if self.head is self.requests[0]:
+            # retry of the same request, its body was already read
+            self.head.body_file_raw.seek(0)
+        self.head = self.requests[0]
+        return self.head
+
+    def __nonzero__(self):
+        return bool(self.requests)
+
+    def __len__(self):
+        return len(self.requests)
+
+    def reload(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+@implementer(IRequestQueueConstructor)
+class MemoryQueueConstructor(object):
+
+    memory_queue = MemoryQueue  # for tests
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.queues = {}
+
+    def __call__(self, name):
+        if name not in self.queues:
+            self.queues[name] = self.memory_queue(name)
+        return self.queues[name]
+
+    def backlog(self, names):
+        # Nothing is left from the last run
+        return set(name for name in names if self.queues.get(name))
+
+
+class Unsynced(object):
+    # Number of requests kept only in memory by all TieredQueues
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+
+    def add(self, count):
+        self.count += count
+
+    def exceeded(self):
+        return self.count > self.limit
+
+
+@implementer(IRequestQueue)
+class TieredQueue(object):
+
+    def __init__(self, name, back, unsynced, size, max_age, clock):
+        self.name = name
+        self.back = back
+        self.unsynced = unsynced
+        self.size = size
+        self.max_age = max_age
+        self.clock = clock
+        self.front = collections.deque()  # (received, request)
+        self.head = None
+        self.spilled = bool(back)
+
+    def append(self, req, replicas=0):
+        if replicas and not self.spilled:
+            # The request must be replicated by Redis, requests received
+            # before it go there first (and those after it, until the Redis
+            # queue is drained)
+            self.spill()
+            self.spilled = True
+        if self.spilled:
+            self.back.append(req, replicas)
+            return
+        self.front.append((self.clock(), req))
+        self.unsynced.add(1)
+        if len(self.front) > self.size or self.unsynced.exceeded():
+            self.spill()
+        else:
+            self.expire()
+
+    def pop(self):
+        if self.front:
+            self.front.popleft()
+            self.unsynced.add(-1)
+            self.head = None
+        else:
+            self.back.pop()
+
+    def top(self):
+        self.expire()
+        if self.front:
+            req = self.front[0][1]
+            if self.head is not req:
+                self.head = req
+                return req
+            if self.spilled:
+                # Next requests were spilled while this one was being
+                # delivered, it has to stay first.
+                req.body_file_raw.seek(0)
+                return req
+            # retry of the same request, the destination is failing
+            self.spill(keep_head=False)
+        return self.back.top()
+
+    def __nonzero__(self):
+        if self.spilled:
+            # when the Redis queue is drained, we may use memory again
+            self.spilled = bool(self.back)
+        return self.spilled or bool(self.front)
+
+    def __len__(self):
+        return len(self.front) + len(self.back)
+
+    def reload(self):
+        self.back.reload()
+
+    def flush(self):
+        self.back.flush()
+
+    def expire(self):
+        if self.front and self.clock() - self.front[0][0] > self.max_age:
+            self.spill()
+
+    def spill(self, keep_head=True):
+        """
+        Move requests from memory to the Redis queue. The first request
+        may be being delivered right now (in another thread/coroutine),
+        so it is left in memory unless `keep_head` is False.
+        """
+        head = None
+        if keep_head and self.front and self.front[0][1] is self.head:
+            head = self.front[0]
+        # Appending to Redis yields, so the head may be popped meanwhile;
+        # the head stays in place and only the spilled entries are removed
+        entries = [entry for entry in self.front if entry is not head]
+        if entries:
+            webhook_logger.info(
+                'Spilling %d requests of %s to Redis' % (
+                    len(entries),
+                    self.name
+                )
+            )
+            self.spilled = True
+        appended = 0
+        try:
+            for _, req in entries:
+                req.body_file_raw.seek(0)
+                self.back.append(req)
+                appended += 1
+        finally:
+            self._remove(entries[:appended])
+        if not head:
+            self.head = None
+
+    def _remove(self, entries):
+        removed = set(id(entry) for entry in entries)
+        kept = [entry for entry in self.front if id(entry) not in removed]
+        self.unsynced.add(len(kept) - len(self.front))
+        self.front.clear()
+        self.front.extend(kept)
+
+
+@implementer(IRequestQueueConstructor)
+class TieredQueueConstructor(object):
+
+    tiered_queue = TieredQueue  # for tests
+    redis_queue_constructor = RedisQueueConstructor
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.back = self.redis_queue_constructor(registry)
+        self.unsynced = Unsynced(
+            registry.settings.get('memory_queue_max_unsynced', 1000)
+        )
+        self.queues = []
+
+    def __call__(self, name):
+        settings = self.registry.settings
+        concurrency = self.registry.get_concurrency_utils()
+        if not self.queues:
+            concurrency.spawn(self._expire)
+        queue = self.tiered_queue(
+            name,
+            self.back(name),
+            self.unsynced,
+            settings.get('memory_queue_size', 100),
+            settings.get('memory_queue_max_age', 1),
+            concurrency.now
+        )
+        self.queues.append(queue)
+        return queue
+
+    def backlog(self, names):
+        # Requests kept in memory are pushed after the handler exists
+        return self.back.backlog(names)
+
+    def _expire(self):
+        # This is executed in separate thread/coroutine
+        # Requests which wait too long are spilled even if nobody touches
+        # their queue (e.g. the delivery hangs).
+        concurrency = self.registry.get_concurrency_utils()
+        interval = self.registry.settings.get('memory_queue_max_age', 1) / 2.
+        while True:
+            concurrency.sleep(interval)
+            for queue in self.queues:
+                try:
+                    queue.expire()
+                except Exception as error:
+                    webhook_logger.exception(
+                        'Spilling %s failed\n%s' % (queue.name, error)
+                    )
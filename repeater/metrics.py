@@ -0,0 +1,216 @@
+"""
+This module provides metrics in Prometheus text format.
+See interfaces.py for documentation.
+
+Counters and histograms are updated in place by the code which counts
+(e.g. `self.delivered.inc()`), without locks: greenlets are not
+preempted between reading and writing a value. Children for the label
+values should be created once (see labels) so counting on hot paths is
+a single addition. Gauges are computed by their collectors when metrics
+are scraped.
+"""
+
+import bisect
+
+import webob
+from zope.interface import implementer
+
+from repeater.interfaces import IMetrics
+from repeater.log import webhook_logger
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300.,
+)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+                '\n', r'\n'
+            )
+        )
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class CounterChild(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class HistogramChild(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric(object):
+
+    kind = None
+    child_class = None
+
+    def __init__(self, name, doc, labelnames):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *values):
+        values = tuple(values)
+        if values not in self.children:
+            self.children[values] = self._child()
+        return self.children[values]
+
+    def _child(self):
+        return self.child_class()
+
+    def samples(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+    child_class = CounterChild
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            yield self.name, format_labels(self.labelnames, values), \
+                child.value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return HistogramChild(self.buckets)
+
+    def samples(self):
+        bounds = self.buckets + (float('inf'), )
+        for values, child in sorted(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, child.counts):
+                cumulative += count
+                yield '%s_bucket' % self.name, format_labels(
+                    self.labelnames,
+                    values,
+                    [('le', format_value(bound))]
+                ), cumulative
+            labels = format_labels(self.labelnames, values)
+            yield '%s_sum' % self.name, labels, child.sum
+            yield '%s_count' % self.name, labels, child.count
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labelnames):
+        super(Gauge, self).__init__(name, doc, labelnames)
+        self.collectors = []
+
+    def samples(self):
+        for collect in self.collectors:
+            try:
+                collected = list(collect())
+            except Exception as error:
+                webhook_logger.warn(
+                    'Collecting %s failed: %s' % (self.name, error)
+                )
+                continue
+            for values, value in collected:
+                yield self.name, format_labels(self.labelnames, values), \
+                    value
+
+
+@implementer(IMetrics)
+class Metrics(object):
+
+    def __init__(self, registry):
+        self.metrics = {}
+
+    def counter(self, name, doc, labelnames=()):
+        return self._metric(Counter, name, doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=None):
+        return self._metric(
+            Histogram,
+            name,
+            doc,
+            labelnames,
+            buckets or DEFAULT_BUCKETS
+        )
+
+    def gauge(self, name, doc, labelnames, collect):
+        gauge = self._metric(Gauge, name, doc, labelnames)
+        gauge.collectors.append(collect)
+        return gauge
+
+    def _metric(self, metric_class, name, doc, labelnames, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(
+                name,
+                doc,
+                labelnames,
+                *args
+            )
+        elif not isinstance(metric, metric_class):
+            raise ValueError('Metric %s is a %s' % (name, metric.kind))
+        return metric
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.doc))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsApp(object):
+    # WSGI application which serves the metrics
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        return self.response()(environ, start_response)
+
+    def response(self):
+        response = webob.Response()
+        response.content_type = CONTENT_TYPE
+        response.body = self.metrics.render()
+        return response
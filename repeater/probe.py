@@ -0,0 +1,130 @@
+"""
+This module provides health probes of remote hosts. See interfaces.py
+for documentation.
+
+While deliveries to a remote host fail, QueueHandler checks the host
+with a probe, which is much cheaper than sending the queued request
+again: it needn't be read from the queue and its body isn't sent.
+The probe is given by spec:
+
+- "tcp" - connect to the host,
+- "head" or "head:<path>" - HEAD request of the path (default "/"),
+- "get:<path>" - GET request of the path (e.g. health check URL).
+
+HTTP probes succeed if the host responds with status lower than 500.
+"""
+
+import httplib
+import socket
+import urlparse
+
+from zope.interface import implementer
+
+from repeater.http_client import CONNECTIONS
+from repeater.interfaces import (
+    IProbe,
+    IProbeConstructor,
+)
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+
+
+def parse_probe(spec):
+    """
+    Method returns (kind, path) of probe given by `spec` or None if
+    the spec is empty or "off". Raises ValueError if it is not valid.
+    """
+    if not spec or spec == 'off':
+        return None
+    kind, _, path = spec.partition(':')
+    if kind == 'tcp' and not path:
+        return kind, None
+    if kind == 'head':
+        return kind, path or '/'
+    if kind == 'get' and path:
+        return kind, path
+    raise ValueError('Unknown probe: %s' % spec)
+
+
+@implementer(IProbe)
+class TCPProbe(object):
+
+    socket_mod = socket  # for tests
+
+    def __init__(self, host, port, timeout):
+        self.address = (host, port)
+        self.timeout = timeout
+
+    def check(self):
+        try:
+            sock = self.socket_mod.create_connection(
+                self.address,
+                self.timeout
+            )
+        except (socket.error, IOError):
+            return False
+        sock.close()
+        return True
+
+
+@implementer(IProbe)
+class HTTPProbe(object):
+
+    connections = CONNECTIONS  # for tests
+
+    def __init__(self, scheme, netloc, method, path, timeout):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.method = method
+        self.path = path
+        self.timeout = timeout
+
+    def check(self):
+        conn = self.connections[self.scheme](
+            self.netloc,
+            timeout=self.timeout
+        )
+        try:
+            conn.request(self.method, self.path, None, {
+                'Host': self.netloc,
+                'Connection': 'close',
+            })
+            return conn.getresponse().status < 500
+        except (httplib.HTTPException, socket.error, IOError):
+            return False
+        finally:
+            conn.close()
+
+
+@implementer(IProbeConstructor)
+class ProbeConstructor(object):
+
+    tcp_probe = TCPProbe
+    http_probe = HTTPProbe
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __call__(self, href, spec):
+        probe = parse_probe(spec)
+        if not probe:
+            return None
+        kind, path = probe
+        url = urlparse.urlsplit(href)
+        timeout = self.registry.settings.get('probe_timeout', 5)
+        if kind == 'tcp':
+            return self.tcp_probe(
+                url.hostname,
+                url.port or DEFAULT_PORTS.get(url.scheme, 80),
+                timeout
+            )
+        return self.http_probe(
+            url.scheme,
+            url.netloc,
+            kind.upper(),
+            path,
+            timeout
+        )
@@ -0,0 +1,109 @@
+"""
+This module provides rate limiters for deliveries to remote hosts.
+See interfaces.py for documentation.
+
+Limiters are token buckets implemented as GCRA (generic cell rate
+algorithm): instead of counting tokens we remember the time at which
+the bucket would be full again (theoretical arrival time, TAT). Each
+reservation moves TAT forward by 1 / rate; the request has to wait until
+TAT is no more than burst / rate ahead of now.
+"""
+
+import redis
+from zope.interface import implementer
+
+from repeater.interfaces import (
+    IRateLimiter,
+    IRateLimiterConstructor,
+)
+
+# KEYS[1] - bucket key, ARGV[1] - interval (1 / rate), ARGV[2] - burst
+# Returns time to wait in microseconds (as Lua numbers are truncated
+# to integers on the way back).
+REDIS_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+tat = tat + interval
+local ttl = math.ceil((tat - now) * 1000)
+redis.call('SET', KEYS[1], string.format('%.6f', tat), 'PX', ttl)
+local wait = tat - now - burst * interval
+if wait < 0 then
+    return 0
+end
+return math.ceil(wait * 1000000)
+"""
+
+
+@implementer(IRateLimiter)
+class UnlimitedRateLimiter(object):
+
+    def reserve(self):
+        return 0
+
+
+@implementer(IRateLimiter)
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, clock):
+        self.interval = 1. / rate
+        self.burst = burst
+        self.clock = clock
+        self.tat = clock()
+
+    def reserve(self):
+        now = self.clock()
+        self.tat = max(self.tat, now) + self.interval
+        wait = self.tat - now - self.burst * self.interval
+        return wait if wait > 0 else 0
+
+
+@implementer(IRateLimiter)
+class RedisTokenBucket(object):
+
+    # Bucket shared by all Repeater processes using the same Redis
+
+    def __init__(self, name, rate, burst, script):
+        self.key = 'repeater:rate:%s' % name
+        self.interval = 1. / rate
+        self.burst = burst
+        self.script = script
+
+    def reserve(self):
+        wait = self.script(keys=[self.key], args=[self.interval, self.burst])
+        return int(wait) / 1e6
+
+
+@implementer(IRateLimiterConstructor)
+class RateLimiterConstructor(object):
+
+    unlimited = UnlimitedRateLimiter
+    token_bucket = TokenBucket
+    redis_token_bucket = RedisTokenBucket
+    redis_mod = redis
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.script = None
+
+    def __call__(self, name, rate, burst):
+        if not rate:
+            return self.unlimited()
+        settings = self.registry.settings
+        if settings.get('rate_limit_backend', 'local') == 'redis':
+            if not self.script:
+                client = self.redis_mod.Redis(
+                    host=settings['redis_host'],
+                    port=settings['redis_port'],
+                    db=settings['redis_db']
+                )
+                self.script = client.register_script(REDIS_SCRIPT)
+            return self.redis_token_bucket(name, rate, burst, self.script)
+        concurrency = self.registry.get_concurrency_utils()
+        return self.token_bucket(rate, burst, concurrency.now)
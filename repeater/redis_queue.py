@@ -3,27 +3,222 @@ This module provides persistance layer for the application.
 See interfaces.py for documentation.
 """
 
+import collections
+
 import redis
 from zope.interface import implementer
 
+from repeater.application import QueueBusy
 from repeater.interfaces import (
+    IQueueEditor,
     IRequestQueue,
     IRequestQueueConstructor,
 )
+from repeater.log import webhook_logger
+
+# Scripts used by ReliableRedisQueue. Its keys are: the queue (list),
+# in-flight deadlines (sorted set of id -> deadline), in-flight requests
+# (hash of id -> request) and the sequence of ids.
+
+# ARGV[1] - visibility timeout in seconds
+# Returns {id, request} or nil if the queue is empty
+CLAIM_SCRIPT = """
+redis.replicate_commands()
+local request = redis.call('LPOP', KEYS[1])
+if not request then
+    return nil
+end
+local time = redis.call('TIME')
+local id = redis.call('INCR', KEYS[4])
+redis.call('HSET', KEYS[3], id, request)
+redis.call('ZADD', KEYS[2], tonumber(time[1]) + tonumber(ARGV[1]), id)
+return {id, request}
+"""
+
+# ARGV[1] - id, ARGV[2] - visibility timeout in seconds
+# Returns 0 if the request is not in-flight anymore
+EXTEND_SCRIPT = """
+redis.replicate_commands()
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+local time = redis.call('TIME')
+redis.call('ZADD', KEYS[2], tonumber(time[1]) + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""
+
+# Puts the in-flight request back at the beginning of the queue
+# ARGV[1] - id
+UNCLAIM_SCRIPT = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+local request = redis.call('HGET', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('LPUSH', KEYS[1], request)
+return 1
+"""
+
+# Puts in-flight requests with expired deadline back at the beginning
+# of the queue (in the order they were claimed).
+# ARGV[1] - maximal number of requests to put back
+SWEEP_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local ids = redis.call(
+    'ZRANGEBYSCORE', KEYS[2], '-inf', time[1], 'LIMIT', 0, ARGV[1]
+)
+table.sort(ids, function(a, b) return tonumber(a) > tonumber(b) end)
+for _, id in ipairs(ids) do
+    local request = redis.call('HGET', KEYS[3], id)
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('HDEL', KEYS[3], id)
+    if request then
+        redis.call('LPUSH', KEYS[1], request)
+    end
+end
+return #ids
+"""
+
+SCRIPTS = {
+    'claim': CLAIM_SCRIPT,
+    'extend': EXTEND_SCRIPT,
+    'unclaim': UNCLAIM_SCRIPT,
+    'sweep': SWEEP_SCRIPT,
+}
+
+# Acknowledges requests popped by PrefetchingRedisQueue: removes first
+# ARGV[1] requests of the queue (KEYS[1]), but only if the last of them
+# is still the last popped request ARGV[2]; it is not when another process
+# delivered and removed them meanwhile (e.g. the lease was lost).
+# Returns 1 if they were removed
+ACK_SCRIPT = """
+local count = tonumber(ARGV[1])
+if redis.call('LINDEX', KEYS[1], count - 1) ~= ARGV[2] then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], count, -1)
+return 1
+"""
+
+# Replaces the queue (KEYS[1]) by its edited copy (KEYS[2]). Requests
+# appended to the queue after the copying started are appended to the
+# copy first. Nothing is replaced if the copied requests moved in the
+# queue meanwhile (e.g. the sweeper of ReliableRedisQueue put requests back
+# at its beginning).
+# ARGV[1] - length of the queue when the copying started
+# ARGV[2], ARGV[3] - the first and the last copied request
+# Returns number of such requests or -1 if the requests moved
+REPLACE_SCRIPT = """
+local size = tonumber(ARGV[1])
+if redis.call('LINDEX', KEYS[1], 0) ~= ARGV[2] or
+        redis.call('LINDEX', KEYS[1], size - 1) ~= ARGV[3] then
+    redis.call('DEL', KEYS[2])
+    return -1
+end
+local appended = redis.call('LRANGE', KEYS[1], size, -1)
+for _, request in ipairs(appended) do
+    redis.call('RPUSH', KEYS[2], request)
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RENAME', KEYS[2], KEYS[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+return #appended
+"""
+
+
+class ReplicationTimeout(IOError):
+    # Not enough replicas confirmed the write in time (see
+    # RedisQueue.append), the request is stored on the master only
+    pass
+
+
+class GroupCommit(object):
+
+    # Appends of concurrent requests are collected for `window` seconds
+    # (or until `max_batch` of them are collected) and written to Redis
+    # in a single pipeline. Each caller waits until its batch is written,
+    # so it responds to the sender only when its request is stored.
+
+    def __init__(self, redis, concurrency, window, max_batch):
+        self.redis = redis
+        self.concurrency = concurrency
+        self.window = window
+        self.max_batch = max_batch
+        self.batch = None
+
+    def rpush(self, name, string):
+        batch = self.batch
+        if batch is None:
+            batch = self.batch = ([], self.concurrency.future())
+            self.concurrency.spawn(lambda: self._flush_later(batch))
+        batch[0].append((name, string))
+        if len(batch[0]) >= self.max_batch:
+            self._flush(batch)
+        batch[1].get()
+
+    def _flush_later(self, batch):
+        # This is executed in separate thread/coroutine
+        self.concurrency.sleep(self.window)
+        self._flush(batch)
+
+    def _flush(self, batch):
+        if self.batch is not batch:
+            return  # already flushed
+        self.batch = None
+        entries, future = batch
+        lists = collections.OrderedDict()
+        for name, string in entries:
+            lists.setdefault(name, []).append(string)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for name, strings in lists.items():
+                pipe.rpush(name, *strings)
+            pipe.execute()
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set()
 
 
 @implementer(IRequestQueue)
 class RedisQueue(object):
 
+    group_commit = None  # see RedisQueueConstructor
+
     def __init__(self, name, redis, registry):
         self.registry = registry
         self.redis = redis
         self.name = name
 
-    def append(self, req):
+    def append(self, req, replicas=0):
         serializer = self.registry.get_request_serializer()
         string = serializer.dumps(req)
-        self.redis.rpush(self.name, string)
+        if replicas:
+            self._replicated_rpush(string, replicas)
+        elif self.group_commit:
+            self.group_commit.rpush(self.name, string)
+        else:
+            self.redis.rpush(self.name, string)
+
+    def _replicated_rpush(self, string, replicas):
+        # WAIT waits for writes of its own connection, so it is sent with
+        # RPUSH in one pipeline (not in group commits of other requests).
+        timeout = self.registry.settings.get('durability_timeout', 1)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush(self.name, string)
+        pipe.execute_command('WAIT', replicas, int(timeout * 1000))
+        acked = pipe.execute()[-1]
+        if acked < replicas:
+            raise ReplicationTimeout(
+                'Request appended to %s confirmed by %d of %d replicas' % (
+                    self.name,
+                    acked,
+                    replicas
+                )
+            )
 
     def pop(self):
         self.redis.lpop(self.name)
@@ -36,23 +231,389 @@ class RedisQueue(object):
     def __nonzero__(self):
         return self.redis.llen(self.name)
 
+    def __len__(self):
+        return self.redis.llen(self.name)
+
+    def reload(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+@implementer(IRequestQueue)
+class PrefetchingRedisQueue(RedisQueue):
+
+    # Queue that reads up to `window` requests in one round trip and keeps
+    # them locally, so QueueHandler can check, read and retry the head
+    # without talking to Redis. Popped requests are acknowledged lazily:
+    # they are removed at once (see ACK_SCRIPT) once `ack_batch` of them
+    # are collected, together with the next window fetch, and by flush()
+    # before the lease of the queue is released.
+    #
+    # It assumes there is only one consumer of the list at a time (see
+    # lease.py), producers may RPUSH concurrently. After a crash or losing
+    # the lease at most `ack_batch` already delivered requests may be
+    # delivered once again.
+
+    def __init__(self, name, redis, registry, window, ack_batch=None):
+        super(PrefetchingRedisQueue, self).__init__(name, redis, registry)
+        self.window = window
+        self.ack_batch = ack_batch or window
+        self.prefetched = collections.deque()
+        self.acked = 0
+        self.last_acked = None
+        self.head = None
+
+    def pop(self):
+        if not self.prefetched:
+            self._fetch()
+        if self.prefetched:
+            self.last_acked = self.prefetched.popleft()
+            self.head = None
+            self.acked += 1
+            if self.acked >= self.ack_batch:
+                self._trim()
+
+    def top(self):
+        if self.head is None:
+            if not self.prefetched:
+                self._fetch()
+            serializer = self.registry.get_request_serializer()
+            self.head = serializer.loads(self.prefetched[0])
+        else:
+            # retry of the same request, its body was already read
+            self.head.body_file_raw.seek(0)
+        return self.head
+
+    def __nonzero__(self):
+        if not self.prefetched:
+            self._fetch()
+        return bool(self.prefetched)
+
+    def __len__(self):
+        # popped requests are still in Redis until they are acknowledged
+        return max(self.redis.llen(self.name) - self.acked, 0)
+
+    def reload(self):
+        # Popped requests are acknowledged first (unless another process
+        # removed them meanwhile), so they are not delivered again
+        self.flush()
+        self.prefetched.clear()
+        self.head = None
+
+    def flush(self):
+        if self.acked:
+            self._trim()
+
+    def _trim(self):
+        self.redis.eval(ACK_SCRIPT, 1, self.name, self.acked, self.last_acked)
+        self.acked = 0
+
+    def _fetch(self):
+        # acknowledge popped requests and read next window at once
+        pipe = self.redis.pipeline(transaction=False)
+        if self.acked:
+            pipe.eval(ACK_SCRIPT, 1, self.name, self.acked, self.last_acked)
+        pipe.lrange(self.name, 0, self.window - 1)
+        result = pipe.execute()
+        self.acked = 0
+        self.head = None
+        self.prefetched.extend(result[-1])
+
+
+@implementer(IRequestQueue)
+class ReliableRedisQueue(RedisQueue):
+
+    # Queue which tracks requests being delivered. top() atomically moves
+    # the first request from the queue to in-flight requests with deadline
+    # `visibility_timeout` seconds from now, pop() acknowledges it. Retries
+    # extend the deadline. Requests which are in-flight past their deadline
+    # (e.g. because the process died) are put back at the beginning of the
+    # queue by sweep(), so only they are delivered again. As each consumer
+    # gets different request, many consumers may share the queue (but then
+    # requests may be delivered out of order).
+
+    def __init__(self, name, redis, registry, scripts, visibility_timeout):
+        super(ReliableRedisQueue, self).__init__(name, redis, registry)
+        self.keys = [
+            name,
+            '%s:inflight' % name,
+            '%s:inflight:requests' % name,
+            '%s:inflight:seq' % name,
+        ]
+        self.scripts = scripts
+        self.visibility_timeout = visibility_timeout
+        self.claimed = None
+
+    def pop(self):
+        # Only a request claimed by top() can be acknowledged, claiming one
+        # here would drop it undelivered
+        if not self.claimed:
+            return
+        request_id, _ = self.claimed
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.keys[1], request_id)
+        pipe.hdel(self.keys[2], request_id)
+        pipe.execute()
+        self.claimed = None
+
+    def top(self):
+        if self.claimed:
+            request_id, req = self.claimed
+            if self.scripts['extend'](
+                keys=self.keys,
+                args=[request_id, self.visibility_timeout]
+            ):
+                # retry of the same request, its body was already read
+                req.body_file_raw.seek(0)
+                return req
+            # we were too slow, the request was put back to the queue
+            self.claimed = None
+        result = self.scripts['claim'](
+            keys=self.keys,
+            args=[self.visibility_timeout]
+        )
+        if result is None:
+            raise IndexError('Queue %s is empty' % self.name)
+        request_id, string = result
+        serializer = self.registry.get_request_serializer()
+        self.claimed = (request_id, serializer.loads(string))
+        return self.claimed[1]
+
+    def __nonzero__(self):
+        return bool(self.claimed) or bool(self.redis.llen(self.name))
+
+    def __len__(self):
+        return int(bool(self.claimed)) + self.redis.llen(self.name)
+
+    def reload(self):
+        if self.claimed:
+            self.scripts['unclaim'](keys=self.keys, args=[self.claimed[0]])
+            self.claimed = None
+
+    def sweep(self, limit=100):
+        return self.scripts['sweep'](keys=self.keys, args=[limit])
+
 
 @implementer(IRequestQueueConstructor)
 class RedisQueueConstructor(object):
 
     redis_queue = RedisQueue
+    prefetching_redis_queue = PrefetchingRedisQueue
+    reliable_redis_queue = ReliableRedisQueue
+    group_commit_class = GroupCommit
     redis_mod = redis
 
     def __init__(self, registry):
         self.registry = registry
         self.redis = None
+        self.group_commit = None
+        self.scripts = None
+        self.reliable_queues = []
 
     def __call__(self, name):
+        self._connect()
+        queue = self._queue(name)
+        queue.group_commit = self.group_commit
+        return queue
+
+    def backlog(self, names):
+        # Lengths of all the queues (and their in-flight requests) are read
+        # in one pipeline
+        self._connect()
+        inflight = self.registry.settings.get('redis_inflight')
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.llen(name)
+            if inflight:
+                pipe.zcard('%s:inflight' % name)
+        counts = iter(pipe.execute())
+        backlog = set()
+        for name in names:
+            count = next(counts)
+            if inflight:
+                count += next(counts)
+            if count:
+                backlog.add(name)
+        return backlog
+
+    def _connect(self):
+        settings = self.registry.settings
         if not self.redis:
-            settings = self.registry.settings
             self.redis = self.redis_mod.Redis(
                 host=settings['redis_host'],
                 port=settings['redis_port'],
                 db=settings['redis_db']
             )
+            if settings.get('redis_commit_window'):
+                self.group_commit = self.group_commit_class(
+                    self.redis,
+                    self.registry.get_concurrency_utils(),
+                    settings['redis_commit_window'],
+                    settings.get('redis_commit_batch', 100)
+                )
+
+    def _queue(self, name):
+        if self.registry.settings.get('redis_inflight'):
+            return self._reliable_queue(name)
+        window = self.registry.settings.get('redis_prefetch', 1)
+        if window > 1:
+            return self.prefetching_redis_queue(
+                name,
+                self.redis,
+                self.registry,
+                window,
+                self.registry.settings.get('redis_ack_batch')
+            )
         return self.redis_queue(name, self.redis, self.registry)
+
+    def _reliable_queue(self, name):
+        if not self.scripts:
+            self.scripts = {
+                key: self.redis.register_script(script)
+                for key, script in SCRIPTS.items()
+            }
+            concurrency = self.registry.get_concurrency_utils()
+            concurrency.spawn(self._sweep)
+        queue = self.reliable_redis_queue(
+            name,
+            self.redis,
+            self.registry,
+            self.scripts,
+            self.registry.settings['redis_visibility_timeout']
+        )
+        self.reliable_queues.append(queue)
+        return queue
+
+    def _sweep(self):
+        # This is executed in separate thread/coroutine
+        concurrency = self.registry.get_concurrency_utils()
+        interval = self.registry.settings['redis_visibility_timeout'] / 2.
+        while True:
+            concurrency.sleep(interval)
+            for queue in self.reliable_queues:
+                try:
+                    count = queue.sweep()
+                    if count:
+                        webhook_logger.warn(
+                            '%d expired in-flight requests put back to %s' % (
+                                count,
+                                queue.name
+                            )
+                        )
+                except Exception as error:
+                    webhook_logger.exception(
+                        'Sweeping %s failed\n%s' % (queue.name, error)
+                    )
+
+
+@implementer(IQueueEditor)
+class RedisQueueEditor(object):
+
+    # The queue is read in chunks of `admin_chunk_size` requests. Requests
+    # which stay are copied to a temporary list, which replaces the queue
+    # at the end (see REPLACE_SCRIPT), so the queue is never left half
+    # edited; moved requests may be moved again if the editing fails.
+    # Writes of each chunk are sent together with reading of the next one
+    # and other threads/coroutines run between chunks, so editing long
+    # queues doesn't block delivery to other hosts nor accepting requests.
+
+    redis_mod = redis
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.chunk_size = registry.settings.get('admin_chunk_size', 1000)
+        self.redis = None
+        self.replace_script = None
+
+    def _redis(self):
+        # Connect lazily, the editor is used only by admin.py
+        if not self.redis:
+            settings = self.registry.settings
+            self.redis = self.redis_mod.Redis(
+                host=settings['redis_host'],
+                port=settings['redis_port'],
+                db=settings['redis_db']
+            )
+            self.replace_script = self.redis.register_script(REPLACE_SCRIPT)
+        return self.redis
+
+    def move(self, source, target, match):
+        redis = self._redis()
+        concurrency = self.registry.get_concurrency_utils()
+        copy = '%s:edited' % source
+        redis.delete(copy)
+        size = redis.llen(source)
+        moved = 0
+        deleted = []
+        start = 0
+        strings = redis.lrange(source, 0, min(self.chunk_size, size) - 1) \
+            if size else []
+        first = last = strings[0] if strings else None
+        while strings:
+            last = strings[-1]
+            start += len(strings)
+            kept, matched, requests = self._split(strings, match)
+            pipe = redis.pipeline(transaction=False)
+            if kept:
+                pipe.rpush(copy, *kept)
+            if matched and target is not None:
+                pipe.rpush(target, *matched)
+            if start < size:
+                pipe.lrange(
+                    source,
+                    start,
+                    min(start + self.chunk_size, size) - 1
+                )
+            result = pipe.execute()
+            if target is None:
+                deleted.extend(self._body_keys(requests))
+            moved += len(matched)
+            strings = result[-1] if start < size else []
+            concurrency.sleep(0)
+        if moved:
+            if self.replace_script(
+                keys=[source, copy],
+                args=[start, first, last]
+            ) < 0:
+                raise QueueBusy('Queue %s changed while it was edited, '
+                                'try again' % source)
+            # Bodies of deleted requests are released only when they are
+            # not in the queue anymore
+            self._release_bodies(deleted)
+        else:
+            redis.delete(copy)
+        return moved
+
+    def _split(self, strings, match):
+        serializer = self.registry.get_request_serializer()
+        kept = []
+        matched = []
+        requests = []
+        for string in strings:
+            try:
+                req = serializer.loads(string)
+            except Exception as error:
+                # such requests can't be delivered either, leave them
+                webhook_logger.warn('Skipping unreadable request: %s' % error)
+                kept.append(string)
+                continue
+            if match(req):
+                matched.append(string)
+                requests.append(req)
+            else:
+                kept.append(string)
+        return kept, matched, requests
+
+    def _body_keys(self, requests):
+        return [
+            req.environ['repeater.body_key'] for req in requests
+            if req.environ.get('repeater.body_key')
+        ]
+
+    def _release_bodies(self, keys):
+        # Bodies of deleted requests are not needed anymore
+        body_store = self.registry.get_body_store()
+        for key in keys:
+            body_store.release(key)
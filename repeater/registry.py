@@ -1,22 +1,61 @@
 from zope.interface.registry import Components
 
-from repeater.application import RequestSerializer as _RequestSerializer
+from repeater.body_store import RedisBodyStore
+from repeater.compression import CompressingRequestSerializer
 from repeater.gevent_concurrency import GEventConcurrencyUtils
 from repeater.gevent_server import GEventServer
+from repeater.http_client import ProxyConstructor as _ProxyConstructor
 from repeater.interfaces import (
+    IBodyStore,
     IConcurrencyUtils,
+    ILeaseConstructor,
+    IMetrics,
+    IProbeConstructor,
+    IProxyConstructor,
+    IQueueEditor,
+    IRateLimiterConstructor,
     IRequestQueueConstructor,
     IRequestSerializer,
+    IRequestSigner,
+    IScheduler,
     IServerConstructor,
 )
-from repeater.redis_queue import RedisQueueConstructor
+from repeater.lease import LeaseConstructor as _LeaseConstructor
+from repeater.memory_queue import (
+    MemoryQueueConstructor as _MemoryQueueConstructor,
+    TieredQueueConstructor as _TieredQueueConstructor,
+)
+from repeater.metrics import Metrics as _Metrics
+from repeater.probe import ProbeConstructor as _ProbeConstructor
+from repeater.rate_limit import (
+    RateLimiterConstructor as _RateLimiterConstructor,
+)
+from repeater.redis_queue import (
+    RedisQueueConstructor,
+    RedisQueueEditor,
+)
+from repeater.scheduler import HeapScheduler
+from repeater.signing import HMACRequestSigner
+from repeater.wal_queue import WALQueueConstructor as _WALQueueConstructor
 
 
 class DefaultComponents(object):
     ConcurrencyUtils = GEventConcurrencyUtils
     ServerConstructor = GEventServer
-    RequestSerializer = _RequestSerializer
+    BodyStore = RedisBodyStore
+    RequestSerializer = CompressingRequestSerializer
+    RequestSigner = HMACRequestSigner
     QueueConstructor = RedisQueueConstructor
+    WALQueueConstructor = _WALQueueConstructor
+    MemoryQueueConstructor = _MemoryQueueConstructor
+    TieredQueueConstructor = _TieredQueueConstructor
+    QueueEditor = RedisQueueEditor
+    RateLimiterConstructor = _RateLimiterConstructor
+    ProxyConstructor = _ProxyConstructor
+    ProbeConstructor = _ProbeConstructor
+    LeaseConstructor = _LeaseConstructor
+    Metrics = _Metrics
+    Scheduler = HeapScheduler
 
 
 class Registry(object):
@@ -33,27 +72,98 @@ class Registry(object):
                 self.default_components.ConcurrencyUtils()
             )
 
+        if not self._components.queryUtility(IMetrics):
+            self._components.registerUtility(
+                self.default_components.Metrics(self)
+            )
+
         if not self._components.queryUtility(IServerConstructor):
             self._components.registerUtility(
                 self.default_components.ServerConstructor
             )
 
+        if not self._components.queryUtility(IBodyStore):
+            self._components.registerUtility(
+                self.default_components.BodyStore(self)
+            )
+
         if not self._components.queryUtility(IRequestSerializer):
             self._components.registerUtility(
-                self.default_components.RequestSerializer()
+                self.default_components.RequestSerializer(self)
+            )
+
+        if not self._components.queryUtility(IRequestSigner):
+            self._components.registerUtility(
+                self.default_components.RequestSigner(self)
             )
 
         if not self._components.queryUtility(IRequestQueueConstructor):
+            queue_constructor = {
+                'wal': self.default_components.WALQueueConstructor,
+                'memory': self.default_components.MemoryQueueConstructor,
+                'tiered': self.default_components.TieredQueueConstructor,
+            }.get(
+                settings.get('queue_backend'),
+                self.default_components.QueueConstructor
+            )
+            self._components.registerUtility(queue_constructor(self))
+
+        # Queues kept in local files or in memory can't be edited
+        if not self._components.queryUtility(IQueueEditor) and \
+                settings.get('queue_backend') not in ('wal', 'memory'):
+            self._components.registerUtility(
+                self.default_components.QueueEditor(self)
+            )
+
+        # Without the scheduler each queue handler delivers in its own
+        # thread/coroutine
+        if not self._components.queryUtility(IScheduler) and \
+                settings.get('scheduler') == 'heap':
             self._components.registerUtility(
-                self.default_components.QueueConstructor(self)
+                self.default_components.Scheduler(self)
+            )
+
+        if not self._components.queryUtility(IRateLimiterConstructor):
+            self._components.registerUtility(
+                self.default_components.RateLimiterConstructor(self)
+            )
+
+        if not self._components.queryUtility(IProxyConstructor):
+            self._components.registerUtility(
+                self.default_components.ProxyConstructor(self)
+            )
+
+        if not self._components.queryUtility(IProbeConstructor):
+            self._components.registerUtility(
+                self.default_components.ProbeConstructor(self)
+            )
+
+        if not self._components.queryUtility(ILeaseConstructor):
+            self._components.registerUtility(
+                self.default_components.LeaseConstructor(self)
             )
 
     def get_concurrency_utils(self):
         return self._components.queryUtility(IConcurrencyUtils)
 
+    def get_metrics(self):
+        return self._components.queryUtility(IMetrics)
+
+    def get_body_store(self):
+        return self._components.queryUtility(IBodyStore)
+
     def get_request_serializer(self):
         return self._components.queryUtility(IRequestSerializer)
 
+    def get_request_signer(self):
+        return self._components.queryUtility(IRequestSigner)
+
+    def get_queue_editor(self):
+        return self._components.queryUtility(IQueueEditor)
+
+    def get_scheduler(self):
+        return self._components.queryUtility(IScheduler)
+
     def construct_server(self, app, host=None, port=None):
         constructor = self._components.queryUtility(IServerConstructor)
         return constructor(app, host, port)
@@ -62,6 +172,26 @@ class Registry(object):
         constructor = self._components.queryUtility(IRequestQueueConstructor)
         return constructor(name)
 
+    def find_backlog(self, names):
+        constructor = self._components.queryUtility(IRequestQueueConstructor)
+        return constructor.backlog(names)
+
+    def construct_rate_limiter(self, name, rate, burst):
+        constructor = self._components.queryUtility(IRateLimiterConstructor)
+        return constructor(name, rate, burst)
+
+    def construct_proxy(self, href):
+        constructor = self._components.queryUtility(IProxyConstructor)
+        return constructor(href)
+
+    def construct_probe(self, href, spec):
+        constructor = self._components.queryUtility(IProbeConstructor)
+        return constructor(href, spec)
+
+    def construct_lease(self, name):
+        constructor = self._components.queryUtility(ILeaseConstructor)
+        return constructor(name)
+
 
 def bootstrap(settings, _components=None):
     return Registry(settings, _components)
@@ -0,0 +1,198 @@
+"""
+Routing of requests to hooks by source path.
+
+Source path of a hook (src_path) is a pattern of "/" separated segments:
+
+- plain segment matches itself,
+- "{name}" matches any non-empty segment, its value is captured,
+- "*" as the last segment matches the rest of the path (one or more
+  segments), so the pattern matches every path with given prefix.
+
+Paths without "{" and "*" match as before, exactly. Captured values may
+be used in dst_path, e.g. src_path = /secret/{project} and
+dst_path = /api/jira/{project}.
+
+Patterns are compiled into a trie of segments, so looking a path up costs
+a step per segment of the path, no matter how many routes there are. The
+most specific route wins: at each segment a plain segment is tried before
+"{name}" and "{name}" before "*". Other ways are tried (backtracking)
+only if the more specific one does not lead to a route.
+"""
+
+import re
+import urllib
+
+PARAM = re.compile(r'^\{([A-Za-z_][A-Za-z0-9_]*)\}$')
+TEMPLATE = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}')
+PREFIX = '*'
+
+
+class RouteConflict(ValueError):
+    # Raised by RouteTrie.add if an equivalent pattern (matching the same
+    # paths) was added already; `value` is the value it was added with.
+
+    def __init__(self, pattern, existing, value):
+        ValueError.__init__(
+            self,
+            'Route %s conflicts with %s' % (pattern, existing)
+        )
+        self.value = value
+
+
+def parse_route(pattern):
+    """
+    Method converts `pattern` into list of its segments; "{name}"
+    segments are converted into (name, ) and "*" is kept as it is.
+    Raises ValueError if the pattern is not valid.
+    """
+    segments = []
+    names = set()
+    parts = pattern.split('/')
+    for i, part in enumerate(parts):
+        param = PARAM.match(part)
+        if param:
+            name = param.group(1)
+            if name in names:
+                raise ValueError('Duplicated {%s} in route %s' % (
+                    name,
+                    pattern
+                ))
+            names.add(name)
+            segments.append((name, ))
+        elif part == PREFIX and i == len(parts) - 1 and i > 0:
+            segments.append(PREFIX)
+        elif '{' in part or '}' in part or PREFIX in part:
+            raise ValueError('Invalid segment %r of route %s' % (
+                part,
+                pattern
+            ))
+        else:
+            segments.append(part)
+    return segments
+
+
+def route_names(pattern):
+    """
+    Method returns names of values captured by `pattern`.
+    """
+    return [
+        segment[0] for segment in parse_route(pattern)
+        if isinstance(segment, tuple)
+    ]
+
+
+def template_names(template):
+    """
+    Method returns names of values used by `template` (e.g. dst_path).
+    """
+    return TEMPLATE.findall(template)
+
+
+def expand(template, values):
+    """
+    Method replaces "{name}" in `template` by quoted values[name].
+    """
+    return TEMPLATE.sub(
+        lambda match: urllib.quote(values[match.group(1)], safe=''),
+        template
+    )
+
+
+class RouteTrie(object):
+    # Maps paths to values by patterns added with add(pattern, value).
+    # get(path) returns the value of the most specific matching route,
+    # match(path) returns (value, captured values) as well.
+
+    # Each trie node is a list [plain segment -> child, child for "{name}",
+    # route ending at the node, route with "*" after the node]; routes are
+    # tuples (pattern, [(segment index, name)], value).
+
+    def __init__(self):
+        self.root = [{}, None, None, None]
+        self.exact = {}  # patterns without "{name}" and "*"
+        self.size = 0
+
+    def add(self, pattern, value):
+        segments = parse_route(pattern)
+        names = [
+            (i, segment[0]) for i, segment in enumerate(segments)
+            if isinstance(segment, tuple)
+        ]
+        node = self.root
+        for segment in segments:
+            if segment == PREFIX:
+                break
+            if isinstance(segment, tuple):
+                if node[1] is None:
+                    node[1] = [{}, None, None, None]
+                node = node[1]
+            else:
+                node = node[0].setdefault(segment, [{}, None, None, None])
+        slot = 3 if segments[-1] == PREFIX else 2
+        if node[slot] is not None:
+            raise RouteConflict(pattern, node[slot][0], node[slot][2])
+        node[slot] = (pattern, names, value)
+        if slot == 2 and not names:
+            self.exact[pattern] = value
+        self.size += 1
+
+    def get(self, path, default=None):
+        if path in self.exact:
+            return self.exact[path]
+        route = self._find(path.split('/'))
+        return route[2] if route else default
+
+    def match(self, path):
+        """
+        Returns (value, captured values) of the route matching `path` or
+        None if there is no such route.
+        """
+        if path in self.exact:
+            return self.exact[path], {}
+        segments = path.split('/')
+        route = self._find(segments)
+        if not route:
+            return None
+        return route[2], {name: segments[i] for i, name in route[1]}
+
+    def _find(self, segments):
+        # Depth-first search, more specific ways first
+        count = len(segments)
+        stack = [(self.root, 0, False)]
+        while stack:
+            node, i, backtracked = stack.pop()
+            if backtracked:
+                if node[3] is not None:
+                    return node[3]
+                continue
+            if i == count:
+                if node[2] is not None:
+                    return node[2]
+                continue
+            stack.append((node, i, True))
+            if node[1] is not None and segments[i]:
+                stack.append((node[1], i + 1, False))
+            child = node[0].get(segments[i])
+            if child is not None:
+                stack.append((child, i + 1, False))
+        return None
+
+    def __len__(self):
+        return self.size
+
+
+class TemplateProxy(object):
+    # WSGI application forwarding requests matching `pattern` to
+    # `template` (URL with "{name}" replaced by values captured from
+    # PATH_INFO, see expand) by proxies constructed by `construct_proxy`
+    # (see IProxyConstructor).
+
+    def __init__(self, pattern, template, construct_proxy):
+        self.routes = RouteTrie()
+        self.routes.add(pattern, template)
+        self.construct_proxy = construct_proxy
+
+    def __call__(self, environ, start_response):
+        template, values = self.routes.match(environ.get('PATH_INFO', ''))
+        proxy = self.construct_proxy(expand(template, values))
+        return proxy(environ, start_response)
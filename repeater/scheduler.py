@@ -0,0 +1,123 @@
+"""
+This module provides the scheduler of deliveries. See interfaces.py for
+documentation.
+
+HeapScheduler keeps a heap of tasks (delivery steps of queue handlers)
+ordered by the time they are due and one coroutine which runs the due
+tasks on at most `scheduler_workers` coroutines at once. So there is no
+sleeping coroutine for each remote host and no more than
+`scheduler_workers` requests are being delivered at once; hosts with
+nothing to deliver are not in the heap at all. Tasks due at the same time
+run in the order they were scheduled, so each host gets its turn.
+"""
+
+import functools
+import heapq
+import itertools
+
+from zope.interface import implementer
+
+from repeater.interfaces import IScheduler
+from repeater.log import webhook_logger
+
+
+@implementer(IScheduler)
+class HeapScheduler(object):
+
+    def __init__(self, registry):
+        self.concurrency = registry.get_concurrency_utils()
+        self.workers = registry.settings.get('scheduler_workers', 100)
+        self.heap = []  # (due, seq, task)
+        self.entries = {}  # task -> (due, seq) of its entry in the heap
+        self.running = {}  # task -> when to run it again (or None)
+        self.counter = itertools.count()
+        self.busy = 0
+        self.runner = None
+        # set when a task is due sooner or a worker is free
+        self.wakeup = self.concurrency.event()
+        metrics = registry.get_metrics()
+        metrics.gauge(
+            'repeater_scheduled_tasks',
+            'Queue handlers waiting for their turn or delivering',
+            (),
+            lambda: [((), len(self.entries) + len(self.running))]
+        )
+        metrics.gauge(
+            'repeater_scheduler_busy_workers',
+            'Workers delivering requests',
+            (),
+            lambda: [((), self.busy)]
+        )
+
+    def schedule(self, task, delay=0):
+        due = self.concurrency.now() + delay
+        if task in self.running:
+            pending = self.running[task]
+            if pending is None or due < pending:
+                self.running[task] = due
+            return
+        self._push(task, due)
+
+    def _push(self, task, due):
+        entry = self.entries.get(task)
+        if entry and entry[0] <= due:
+            return
+        # The former entry stays in the heap, it is skipped when popped
+        seq = next(self.counter)
+        self.entries[task] = (due, seq)
+        heapq.heappush(self.heap, (due, seq, task))
+        if self.heap[0][1] == seq:
+            self.wakeup.set()
+        if not self.runner:
+            self.runner = self.concurrency.spawn(self._run)
+
+    def _run(self):
+        # This is executed in separate thread/coroutine
+        while True:
+            if self.busy >= self.workers:
+                self.wakeup.clear()
+                self.wakeup.wait()
+                continue
+            task = self._pop()
+            if task is None:
+                self.runner = None
+                return
+            if task is not False:
+                self.busy += 1
+                self.running[task] = None
+                self.concurrency.spawn(functools.partial(self._work, task))
+
+    def _pop(self):
+        # Returns the due task, None if the heap is empty or False
+        # if the runner should look again
+        while self.heap:
+            due, seq, task = self.heap[0]
+            if self.entries.get(task, (None, None))[1] != seq:
+                heapq.heappop(self.heap)
+                continue
+            wait = due - self.concurrency.now()
+            if wait > 0:
+                self.wakeup.clear()
+                self.wakeup.wait(wait)
+                return False
+            heapq.heappop(self.heap)
+            del self.entries[task]
+            return task
+        return None
+
+    def _work(self, task):
+        try:
+            delay = task()
+        except Exception as error:
+            webhook_logger.exception('Scheduled task failed with unexcepted '
+                                     'error\n{}'.format(error))
+            delay = None
+        self.busy -= 1
+        self.wakeup.set()
+        pending = self.running.pop(task)
+        if delay is not None:
+            due = self.concurrency.now() + delay
+            if pending is None or due < pending:
+                pending = due
+        if pending is not None:
+            self._push(task, pending)
@@ -0,0 +1,74 @@
+"""
+This module provides signing of forwarded requests. See interfaces.py
+for documentation.
+
+The signature (X-REPEATER-SIG header) is hex HMAC of the content type,
+the content length and the body of the request, keyed by `secret`. The
+digest is given by `sign_digest` setting or by the hook: "md5" (the
+default, for receivers verifying the old signatures), "sha256" or
+"sha512".
+
+The keyed inner and outer state of HMAC is computed once per digest and
+copied for each request. The body is read chunk by chunk, once for all
+digests (requests fanned out to several hooks may need more of them),
+so large bodies are never copied as a whole.
+"""
+
+import hashlib
+import hmac
+
+from zope.interface import implementer
+
+from repeater.body_store import read_chunks
+from repeater.interfaces import IRequestSigner
+
+DIGESTS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+}
+
+HEADER = 'X-REPEATER-SIG'
+
+
+def parse_digest(name):
+    """
+    Method returns hash constructor of digest given by `name`.
+    Raises ValueError if it is not known.
+    """
+    try:
+        return DIGESTS[name]
+    except KeyError:
+        raise ValueError('Unknown digest: %s' % name)
+
+
+@implementer(IRequestSigner)
+class HMACRequestSigner(object):
+
+    def __init__(self, registry):
+        secret = registry.settings['secret']
+        self.default = registry.settings.get('sign_digest', 'md5')
+        self.keyed = {
+            name: hmac.new(secret, digestmod=digestmod)
+            for name, digestmod in DIGESTS.items()
+        }
+
+    def sign(self, request, digests=None):
+        sigs = [
+            (name, self.keyed[name].copy())
+            for name in sorted(set(digests or [self.default]))
+        ]
+        if request.is_body_readable:
+            request.make_body_seekable()  # by purpose to compute length
+        for part in (request.content_type, str(request.content_length)):
+            for _, sig in sigs:
+                sig.update(part)
+        if request.is_body_readable:
+            for chunk in read_chunks(
+                request.body_file,
+                request.content_length
+            ):
+                for _, sig in sigs:
+                    sig.update(chunk)
+            request.body_file_raw.seek(0)
+        return {name: sig.hexdigest() for name, sig in sigs}
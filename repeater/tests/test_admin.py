@@ -0,0 +1,180 @@
+import json
+import unittest
+
+import mock
+import webob
+
+from repeater.admin import AdminApp
+from repeater.application import QueueBusy
+
+
+def handler_mock(host):
+    handler = mock.Mock(host=host)
+    handler.status.return_value = {'destination': host}
+    handler.edit.side_effect = lambda func: func(host)
+    return handler
+
+
+class AdminAppTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {'admin_token': 'token'}
+        self.editor = self.registry.get_queue_editor.return_value
+        self.editor.move.return_value = 3
+        self.repeater = mock.Mock()
+        self.repeater.hooks = {
+            'hook1': {'src_path': '/src_path1', 'dst_host': 'dst_host1'},
+            'hook2': {'src_path': '/src_path2', 'dst_host': 'dst_host2'},
+        }
+        self.handler1 = handler_mock('dst_host1')
+        self.lane1 = handler_mock('dst_host1#1')
+        self.handler2 = handler_mock('dst_host2')
+        destinations = {
+            'dst_host1': [self.handler1, self.lane1],
+            'dst_host2': [self.handler2],
+        }
+        self.repeater.hosts = {
+            'dst_host1': ['hook1'],
+            'dst_host2': ['hook2'],
+        }
+        self.repeater.handlers.side_effect = destinations.get
+        self.repeater.status.side_effect = lambda name: [
+            handler.status() for handler in destinations[name]
+        ]
+        self.app = AdminApp(self.repeater, self.registry)
+
+    def _request(self, path, method='POST', token='token'):
+        req = webob.Request.blank(path, method=method)
+        if token:
+            req.headers['Authorization'] = 'Bearer %s' % token
+        return req.get_response(self.app)
+
+    def _match(self):
+        return self.editor.move.mock_calls[0][1][2]
+
+    def test_unauthorized(self):
+        assert self._request('/pause', token=None).status_code == 401
+        assert self._request('/pause', token='wrong').status_code == 401
+        assert self.handler1.pause.call_count == 0
+
+    def test_destinations(self):
+        response = self._request('/destinations', method='GET')
+        assert response.status_code == 200
+        assert json.loads(response.body) == {'destinations': [
+            {'destination': 'dst_host1'},
+            {'destination': 'dst_host1#1'},
+            {'destination': 'dst_host2'},
+        ]}
+        assert self.repeater.handlers.call_count == 0
+
+    def test_pause_all(self):
+        response = self._request('/pause')
+        assert response.status_code == 200
+        for handler in [self.handler1, self.lane1, self.handler2]:
+            assert handler.pause.call_count == 1
+
+    def test_resume_destination(self):
+        self._request('/resume?destination=dst_host2')
+        assert self.handler2.resume.call_count == 1
+        assert self.handler1.resume.call_count == 0
+
+    def test_drain_hook(self):
+        self._request('/drain?hook=hook1')
+        assert self.handler1.drain.call_count == 1
+        assert self.lane1.drain.call_count == 1
+        assert self.handler2.drain.call_count == 0
+
+    def test_bad_requests(self):
+        for path in [
+            '/pause?destination=unknown',
+            '/pause?hook=unknown',
+            '/pause?hook=hook1&destination=dst_host2',
+            '/move?since=yesterday',
+        ]:
+            assert self._request(path).status_code == 400
+        assert self._request('/unknown').status_code == 404
+        assert self._request('/pause', method='GET').status_code == 405
+
+    def test_move(self):
+        response = self._request('/move?destination=dst_host2')
+        assert json.loads(response.body) == {'destinations': [
+            {'destination': 'dst_host2', 'moved': 3},
+        ]}
+        assert self.editor.move.mock_calls[0][1][:2] == (
+            'dst_host2',
+            'dst_host2:parked'
+        )
+
+    def test_replay(self):
+        response = self._request('/replay?destination=dst_host2')
+        assert json.loads(response.body) == {'destinations': [
+            {'destination': 'dst_host2', 'replayed': 3},
+        ]}
+        assert self.editor.move.mock_calls[0][1][:2] == (
+            'dst_host2:parked',
+            'dst_host2'
+        )
+
+    def test_purge(self):
+        self._request('/purge?destination=dst_host2')
+        self._request('/purge?destination=dst_host2&parked=1')
+        calls = self.editor.move.mock_calls
+        assert calls[0][1][:2] == ('dst_host2', None)
+        assert calls[1][1][:2] == ('dst_host2:parked', None)
+
+    def test_match_hook(self):
+        self._request('/purge?hook=hook1')
+        match = self._match()
+        assert match(mock.Mock(path_info='/src_path1'))
+        assert not match(mock.Mock(path_info='/src_path2'))
+        assert self.editor.move.call_count == 2  # both lanes
+
+    def test_match_time(self):
+        self._request('/purge?since=100&until=200')
+        match = self._match()
+
+        def req(received):
+            return mock.Mock(environ={'repeater.received': received})
+        assert match(req(100.))
+        assert match(req(150.))
+        assert not match(req(200.))
+        assert not match(req(50.))
+        assert not match(mock.Mock(environ={}))
+
+    def test_match_all(self):
+        self._request('/purge')
+        assert self._match()(mock.Mock(environ={}))
+        assert self.editor.move.call_count == 3
+
+    def test_busy(self):
+        self.handler2.edit.side_effect = QueueBusy('busy')
+        response = self._request('/move?destination=dst_host2')
+        assert response.status_code == 409
+
+    def test_not_editable(self):
+        self.registry.get_queue_editor.return_value = None
+        app = AdminApp(self.repeater, self.registry)
+        req = webob.Request.blank('/move', method='POST')
+        req.headers['Authorization'] = 'Bearer token'
+        assert req.get_response(app).status_code == 501
+        assert self.handler1.edit.call_count == 0
+
+    def test_reload(self):
+        reload = mock.Mock()
+        self.app = AdminApp(self.repeater, self.registry, reload=reload)
+        assert self._request('/reload', method='GET').status_code == 405
+        response = self._request('/reload')
+        assert response.status_code == 200
+        assert json.loads(response.body) == {'hooks': ['hook1', 'hook2']}
+        assert reload.call_count == 1
+
+    def test_reload_bad_hooks(self):
+        reload = mock.Mock(side_effect=ValueError('Error: No hooks defined'))
+        self.app = AdminApp(self.repeater, self.registry, reload=reload)
+        response = self._request('/reload')
+        assert response.status_code == 400
+        assert 'No hooks defined' in response.body
+
+    def test_reload_not_available(self):
+        assert self._request('/reload').status_code == 501
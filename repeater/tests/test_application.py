@@ -1,6 +1,7 @@
 """
 Testing file for `application` module of webhook-repeater app.
 """
+import copy
 import cStringIO as stringio
 import pickle
 import unittest
@@ -9,12 +10,24 @@ import webob
 import mock
 
 from repeater.application import (
+    QueueBusy,
     RequestSerializer,
+    PartitionedQueueHandler,
     QueueHandler,
     Repeater,
-    sign_request,
+    ORDER_KEY_PREFIX,
+    json_field,
+    ordering_key,
     check_remote_address,
-    generate_inet_aton
+    hook_matcher,
+)
+from repeater.interfaces import IRequestSerializer
+from repeater.ip_matcher import AddressMatcher
+from repeater.metrics import Metrics
+from repeater.routing import TemplateProxy
+from repeater.rate_limit import (
+    TokenBucket,
+    UnlimitedRateLimiter,
 )
 
 
@@ -36,6 +49,9 @@ class RequestSerializerTestCase(unittest.TestCase):
             "X-REPEATER-BODY": "body"
         })
 
+    def test_implements(self):
+        assert IRequestSerializer.implementedBy(RequestSerializer)
+
     def test_serialize(self):
         string = self.serializer.dumps(self.request)
         assert "key2" in string
@@ -53,11 +69,15 @@ class RequestSerializerTestCase(unittest.TestCase):
 
 
 class QueueMock(object):
+    replicas = 0  # replicas confirming appended requests
+
     def __init__(self, queue=[]):
         self.queue = queue
 
-    def append(self, req):
+    def append(self, req, replicas=0):
         self.queue.append(req)
+        if replicas > self.replicas:
+            raise IOError('Not replicated')
 
     def pop(self):
         self.queue.pop(0)
@@ -68,6 +88,55 @@ class QueueMock(object):
     def __nonzero__(self):
         return bool(self.queue)
 
+    def __len__(self):
+        return len(self.queue)
+
+    def reload(self):
+        pass
+
+    def flush(self):
+        self.flushed = getattr(self, 'flushed', 0) + 1
+
+
+class EventMock(object):
+    # Waiting for the event is sleeping, unless it is set meanwhile
+
+    def __init__(self, sleep):
+        self.sleep = sleep
+        self.flag = False
+
+    def set(self):
+        self.flag = True
+
+    def clear(self):
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def wait(self, sec=None):
+        if not self.flag:
+            self.sleep(sec)
+        return self.flag
+
+
+class LeaseMock(object):
+    def __init__(self, acquire=(), keep=(), ttl=10, heartbeat=None):
+        self.acquire_results = list(acquire)
+        self.keep_results = list(keep)
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.released = 0
+
+    def acquire(self):
+        return self.acquire_results.pop(0) if self.acquire_results else True
+
+    def keep(self):
+        return self.keep_results.pop(0) if self.keep_results else True
+
+    def release(self):
+        self.released += 1
+
 
 class QueueHandlerTestCase(unittest.TestCase):
     def setUp(self):
@@ -75,12 +144,16 @@ class QueueHandlerTestCase(unittest.TestCase):
         self.registry.settings = {
             'backoff_timeout': 1,
             'backoff_max_timeout': 4,
+            'backoff_jitter': 0,
             'timeout': 2
         }
+        self.registry.get_scheduler.return_value = None
 
         self.queue = []
-        queue_mock = QueueMock(self.queue)
-        self.registry.construct_request_queue.return_value = queue_mock
+        self.queue_mock = QueueMock(self.queue)
+        self.registry.construct_request_queue.return_value = self.queue_mock
+        self.lease = LeaseMock()
+        self.registry.construct_lease.return_value = self.lease
         concurrency_utils = self.registry.get_concurrency_utils.return_value
         self.semaphore = concurrency_utils.semaphore.return_value
         self.semaphore.__exit__ = mock.Mock()
@@ -92,16 +165,37 @@ class QueueHandlerTestCase(unittest.TestCase):
             'path1': self.path1_proxy,
             'path2': self.path2_proxy
         }
+        self.rate_limiter = UnlimitedRateLimiter()
+        self.clock = [0.]
+
+        def sleep(sec):
+            self.clock[0] += sec
+        concurrency_utils.sleep.side_effect = sleep
+        concurrency_utils.now.side_effect = lambda: self.clock[0]
+        concurrency_utils.event.side_effect = lambda: EventMock(
+            concurrency_utils.sleep
+        )
+
+    def _handler(self, proxies=None, probe=None):
+        handler = QueueHandler(
+            'name',
+            proxies or self.proxies,
+            self.registry,
+            self.rate_limiter,
+            probe=probe
+        )
+        handler.start()
+        return handler
 
     def test_push(self):
-        handler = QueueHandler('name', self.proxies, self.registry)
+        handler = self._handler()
         request = mock.Mock()
         handler.push(request)
 
         assert self.queue[0] == request
 
     def test_spawn_on_push(self):
-        handler = QueueHandler('name', self.proxies, self.registry)
+        handler = self._handler()
         request = mock.Mock()
         handler.push(request)
 
@@ -109,14 +203,75 @@ class QueueHandlerTestCase(unittest.TestCase):
         assert sem.__enter__.call_count == sem.__exit__.call_count
         assert self.concurrency_utils.spawn.call_count == 1
 
-    def test_spawn_form_constructor(self):
+    def test_push_not_replicated(self):
+        self.semaphore.__exit__.return_value = False  # don't swallow it
+        handler = self._handler()
+        self.queue.append(object())  # not delivered directly
+        request = mock.Mock()
+        with self.assertRaises(IOError):
+            handler.push(request, 1)
+
+        assert self.queue[-1] == request
+        assert self.concurrency_utils.spawn.call_count == 1
+
+    def test_spawn_on_start(self):
         self.queue[:] = [object()]
-        QueueHandler('name', self.proxies, self.registry)
+        handler = QueueHandler(
+            'name',
+            self.proxies,
+            self.registry,
+            self.rate_limiter
+        )
+        assert self.concurrency_utils.spawn.call_count == 0
+        handler.start()
 
         sem = self.semaphore
         assert sem.__enter__.call_count == sem.__exit__.call_count
         assert self.concurrency_utils.spawn.call_count == 1
 
+    def test_start_empty(self):
+        self._handler()
+        assert self.concurrency_utils.spawn.call_count == 0
+
+    def test_reconfigure(self):
+        handler = self._handler()
+        path1_proxy = object()
+        path3_proxy = object()
+        rate_limiter = object()
+        probe = object()
+        labels = self.registry.get_metrics.return_value.counter.return_value \
+            .labels
+        labels.reset_mock()
+        handler.reconfigure(
+            {'path1': path1_proxy, 'path3': path3_proxy},
+            rate_limiter,
+            hooks={'path1': 'hook1', 'path3': 'hook3'},
+            probe=probe
+        )
+        assert handler.proxies == {
+            'path1': path1_proxy,
+            'path2': self.path2_proxy,
+            'path3': path3_proxy,
+        }
+        assert handler.rate_limiter == rate_limiter
+        assert handler.breaker.probe == probe
+        assert sorted(call[1] for call in labels.mock_calls) == [
+            ('hook1', 'name'),
+            ('hook3', 'name'),
+        ]
+        assert sorted(handler.delivered) == ['path1', 'path2', 'path3']
+
+    def test_forwarding_by_route(self):
+        req = mock.Mock()
+        req.path_info = '/secret/ZADAR'
+        self.queue[:] = [req]
+        self._handler(proxies={'/secret/{project}': self.path1_proxy})
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert req.get_response.mock_calls[0][1] == (self.path1_proxy,)
+
     def test_forwarding(self):
         req = mock.Mock()
         req.path_info = 'path1'
@@ -124,7 +279,7 @@ class QueueHandlerTestCase(unittest.TestCase):
         resp.status_code = 200
         req.get_response.return_value = resp
         self.queue[:] = [req]
-        QueueHandler('name', self.proxies, self.registry)
+        self._handler()
 
         worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
         worker()
@@ -142,15 +297,123 @@ class QueueHandlerTestCase(unittest.TestCase):
         req1.get_response.return_value = resp
         req2.get_response.return_value = resp
         self.queue[:] = [req1, req2]
-        QueueHandler('name', self.proxies, self.registry)
+        self._handler()
 
         worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
         worker()
         assert not self.queue
         assert req1.get_response.mock_calls[0][1] == (self.path1_proxy,)
         assert req2.get_response.mock_calls[0][1] == (self.path2_proxy,)
-        assert self.concurrency_utils.sleep.call_count == 1
-        assert self.concurrency_utils.sleep.mock_calls[0][1] == (2,)
+        assert self.concurrency_utils.sleep.call_count == 0
+
+    def test_release_body(self):
+        body_store = self.registry.get_body_store.return_value
+        req1 = mock.Mock(path_info='path1', environ={})
+        req2 = mock.Mock(path_info='path1')
+        req2.environ = {'repeater.body_key': 'key'}
+        req2.get_response.side_effect = [IOError(), mock.Mock()]
+        self.queue[:] = [req1, req2]
+        self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert body_store.release.mock_calls == [mock.call('key')]
+
+    def test_metrics(self):
+        metrics = self.registry.get_metrics.return_value = Metrics(None)
+        req = mock.Mock(path_info='path1')
+        req.environ = {'repeater.received': -2.}
+        req.get_response.side_effect = [IOError(), mock.Mock()]
+        self.queue[:] = [req, mock.Mock(path_info='path2')]
+        handler = QueueHandler(
+            'name',
+            self.proxies,
+            self.registry,
+            self.rate_limiter,
+            hooks={'path1': 'hook1'}
+        )
+        handler.start()
+        assert 'repeater_queue_depth{destination="name"} 2.0' in \
+            metrics.render()
+        backoffs = []
+
+        def sleep(sec):
+            backoffs.append(handler.current_backoff)
+            self.clock[0] += sec
+        self.concurrency_utils.sleep.side_effect = sleep
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert backoffs == [1]
+        lines = metrics.render().split('\n')
+        for line in [
+            'repeater_delivery_attempts_total{destination="name"} 3.0',
+            'repeater_delivery_failures_total{destination="name"} 1.0',
+            'repeater_requests_delivered_total{hook="hook1",'
+            'destination="name"} 1.0',
+            'repeater_requests_delivered_total{hook="",'
+            'destination="name"} 1.0',
+            'repeater_delivery_lag_seconds_sum{destination="name"} 3.0',
+            'repeater_delivery_lag_seconds_count{destination="name"} 1.0',
+            'repeater_delivery_duration_seconds_count{destination="name"} 2.0',
+            'repeater_backoff_seconds{destination="name"} 0.0',
+            'repeater_queue_depth{destination="name"} 0.0',
+            'repeater_queue_oldest_age_seconds{destination="name"} 0.0',
+        ]:
+            assert line in lines
+
+    def test_oldest_age(self):
+        ages = []
+        req = mock.Mock(path_info='path1')
+        req.environ = {'repeater.received': -2.}
+        req.get_response.side_effect = lambda proxy: ages.append(
+            handler._oldest_age()
+        )
+        self.queue[:] = [req]
+        handler = self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert ages == [[(('name', ), 2.)]]
+        assert handler._oldest_age() == [(('name', ), 0)]
+
+    def test_rate_limit(self):
+        """
+        Test waiting between requests as long as rate limiter says.
+        """
+        self.rate_limiter = TokenBucket(0.5, 2, lambda: self.clock[0])
+        reqs = [mock.Mock(path_info='path1') for i in range(4)]
+        self.queue[:] = reqs
+        self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        for req in reqs:
+            assert req.get_response.call_count == 1
+        assert self.concurrency_utils.sleep.mock_calls == [
+            mock.call(2.),
+            mock.call(2.),
+        ]
+
+    def test_rate_limit_with_fail(self):
+        """
+        Test failed attempts count against the rate limit.
+        """
+        self.rate_limiter = TokenBucket(0.5, 1, lambda: self.clock[0])
+        req = mock.Mock(path_info='path1')
+        req.get_response.side_effect = [IOError(), mock.Mock()]
+        self.queue[:] = [req]
+        self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert self.concurrency_utils.sleep.mock_calls == [
+            mock.call(1),  # backoff
+            mock.call(1.),  # rest of 2 seconds between requests
+        ]
 
     def test_forwarding_until_400(self):
         """
@@ -163,7 +426,7 @@ class QueueHandlerTestCase(unittest.TestCase):
         resp1.status_code = 400
         req.get_response.side_effect = [IOError(), IOError(), resp1]
         self.queue[:] = [req]
-        QueueHandler('name', self.proxies, self.registry)
+        self._handler()
 
         worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
         worker()
@@ -190,7 +453,7 @@ class QueueHandlerTestCase(unittest.TestCase):
         req1.get_response.side_effect = [IOError(), resp]
         req2.get_response.return_value = resp
         self.queue[:] = [req1, req2]
-        QueueHandler('name', self.proxies, self.registry)
+        self._handler()
 
         worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
         worker()
@@ -201,8 +464,7 @@ class QueueHandlerTestCase(unittest.TestCase):
         assert req2.get_response.mock_calls[0][1] == (self.path2_proxy,)
         assert req2.get_response.call_count == 1
         assert self.concurrency_utils.sleep.mock_calls[0][1] == (1,)
-        assert self.concurrency_utils.sleep.mock_calls[1][1] == (2,)
-        assert self.concurrency_utils.sleep.call_count == 2
+        assert self.concurrency_utils.sleep.call_count == 1
 
     def test_max_backoff(self):
         req1 = mock.Mock()
@@ -217,7 +479,7 @@ class QueueHandlerTestCase(unittest.TestCase):
             resp
         ]
         self.queue[:] = [req1]
-        QueueHandler('name', self.proxies, self.registry)
+        self._handler()
 
         worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
         worker()
@@ -228,6 +490,153 @@ class QueueHandlerTestCase(unittest.TestCase):
         assert self.concurrency_utils.sleep.mock_calls[3][1] == (4,)
         assert self.concurrency_utils.sleep.call_count == 4
 
+    def test_probe_during_backoff(self):
+        """
+        Test retrying as soon as the probe succeeds. If the retry fails,
+        the next backoff is waited out without probing.
+        """
+        self.registry.settings['probe_interval'] = 1
+        req = mock.Mock(path_info='path1')
+        resp = mock.Mock(status_code=200)
+        req.get_response.side_effect = [IOError(), IOError(), IOError(), resp]
+        self.queue[:] = [req]
+        probe = mock.Mock()
+        probe.check.return_value = True
+        handler = self._handler(probe=probe)
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert self.concurrency_utils.sleep.mock_calls == [
+            mock.call(1),
+            mock.call(1),
+            mock.call(4),
+        ]
+        assert probe.check.call_count == 1
+        assert handler.breaker.state == 'closed'
+
+    def test_probe_failing(self):
+        self.registry.settings['probe_interval'] = 1
+        req = mock.Mock(path_info='path1')
+        resp = mock.Mock(status_code=200)
+        req.get_response.side_effect = [IOError(), IOError(), resp]
+        self.queue[:] = [req]
+        probe = mock.Mock()
+        probe.check.return_value = False
+        self._handler(probe=probe)
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert self.concurrency_utils.sleep.mock_calls == [
+            mock.call(1),
+            mock.call(1),
+            mock.call(1),
+        ]
+        assert probe.check.call_count == 1
+
+    def test_lease_taken(self):
+        """
+        Test waiting for the lease held by another process.
+        """
+        self.lease.acquire_results = [False, False, True]
+        req = mock.Mock(path_info='path1')
+        self.queue[:] = [req]
+        self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert req.get_response.call_count == 1
+        assert self.concurrency_utils.sleep.mock_calls == [
+            mock.call(10),
+            mock.call(10),
+        ]
+        assert self.lease.released == 1
+
+    def test_flush_before_release(self):
+        """
+        Test acknowledgements are written while the lease is held.
+        """
+        released = []
+        self.queue_mock.flush = lambda: released.append(self.lease.released)
+        self.queue[:] = [mock.Mock(path_info='path1')]
+        self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert released == [0]
+        assert self.lease.released == 1
+
+    def test_lease_lost(self):
+        """
+        Test stopping delivery and reloading the queue when the lease
+        was lost.
+        """
+        self.lease.keep_results = [False]
+        self.lease.acquire_results = [True, False, True]
+        self.queue_mock.reload = mock.Mock()
+        reqs = [mock.Mock(path_info='path1') for i in range(3)]
+        self.queue[:] = reqs
+        self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        for req in reqs:
+            assert req.get_response.call_count == 1
+        assert self.concurrency_utils.sleep.mock_calls == [mock.call(10)]
+        assert self.lease.released == 2
+        assert self.queue_mock.reload.call_count == 2
+
+    def test_keep_lease_during_backoff(self):
+        """
+        Test renewing the lease while waiting after failure.
+        """
+        self.lease.heartbeat = 3
+        self.registry.settings['backoff_timeout'] = 10
+        self.registry.settings['backoff_max_timeout'] = 10
+        req = mock.Mock(path_info='path1')
+        req.get_response.side_effect = [IOError(), mock.Mock()]
+        self.queue[:] = [req]
+        self._handler()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert self.concurrency_utils.sleep.mock_calls == [
+            mock.call(3),
+            mock.call(3),
+            mock.call(3),
+            mock.call(1),
+        ]
+
+    def test_lease_lost_during_backoff(self):
+        self.lease.heartbeat = 3
+        self.lease.keep_results = [True, False]
+        self.lease.acquire_results = [True, False]
+        self.registry.settings['backoff_timeout'] = 10
+        self.registry.settings['backoff_max_timeout'] = 10
+        req = mock.Mock(path_info='path1')
+        req.get_response.side_effect = [IOError(), mock.Mock()]
+        self.queue[:] = [req]
+        self._handler()
+        self.concurrency_utils.sleep.side_effect = [
+            None, None, Exception('stop')
+        ]
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert self.queue
+        assert req.get_response.call_count == 1
+        assert self.concurrency_utils.sleep.mock_calls == [
+            mock.call(3),
+            mock.call(3),
+            mock.call(10),  # waiting for the lease
+        ]
+        assert self.lease.released == 1
+
     def test_forwarding_raise_exception(self):
         """
         Test catching exception raised by forward method.
@@ -244,7 +653,7 @@ class QueueHandlerTestCase(unittest.TestCase):
         proxies = {
             'path1': '',
         }
-        QueueHandler('name', proxies, self.registry)
+        self._handler(proxies)
 
         worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
         worker()
@@ -254,6 +663,492 @@ class QueueHandlerTestCase(unittest.TestCase):
         assert len(req2.get_response.mock_calls) == 0
         assert self.concurrency_utils.sleep.mock_calls == []
 
+    def test_pause(self):
+        req = mock.Mock(path_info='path1')
+        self.queue[:] = [req]
+        handler = self._handler()
+        handler.pause()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert self.queue == [req]
+        assert req.get_response.call_count == 0
+        assert handler.handler is None
+        assert handler.idle.is_set()
+        handler.push(mock.Mock(path_info='path1'))
+        assert self.concurrency_utils.spawn.call_count == 1
+
+        handler.resume()
+        assert self.concurrency_utils.spawn.call_count == 2
+        worker = self.concurrency_utils.spawn.mock_calls[1][1][0]
+        worker()
+        assert not self.queue
+
+    def test_pause_during_backoff(self):
+        req = mock.Mock(path_info='path1')
+        req.get_response.side_effect = IOError()
+        self.queue[:] = [req]
+        handler = self._handler()
+        self.concurrency_utils.sleep.side_effect = lambda sec: handler.pause()
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert req.get_response.call_count == 1
+        assert self.concurrency_utils.sleep.mock_calls == [mock.call(1)]
+        assert handler.handler is None
+
+    def test_drain_during_backoff(self):
+        """
+        Test retrying at once and starting the backoff over.
+        """
+        req = mock.Mock(path_info='path1')
+        req.get_response.side_effect = [IOError(), IOError(), IOError(), None]
+        self.queue[:] = [req]
+        handler = self._handler()
+        sleeps = []
+
+        def sleep(sec):
+            sleeps.append(sec)
+            if sec == 2:
+                handler.drain()
+        self.concurrency_utils.sleep.side_effect = sleep
+
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert sleeps == [1, 2, 1]
+
+    def test_edit(self):
+        self.queue_mock.reload = mock.Mock()
+        handler = self._handler()
+        func = mock.Mock()
+        assert handler.edit(func) == func.return_value
+        assert func.mock_calls == [mock.call('name')]
+        assert self.queue_mock.reload.call_count == 1
+        assert self.lease.released == 1
+        assert not handler.paused
+
+    def test_edit_paused(self):
+        handler = self._handler()
+        handler.pause()
+        handler.edit(mock.Mock())
+        assert handler.paused
+
+    def test_edit_lease_taken(self):
+        self.lease.acquire_results = [False]
+        handler = self._handler()
+        func = mock.Mock()
+        with self.assertRaises(QueueBusy):
+            handler.edit(func)
+        assert func.call_count == 0
+        assert not handler.paused
+
+    def test_edit_not_stopped(self):
+        self.queue[:] = [mock.Mock(path_info='path1')]
+        handler = self._handler()
+        func = mock.Mock()
+        with self.assertRaises(QueueBusy):
+            handler.edit(func)
+        assert func.call_count == 0
+        assert self.concurrency_utils.sleep.mock_calls == [mock.call(30)]
+
+
+class CutThroughTestCase(QueueHandlerTestCase):
+    def setUp(self):
+        super(CutThroughTestCase, self).setUp()
+        self.registry.settings['cut_through'] = True
+        self.registry.settings['cut_through_budget'] = 0.5
+        self.timeout = mock.MagicMock()
+        self.concurrency_utils.timeout.return_value = self.timeout
+
+    def test_push(self):
+        """
+        Test request is delivered at once, without storing it.
+        """
+        handler = self._handler()
+        req = mock.Mock(path_info='path1')
+        handler.push(req)
+
+        assert not self.queue
+        assert req.get_response.mock_calls[0][1] == (self.path1_proxy,)
+        assert self.concurrency_utils.timeout.mock_calls[0][1] == (0.5,)
+        assert self.timeout.__enter__.call_count == 1
+        assert self.concurrency_utils.spawn.call_count == 0
+        assert self.lease.released == 1
+
+    def test_push_fanned_out(self):
+        """
+        Test shared body of fanned out requests is released when they are
+        delivered at once.
+        """
+        body_store = self.registry.get_body_store.return_value
+        handlers = [self._handler(), self._handler()]
+        for handler in handlers:
+            req = mock.Mock(path_info='path1')
+            req.environ = {'repeater.body_key': 'key'}
+            handler.push(req)
+
+        assert not self.queue
+        assert body_store.release.mock_calls == [mock.call('key')] * 2
+
+    def test_spawn_on_push(self):
+        handler = self._handler()
+        req = mock.Mock(path_info='path1')
+        req.get_response.side_effect = IOError()
+        handler.push(req)
+
+        assert self.concurrency_utils.spawn.call_count == 1
+
+    def test_failed_delivery(self):
+        """
+        Test request is stored if the delivery fails (or times out) and
+        next requests are stored as well until the handler delivers it.
+        """
+        handler = self._handler()
+        req1 = mock.Mock(path_info='path1')
+        req1.get_response.side_effect = IOError()
+        req2 = mock.Mock(path_info='path2')
+        handler.push(req1)
+        handler.push(req2)
+
+        assert self.queue == [req1, req2]
+        assert req1.body_file_raw.seek.mock_calls == [mock.call(0)]
+        assert req2.get_response.call_count == 0
+
+        req1.get_response.side_effect = None
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        req3 = mock.Mock(path_info='path1')
+        handler.push(req3)
+        assert not self.queue
+        assert req3.get_response.call_count == 1
+
+    def test_queue_not_empty(self):
+        self.queue[:] = [mock.Mock(path_info='path1')]
+        handler = self._handler()
+        handler.handler = None
+        req = mock.Mock(path_info='path1')
+        handler.push(req)
+
+        assert self.queue[1] == req
+        assert req.get_response.call_count == 0
+
+    def test_handler_running(self):
+        handler = self._handler()
+        handler.handler = mock.Mock()
+        req = mock.Mock(path_info='path1')
+        handler.push(req)
+
+        assert self.queue == [req]
+        assert req.get_response.call_count == 0
+        assert self.lease.released == 0
+
+    def test_lease_taken(self):
+        self.lease.acquire_results = [False]
+        handler = self._handler()
+        req = mock.Mock(path_info='path1')
+        handler.push(req)
+
+        assert self.queue == [req]
+        assert req.get_response.call_count == 0
+
+    def test_paused(self):
+        handler = self._handler()
+        handler.pause()
+        req = mock.Mock(path_info='path1')
+        handler.push(req)
+
+        assert self.queue == [req]
+        assert req.get_response.call_count == 0
+        assert self.concurrency_utils.spawn.call_count == 0
+
+    def test_rate_limit(self):
+        self.rate_limiter = TokenBucket(1, 1, lambda: self.clock[0])
+        handler = self._handler()
+        req1 = mock.Mock(path_info='path1')
+        req2 = mock.Mock(path_info='path1')
+        handler.push(req1)
+        handler.push(req2)
+
+        assert self.queue == [req2]
+        assert req1.get_response.call_count == 1
+        assert req2.get_response.call_count == 0
+
+        # The handler uses the token reserved for req2 by the push
+        worker = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        worker()
+        assert not self.queue
+        assert req2.get_response.call_count == 1
+        assert self.concurrency_utils.sleep.mock_calls == [mock.call(1.)]
+        assert self.rate_limiter.tat == 2.
+
+
+class ScheduledQueueHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'backoff_timeout': 1,
+            'backoff_max_timeout': 4,
+            'backoff_jitter': 0,
+            'scheduler_batch': 2,
+        }
+        self.scheduler = self.registry.get_scheduler.return_value
+        self.queue = []
+        self.registry.construct_request_queue.return_value = QueueMock(
+            self.queue
+        )
+        self.lease = LeaseMock()
+        self.registry.construct_lease.return_value = self.lease
+        concurrency_utils = self.registry.get_concurrency_utils.return_value
+        self.semaphore = concurrency_utils.semaphore.return_value
+        self.semaphore.__exit__ = mock.Mock()
+        self.semaphore.__enter__ = mock.Mock()
+        self.concurrency_utils = concurrency_utils
+        self.clock = [0.]
+        concurrency_utils.now.side_effect = lambda: self.clock[0]
+        concurrency_utils.event.side_effect = lambda: EventMock(
+            concurrency_utils.sleep
+        )
+        self.proxy = object()
+        self.rate_limiter = UnlimitedRateLimiter()
+
+    def _handler(self):
+        handler = QueueHandler(
+            'name',
+            {'path1': self.proxy},
+            self.registry,
+            self.rate_limiter
+        )
+        handler.start()
+        return handler
+
+    def _request(self, *responses):
+        req = mock.Mock(path_info='path1')
+        req.get_response.side_effect = list(responses) or [None]
+        return req
+
+    def test_schedule(self):
+        self.queue[:] = [self._request(), self._request()]
+        handler = self._handler()
+        assert self.scheduler.schedule.mock_calls == [
+            mock.call(handler._step)
+        ]
+        assert self.concurrency_utils.spawn.call_count == 0
+        assert handler.status()['delivering']
+        assert handler._step() is None
+        assert not self.queue
+        assert self.lease.released == 1
+        assert handler.handler is None
+        assert handler.idle.is_set()
+
+    def test_batch(self):
+        self.queue[:] = [self._request() for _ in range(3)]
+        handler = self._handler()
+        assert handler._step() == 0
+        assert len(self.queue) == 1
+        assert self.lease.released == 0
+        assert handler._step() is None
+        assert not self.queue
+
+    def test_rate_limit(self):
+        self.rate_limiter = mock.Mock()
+        self.rate_limiter.reserve.side_effect = [0.5, 0]
+        req = self._request()
+        self.queue[:] = [req]
+        handler = self._handler()
+        assert handler._step() == 0.5
+        assert req.get_response.call_count == 0
+        assert handler._step() == 0.5  # woken up too early
+        self.clock[0] = 0.5
+        assert handler._step() is None
+        assert req.get_response.call_count == 1
+        assert self.rate_limiter.reserve.call_count == 1
+
+    def test_backoff(self):
+        req = self._request(IOError(), IOError(), None)
+        self.queue[:] = [req]
+        handler = self._handler()
+        assert handler._step() == 1
+        assert handler.current_backoff == 1
+        self.clock[0] = 1
+        assert handler._step() == 2
+        self.clock[0] = 3
+        assert handler._step() is None
+        assert req.get_response.call_count == 3
+        assert handler.current_backoff == 0
+
+    def test_keep_lease_during_backoff(self):
+        self.registry.settings['backoff_timeout'] = 4
+        self.lease.heartbeat = 1.5
+        self.queue[:] = [self._request(IOError(), None)]
+        handler = self._handler()
+        assert handler._step() == 1.5
+        self.clock[0] = 1.5
+        assert handler._step() == 1.5
+        self.clock[0] = 3
+        assert handler._step() == 1
+        self.clock[0] = 4
+        self.lease.keep_results = [False]
+        assert handler._step() is None
+        assert self.lease.released == 1
+
+    def test_lease_taken(self):
+        self.lease.acquire_results = [False]
+        req = self._request()
+        self.queue[:] = [req]
+        handler = self._handler()
+        assert handler._step() == 10
+        assert req.get_response.call_count == 0
+        assert self.lease.released == 0
+        assert handler._step() is None
+
+    def test_pause_during_backoff(self):
+        req = self._request(IOError(), None)
+        self.queue[:] = [req]
+        handler = self._handler()
+        assert handler._step() == 1
+        handler.pause()
+        assert self.scheduler.schedule.call_count == 2
+        assert handler._step() is None
+        assert self.lease.released == 1
+        assert handler.idle.is_set()
+        self.clock[0] = 1
+        handler.resume()
+        assert self.scheduler.schedule.call_count == 3
+        assert handler._step() is None
+        assert not self.queue
+
+    def test_drain_during_backoff(self):
+        req = self._request(IOError(), None)
+        self.queue[:] = [req]
+        handler = self._handler()
+        assert handler._step() == 1
+        handler.drain()
+        assert self.scheduler.schedule.call_count == 2
+        assert handler._step() is None
+        assert not self.queue
+
+    def test_woken_up_after_stop(self):
+        handler = self._handler()
+        assert handler.handler is None
+        assert handler._step() is None
+        assert self.lease.released == 0
+
+
+class PartitionedQueueHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = object()
+        self.orig_queue_handler = PartitionedQueueHandler.queue_handler
+        self.queue_handler = PartitionedQueueHandler.queue_handler = \
+            mock.Mock(side_effect=lambda *args, **kwargs: mock.Mock(
+                args=args,
+                kwargs=kwargs
+            ))
+        self.proxies = {'path1': object(), 'path2': object()}
+        self.keys = {'path1': lambda request: request.key}
+        self.rate_limiter = object()
+        self.handler = PartitionedQueueHandler(
+            'host',
+            self.proxies,
+            self.keys,
+            4,
+            self.registry,
+            self.rate_limiter
+        )
+
+    def tearDown(self):
+        PartitionedQueueHandler.queue_handler = self.orig_queue_handler
+
+    def _request(self, path_info, key=None):
+        request = mock.Mock()
+        request.path_info = path_info
+        request.key = key
+        return request
+
+    def _lane_of(self, request):
+        self.handler.push(request)
+        lanes = [
+            lane for lane in self.handler.lanes
+            if lane.push.mock_calls and
+            lane.push.mock_calls[-1][1] == (request, 0)
+        ]
+        assert len(lanes) == 1
+        return self.handler.lanes.index(lanes[0])
+
+    def test_lanes_kept(self):
+        lanes = [mock.Mock(), mock.Mock()]
+        handler = PartitionedQueueHandler(
+            'host',
+            self.proxies,
+            self.keys,
+            3,
+            self.registry,
+            self.rate_limiter,
+            handlers=lanes
+        )
+        assert handler.lanes[:2] == lanes
+        assert handler.lanes[2].args[0] == 'host#2'
+        assert self.queue_handler.call_count == 5
+
+    def test_lanes(self):
+        assert self.queue_handler.call_count == 4
+        names = [lane.args[0] for lane in self.handler.lanes]
+        assert names == ['host', 'host#1', 'host#2', 'host#3']
+        for lane in self.handler.lanes:
+            assert lane.args[1:] == (
+                self.proxies,
+                self.registry,
+                self.rate_limiter
+            )
+            assert lane.kwargs == {'hooks': None, 'probe': None}
+
+    def test_same_key_same_lane(self):
+        lane = self._lane_of(self._request('path1', 'ZADAR-1'))
+        for _ in range(3):
+            assert self._lane_of(self._request('path1', 'ZADAR-1')) == lane
+
+    def test_keys_spread_among_lanes(self):
+        lanes = set(
+            self._lane_of(self._request('path1', 'ZADAR-%d' % i))
+            for i in range(100)
+        )
+        assert len(lanes) == 4
+
+    def test_start(self):
+        self.handler.start()
+        for lane in self.handler.lanes:
+            assert lane.start.call_count == 1
+
+    def test_reconfigure(self):
+        keys = {'path2': lambda request: request.key}
+        rate_limiter = object()
+        self.handler.reconfigure(self.proxies, keys, rate_limiter)
+        assert self.handler.keys == keys
+        for lane in self.handler.lanes:
+            assert lane.reconfigure.mock_calls == [mock.call(
+                self.proxies,
+                rate_limiter,
+                hooks=None,
+                probe=None
+            )]
+
+    def test_key_by_route(self):
+        self.handler.reconfigure(
+            self.proxies,
+            {'/secret/{project}': lambda request: request.key},
+            self.rate_limiter
+        )
+        lanes = set(
+            self._lane_of(self._request('/secret/ZADAR', 'ZADAR-%d' % i))
+            for i in range(100)
+        )
+        assert len(lanes) == 4
+
+    def test_no_key(self):
+        assert self._lane_of(self._request('path1')) == 0
+        assert self._lane_of(self._request('path2', 'ZADAR-1')) == 0
+
 
 class RepeaterTestCase(unittest.TestCase):
     def setUp(self):
@@ -268,6 +1163,10 @@ class RepeaterTestCase(unittest.TestCase):
         self.semaphore.__exit__ = mock.Mock()
         self.semaphore.__enter__ = mock.Mock()
         self.concurrency_utils = concurrency_utils
+        self.signer = self.registry.get_request_signer.return_value
+        self.signer.sign.side_effect = lambda request, digests: {
+            digest: '%s-sig' % digest for digest in digests
+        }
         self.hooks = {
             'hook1': {
                 'src_host': '127.0.0.1',
@@ -289,26 +1188,25 @@ class RepeaterTestCase(unittest.TestCase):
             },
         }
         self.orig_queue_handler = Repeater.queue_handler
-        self.orig_proxy = Repeater.proxy
-        self.handlers = [mock.Mock(), mock.Mock()]
+        self.handlers = [mock.Mock(), mock.Mock(), mock.Mock()]
         self.queue_handler = mock.Mock()
         self.queue_handler.side_effect = self._queue_handler_side_effect
-        self.proxy = mock.Mock()
+        self.proxy = self.registry.construct_proxy
         self.proxies = [object(), object(), object()]
         self.proxy.side_effect = self._proxy_side_effect
         Repeater.queue_handler = self.queue_handler
-        Repeater.proxy = self.proxy
         self.repeater = Repeater(self.hooks, self.registry)
 
     def tearDown(self):
         Repeater.queue_handler = self.orig_queue_handler
-        Repeater.proxy = self.orig_proxy
 
-    def _queue_handler_side_effect(self, host, *args):
+    def _queue_handler_side_effect(self, host, *args, **kwargs):
         if host == 'dst_host1':
             return self.handlers[0]
         elif host == 'dst_host3':
             return self.handlers[1]
+        elif host == 'dst_host4':
+            return self.handlers[2]
 
     def _proxy_side_effect(self, host_port):
         if host_port == 'dst_host1/dst_path1':
@@ -328,18 +1226,434 @@ class RepeaterTestCase(unittest.TestCase):
             assert args[1]['/src_path1'] == self.proxies[0]
             assert args[1]['/src_path2'] == self.proxies[1]
         assert args[2] == self.registry
+        assert args[3] == self.registry.construct_rate_limiter.return_value
+
+    def _construct_queues(self, repeater):
+        for host_name in sorted(repeater.hosts):
+            repeater.queue(host_name)
 
     def test_constructor(self):
+        assert self.queue_handler.call_count == 0
+        self._construct_queues(self.repeater)
         assert self.queue_handler.call_count == 2
         args1 = self.queue_handler.mock_calls[0][1]
         self._test_constructor(args1)
         args2 = self.queue_handler.mock_calls[1][1]
         self._test_constructor(args2)
+        assert self.repeater.destinations == {
+            'dst_host1': [self.handlers[0]],
+            'dst_host3': [self.handlers[1]],
+        }
         args = [args[1][0] for args in self.proxy.mock_calls]
         assert len(args) == 3
         assert 'dst_host1/dst_path1' in args
         assert 'dst_host1/dst_path2' in args
         assert 'dst_host3/dst_path3' in args
+        calls = self.registry.construct_rate_limiter.mock_calls
+        assert sorted(call[1] for call in calls) == [
+            ('dst_host1', 0.5, 1),
+            ('dst_host3', 0.5, 1),
+        ]
+
+    def test_rate_from_hooks(self):
+        self.hooks['hook1']['rate'] = 10.
+        self.hooks['hook2']['rate'] = 5.
+        self.hooks['hook2']['burst'] = 3
+        self.hooks['hook3']['rate'] = 0.
+        self.registry.construct_rate_limiter.reset_mock()
+        self._construct_queues(Repeater(self.hooks, self.registry))
+        calls = self.registry.construct_rate_limiter.mock_calls
+        assert sorted(call[1] for call in calls) == [
+            ('dst_host1', 5., 3),
+            ('dst_host3', 0., 1),
+        ]
+
+    def test_probe_from_hooks(self):
+        self.registry.settings['probe'] = 'tcp'
+        self.hooks['hook1']['probe'] = 'get:/health'
+        self.hooks['hook2']['probe'] = 'head'
+        self.registry.construct_probe.reset_mock()
+        self._construct_queues(Repeater(self.hooks, self.registry))
+        calls = self.registry.construct_probe.mock_calls
+        assert sorted(call[1] for call in calls) == [
+            ('dst_host1', 'get:/health'),
+            ('dst_host3', 'tcp'),
+        ]
+        kwargs = [call[2] for call in self.queue_handler.mock_calls]
+        assert kwargs[-1]['probe'] == \
+            self.registry.construct_probe.return_value
+
+    def test_queue(self):
+        assert self.repeater.queue('dst_host3') == self.handlers[1]
+        assert self.repeater.queue('dst_host3') == self.handlers[1]
+        assert self.queue_handler.call_count == 1
+        assert self.repeater.handlers('dst_host3') == [self.handlers[1]]
+        assert self.repeater.handlers('dst_host1') == [self.handlers[0]]
+        assert self.queue_handler.call_count == 2
+
+    def test_status(self):
+        self.handlers[1].status.return_value = {'destination': 'dst_host3'}
+        self.repeater.queue('dst_host3')
+        assert self.repeater.status('dst_host3') == [
+            {'destination': 'dst_host3'},
+        ]
+        assert self.repeater.status('dst_host1') == [{
+            'destination': 'dst_host1',
+            'paused': False,
+            'failing': False,
+            'circuit': 'closed',
+            'backoff': 0,
+            'delivering': False,
+        }]
+        assert self.queue_handler.call_count == 1
+
+    def test_queue_constructed_meanwhile(self):
+        other = mock.Mock()
+
+        def wait():
+            # another coroutine constructed it while this one waited
+            self.repeater.queues['dst_host3'] = other
+        self.semaphore.__enter__.side_effect = wait
+        assert self.repeater.queue('dst_host3') == other
+        assert self.queue_handler.call_count == 0
+
+    def test_start_backlog(self):
+        self.registry.find_backlog.return_value = set([
+            'dst_host1',
+            'dst_host3',
+        ])
+        start_backlog = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        start_backlog()
+        assert self.registry.find_backlog.mock_calls[0][1] == (
+            ['dst_host1', 'dst_host3'],
+        )
+        assert self.handlers[0].start.call_count == 1
+        assert self.handlers[1].start.call_count == 1
+        assert self.concurrency_utils.sleep.mock_calls == [mock.call(0.1)]
+
+    def test_start_backlog_lanes(self):
+        self.registry.settings['lanes'] = 3
+        self.registry.settings['startup_stagger'] = 0
+        self.hooks['hook1']['order_key'] = 'header:X-Key'
+        self.concurrency_utils.spawn.reset_mock()
+        repeater = Repeater(self.hooks, self.registry)
+        partitioned = mock.Mock()
+        repeater.partitioned_queue_handler = partitioned
+        self.registry.find_backlog.return_value = set(['dst_host1#2'])
+        start_backlog = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        start_backlog()
+        assert self.registry.find_backlog.mock_calls[0][1] == (
+            ['dst_host1', 'dst_host1#1', 'dst_host1#2', 'dst_host3'],
+        )
+        assert partitioned.return_value.start.call_count == 1
+        assert self.queue_handler.call_count == 0
+        assert self.concurrency_utils.sleep.call_count == 0
+
+    def _reload(self, **changes):
+        hooks = copy.deepcopy(self.hooks)
+        for hook_name, spec in changes.items():
+            if spec is None:
+                del hooks[hook_name]
+            else:
+                hooks[hook_name] = dict(hooks.get(hook_name, {}), **spec)
+        self.repeater.reload(hooks)
+        return hooks
+
+    def test_template_routes(self):
+        self.hooks['hook3']['src_path'] = '/secret/{project}'
+        self.hooks['hook3']['dst_path'] = '/api/{project}'
+        self.hooks['hook4'] = {
+            'src_host': '127.0.0.1',
+            'src_path': '/secret/*',
+            'dst_host': 'dst_host1',
+            'dst_path': '/dst_path4',
+        }
+        repeater = Repeater(self.hooks, self.registry)
+        assert isinstance(repeater.proxies['hook3'][1], TemplateProxy)
+
+        req = webob.Request.blank('/secret/ZADAR')
+        req.remote_addr = '192.168.1.100'
+        req.get_response(repeater)
+        assert self.handlers[1].push.mock_calls[0][1][0].path_info == \
+            '/secret/ZADAR'
+        args = self.queue_handler.mock_calls[0][1]
+        assert list(args[1]) == ['/secret/{project}']
+
+        req = webob.Request.blank('/secret/ZADAR/1')
+        req.remote_addr = '127.0.0.1'
+        req.get_response(repeater)
+        assert self.handlers[0].push.call_count == 1
+
+    def test_fan_out(self):
+        self.hooks['hook2']['src_path'] = '/src_path3'
+        self.hooks['hook2']['fan_out'] = True
+        self.hooks['hook3']['fan_out'] = True
+        repeater = Repeater(self.hooks, self.registry)
+        body_store = self.registry.get_body_store.return_value
+        body_store.open.side_effect = lambda key, size: stringio.StringIO(
+            'body'
+        )
+        req = webob.Request.blank('/src_path3', method='POST')
+        req.remote_addr = '192.168.1.100'
+        req.body = 'body'
+        assert req.get_response(repeater).status_code == 200
+        assert body_store.put.call_count == 1
+        assert body_store.put.mock_calls[0][1][1:] == (4, 2)
+        key = body_store.put.return_value
+        for handler in self.handlers[:2]:
+            assert handler.push.call_count == 1
+            req_copy = handler.push.mock_calls[0][1][0]
+            assert req_copy.path_info == '/src_path3'
+            assert req_copy.environ['repeater.body_key'] == key
+            assert req_copy.body == 'body'
+        assert self.handlers[0].push.mock_calls[0][1][0] is not \
+            self.handlers[1].push.mock_calls[0][1][0]
+
+    def test_sign_digest(self):
+        self.registry.settings['sign_digest'] = 'sha256'
+        self.hooks['hook2']['src_path'] = '/src_path3'
+        self.hooks['hook2']['fan_out'] = True
+        self.hooks['hook3']['fan_out'] = True
+        self.hooks['hook3']['sign_digest'] = 'sha512'
+        self.registry.get_body_store.return_value = None
+        repeater = Repeater(self.hooks, self.registry)
+        req = webob.Request.blank('/src_path3', method='POST')
+        req.remote_addr = '192.168.1.100'
+        req.body = 'body'
+        req.get_response(repeater)
+        assert self.signer.sign.call_count == 1
+        assert self.signer.sign.mock_calls[0][1][1] == ['sha256', 'sha512']
+        req_copy = self.handlers[0].push.mock_calls[0][1][0]
+        assert req_copy.headers['X-REPEATER-SIG'] == 'sha256-sig'
+        req_copy = self.handlers[1].push.mock_calls[0][1][0]
+        assert req_copy.headers['X-REPEATER-SIG'] == 'sha512-sig'
+
+    def test_fan_out_without_body_store(self):
+        self.hooks['hook2']['src_path'] = '/src_path3'
+        self.hooks['hook2']['fan_out'] = True
+        self.hooks['hook3']['fan_out'] = True
+        self.registry.get_body_store.return_value = None
+        repeater = Repeater(self.hooks, self.registry)
+        req = webob.Request.blank('/src_path3', method='POST')
+        req.remote_addr = '192.168.1.100'
+        req.body = 'body'
+        req.get_response(repeater)
+        for handler in self.handlers[:2]:
+            req_copy = handler.push.mock_calls[0][1][0]
+            assert 'repeater.body_key' not in req_copy.environ
+            assert req_copy.body == 'body'
+
+    def test_fan_out_without_redis(self):
+        self.registry.settings['queue_backend'] = 'wal'
+        self.hooks['hook2']['src_path'] = '/src_path3'
+        self.hooks['hook2']['fan_out'] = True
+        self.hooks['hook3']['fan_out'] = True
+        repeater = Repeater(self.hooks, self.registry)
+        req = webob.Request.blank('/src_path3', method='POST')
+        req.remote_addr = '192.168.1.100'
+        req.body = 'body'
+        assert req.get_response(repeater).status_code == 200
+        assert self.registry.get_body_store.return_value.put.call_count == 0
+        for handler in self.handlers[:2]:
+            req_copy = handler.push.mock_calls[0][1][0]
+            assert 'repeater.body_key' not in req_copy.environ
+            assert req_copy.body == 'body'
+
+    def _post(self, repeater, path='/src_path3'):
+        req = webob.Request.blank(path, method='POST')
+        req.remote_addr = '192.168.1.100'
+        req.body = 'body'
+        return req.get_response(repeater)
+
+    def test_stored_durability(self):
+        assert self._post(self.repeater).status_code == 200
+        assert self.handlers[1].push.call_count == 1
+        assert self.handlers[1].push.mock_calls[0][1][1] == 0
+
+    def test_async_durability(self):
+        self.hooks['hook3']['durability'] = 'async'
+        repeater = Repeater(self.hooks, self.registry)
+        spawn = self.concurrency_utils.spawn
+        spawn.reset_mock()
+        assert self._post(repeater).status_code == 200
+        assert self._post(repeater).status_code == 200
+        assert self.handlers[1].push.call_count == 0
+        assert len(repeater.ingest) == 2
+        assert spawn.mock_calls == [mock.call(repeater.ingest._drain)]
+
+        repeater.ingest._drain()
+        assert len(repeater.ingest) == 0
+        assert self.handlers[1].push.call_count == 2
+        req_copy, replicas = self.handlers[1].push.mock_calls[0][1]
+        assert req_copy.body == 'body'
+        assert replicas == 0
+        assert not repeater.ingest.draining
+
+    def test_async_buffer_full(self):
+        self.registry.settings['ingest_buffer_size'] = 1
+        self.registry.settings['durability'] = 'async'
+        repeater = Repeater(self.hooks, self.registry)
+        self._post(repeater, '/src_path2')
+        assert self.handlers[0].push.call_count == 0
+
+        def wait():
+            # the buffered request is pushed meanwhile
+            assert self.handlers[0].push.call_count == 0
+            repeater.ingest._drain()
+        room = self.concurrency_utils.event.return_value
+        room.wait.side_effect = wait
+        assert self._post(repeater).status_code == 200
+        assert room.wait.call_count == 1
+        assert self.handlers[0].push.call_count == 1
+        assert self.handlers[1].push.call_count == 0
+        assert len(repeater.ingest) == 1
+        assert not repeater.ingest.waiting
+
+    def test_async_push_failed(self):
+        self.hooks['hook3']['durability'] = 'async'
+        repeater = Repeater(self.hooks, self.registry)
+        self.handlers[1].push.side_effect = [Exception('Redis down'), None]
+        self._post(repeater)
+        self._post(repeater)
+        repeater.ingest._drain()
+        assert self.handlers[1].push.call_count == 2
+        assert len(repeater.ingest) == 0
+
+    def test_replicated_durability(self):
+        self.registry.settings['durability_replicas'] = 2
+        self.hooks['hook3']['durability'] = 'replicated'
+        repeater = Repeater(self.hooks, self.registry)
+        assert self._post(repeater).status_code == 200
+        assert self.handlers[1].push.mock_calls[0][1][1] == 2
+
+        self.hooks['hook3']['durability_replicas'] = 1
+        repeater.reload(self.hooks)
+        self._post(repeater)
+        assert self.handlers[1].push.mock_calls[1][1][1] == 1
+
+    def test_not_replicated(self):
+        self.hooks['hook2']['src_path'] = '/src_path3'
+        self.hooks['hook2']['fan_out'] = True
+        self.hooks['hook3']['fan_out'] = True
+        self.hooks['hook3']['durability'] = 'replicated'
+        self.registry.get_body_store.return_value = None
+        repeater = Repeater(self.hooks, self.registry)
+        self.handlers[1].push.side_effect = IOError('Not replicated')
+        assert self._post(repeater).status_code == 503
+        # queued for both hooks anyway
+        assert self.handlers[0].push.call_count == 1
+        assert self.handlers[1].push.call_count == 1
+
+    def test_stored_push_failed(self):
+        self.handlers[1].push.side_effect = IOError('Redis down')
+        with self.assertRaises(IOError):
+            self._post(self.repeater)
+
+    def test_reload_unchanged(self):
+        self._construct_queues(self.repeater)
+        self.registry.construct_rate_limiter.reset_mock()
+        self._reload()
+        assert self.queue_handler.call_count == 2
+        assert self.proxy.call_count == 3
+        assert self.registry.construct_rate_limiter.call_count == 0
+        for handler in self.handlers:
+            assert handler.reconfigure.call_count == 0
+            assert handler.pause.call_count == 0
+
+    def test_reload_changed(self):
+        self._construct_queues(self.repeater)
+        self.registry.construct_rate_limiter.reset_mock()
+        self.registry.construct_probe.reset_mock()
+        self._reload(hook2={'rate': 2.})
+        assert self.queue_handler.call_count == 2
+        assert self.proxy.call_count == 3
+        assert self.handlers[1].reconfigure.call_count == 0
+        assert self.handlers[0].reconfigure.mock_calls == [mock.call(
+            {'/src_path1': self.proxies[0], '/src_path2': self.proxies[1]},
+            self.registry.construct_rate_limiter.return_value,
+            hooks={'/src_path1': 'hook1', '/src_path2': 'hook2'},
+            probe=self.handlers[0].breaker.probe
+        )]
+        assert self.registry.construct_rate_limiter.mock_calls == [
+            mock.call('dst_host1', 2., 1)
+        ]
+        assert self.registry.construct_probe.call_count == 0
+
+    def test_reload_dst_path(self):
+        self._construct_queues(self.repeater)
+        new_proxy = object()
+        self.proxy.side_effect = lambda href: new_proxy
+        self._reload(hook2={'dst_path': '/new_path'})
+        assert self.proxy.mock_calls[-1] == mock.call('dst_host1/new_path')
+        proxies = self.handlers[0].reconfigure.mock_calls[0][1][0]
+        assert proxies == {
+            '/src_path1': self.proxies[0],
+            '/src_path2': new_proxy,
+        }
+        rate_limiter = self.handlers[0].reconfigure.mock_calls[0][1][1]
+        assert rate_limiter == self.handlers[0].rate_limiter
+
+    def test_reload_paths(self):
+        self._construct_queues(self.repeater)
+        self.concurrency_utils.spawn.reset_mock()
+        self._reload(hook3=None, hook4={
+            'src_host': '127.0.0.1',
+            'src_path': '/src_path4',
+            'dst_host': 'dst_host4',
+            'dst_path': '',
+        })
+        assert self.handlers[1].reconfigure.call_count == 0
+        assert self.repeater.queues['dst_host3'] == self.handlers[1]
+        assert sorted(self.repeater.hosts) == ['dst_host1', 'dst_host4']
+
+        req = webob.Request.blank('/src_path3')
+        req.remote_addr = '192.168.1.100'
+        assert req.get_response(self.repeater).status_code == 404
+
+        req = webob.Request.blank('/src_path4')
+        req.remote_addr = '127.0.0.1'
+        req.get_response(self.repeater)
+        assert self.handlers[2].push.call_count == 1
+
+        start_backlog = self.concurrency_utils.spawn.mock_calls[0][1][0]
+        assert start_backlog.args == (['dst_host4'], )
+
+    def test_reload_lanes(self):
+        self.registry.settings['lanes'] = 3
+        repeater = self.repeater = Repeater(self.hooks, self.registry)
+        partitioned = mock.Mock()
+        repeater.partitioned_queue_handler = partitioned
+        self._construct_queues(repeater)
+        self._reload(hook1={'order_key': 'header:X-Key'})
+        assert self.handlers[0].pause.call_count == 0
+        assert self.handlers[0].reconfigure.call_count == 1
+        assert partitioned.call_args[1]['handlers'] == [self.handlers[0]]
+        assert repeater.queues['dst_host1'] == partitioned.return_value
+        assert partitioned.return_value.start.call_count == 1
+        assert repeater.destinations['dst_host1'] == \
+            partitioned.return_value.lanes
+
+    def test_reload_lanes_disabled(self):
+        self.registry.settings['lanes'] = 2
+        self.hooks['hook1']['order_key'] = 'header:X-Key'
+        repeater = self.repeater = Repeater(self.hooks, self.registry)
+        lanes = [self.handlers[0], mock.Mock()]
+        partitioned = mock.Mock()
+        partitioned.return_value.lanes = lanes
+        repeater.partitioned_queue_handler = partitioned
+        self._construct_queues(repeater)
+        self._reload(hook1={'order_key': None})
+        for lane in lanes:
+            assert lane.reconfigure.call_count == 1
+            assert lane.pause.call_count == 0
+        assert repeater.queues['dst_host1'] == self.handlers[0]
+        assert repeater.destinations['dst_host1'] == lanes
+        assert self.queue_handler.call_count == 1
+
+        # the lanes are used again
+        self._reload(hook1={'order_key': 'header:X-Key'})
+        assert partitioned.call_args[1]['handlers'] == lanes
+        assert partitioned.call_count == 2
 
     def test_request(self):
         req = webob.Request.blank('/src_path1')
@@ -363,6 +1677,56 @@ class RepeaterTestCase(unittest.TestCase):
         assert req_copy.path_info == '/src_path3'
         assert self.handlers[1].push.call_count == 1
 
+    def test_lanes(self):
+        self.registry.settings['lanes'] = 4
+        self.hooks['hook1']['order_key'] = 'header:X-Key'
+        self.queue_handler.reset_mock()
+        partitioned = mock.Mock()
+        Repeater.partitioned_queue_handler = partitioned
+        try:
+            repeater = Repeater(self.hooks, self.registry)
+            self._construct_queues(repeater)
+        finally:
+            del Repeater.partitioned_queue_handler
+        assert partitioned.call_count == 1
+        args = partitioned.mock_calls[0][1]
+        assert args[0] == 'dst_host1'
+        assert list(args[2].keys()) == ['/src_path1']
+        assert args[3:] == (
+            4,
+            self.registry,
+            self.registry.construct_rate_limiter.return_value
+        )
+        assert self.queue_handler.call_count == 1
+        assert self.queue_handler.mock_calls[0][1][0] == 'dst_host3'
+        assert repeater.queue('dst_host1') == partitioned.return_value
+        assert repeater.destinations['dst_host1'] == \
+            partitioned.return_value.lanes
+
+    def test_request_forwarded_by_trusted_proxy(self):
+        self.registry.settings['trusted_proxies'] = '10.0.0.1'
+        repeater = Repeater(self.hooks, self.registry)
+        req = webob.Request.blank(
+            '/src_path2',
+            headers={'X-Forwarded-For': '127.0.0.1, 192.168.1.100'}
+        )
+        req.remote_addr = '10.0.0.1'
+        response = req.get_response(repeater)
+        assert response.status_code == 200
+        assert self.handlers[0].push.call_count == 1
+
+    def test_request_forwarded_by_untrusted_proxy(self):
+        self.registry.settings['trusted_proxies'] = '10.0.0.1'
+        repeater = Repeater(self.hooks, self.registry)
+        req = webob.Request.blank(
+            '/src_path2',
+            headers={'X-Forwarded-For': '192.168.1.100'}
+        )
+        req.remote_addr = '10.0.0.2'
+        response = req.get_response(repeater)
+        assert response.status_code == 403
+        assert self.handlers[0].push.call_count == 0
+
     def test_request_catch_http_not_found(self):
         """
         Test catching exception when in Jira wrong path was set
@@ -388,33 +1752,110 @@ class RepeaterTestCase(unittest.TestCase):
         assert self.handlers[0].push.call_count == 0
         assert response.status_code == 403
 
+    def test_metrics(self):
+        metrics = self.registry.get_metrics.return_value = Metrics(None)
+        repeater = Repeater(self.hooks, self.registry)
+        for path, remote_addr in [
+            ('/src_path1', '127.0.0.1'),
+            ('/src_path1', '127.0.0.1'),
+            ('/src_path2', '127.0.0.1'),
+            ('/unknown', '127.0.0.1'),
+        ]:
+            req = webob.Request.blank(path)
+            req.remote_addr = remote_addr
+            req.get_response(repeater)
+        lines = metrics.render().split('\n')
+        for line in [
+            'repeater_requests_accepted_total{hook="hook1"} 2.0',
+            'repeater_requests_accepted_total{hook="hook2"} 0.0',
+            'repeater_requests_rejected_total{hook="",code="404"} 1.0',
+            'repeater_requests_rejected_total{hook="hook2",code="403"} 1.0',
+        ]:
+            assert line in lines
+        kwargs = [call[2] for call in self.queue_handler.mock_calls]
+        assert kwargs == [{
+            'hooks': {'/src_path1': 'hook1', '/src_path2': 'hook2'},
+            'probe': self.registry.construct_probe.return_value,
+        }]
+
+    def test_metrics_path(self):
+        self.registry.settings['metrics_path'] = '/metrics'
+        metrics = self.registry.get_metrics.return_value = Metrics(None)
+        metrics.counter('requests_total', 'Requests').labels().inc()
+        repeater = Repeater(self.hooks, self.registry)
+        response = webob.Request.blank('/metrics').get_response(repeater)
+        assert response.status_code == 200
+        assert 'requests_total 1.0\n' in response.body
+
+    def test_request_too_large(self):
+        self.registry.settings['max_body_size'] = 10
+        repeater = Repeater(self.hooks, self.registry)
+        req = webob.Request.blank('/src_path1', method='POST')
+        req.remote_addr = '127.0.0.1'
+        req.body = 'x' * 11
+        response = req.get_response(repeater)
+        assert self.handlers[0].push.call_count == 0
+        assert response.status_code == 413
+        req.body = 'x' * 10
+        response = req.get_response(repeater)
+        assert self.handlers[0].push.call_count == 1
+        assert response.status_code == 200
+
+    def test_request_too_large_without_content_length(self):
+        self.registry.settings['max_body_size'] = 10
+        repeater = Repeater(self.hooks, self.registry)
+        req = webob.Request.blank('/src_path1', method='POST')
+        req.remote_addr = '127.0.0.1'
+        req.environ['wsgi.input'] = stringio.StringIO('x' * 11)
+        req.environ.pop('CONTENT_LENGTH', None)
+        req.is_body_readable = True
+        response = req.get_response(repeater)
+        assert self.handlers[0].push.call_count == 0
+        assert response.status_code == 413
+
 
 class ApplicationTestCase(unittest.TestCase):
     """
     Tests for functions in module `application`
     """
-    def test_sign_request(self):
+    def test_ordering_key_header(self):
+        req = webob.Request.blank('/', headers={'X-Key': 'ZADAR-1'})
+        assert ordering_key('header:X-Key')(req) == 'ZADAR-1'
+        assert ordering_key('header:X-Other')(req) is None
+
+    def test_ordering_key_json(self):
         req = webob.Request.blank('/')
-        req.body = 'ala ma kota'
-        req = sign_request(req, 'secret')
-        sig = req.headers['X-REPEATER-SIG']
-        assert sig == '65a415c101d8103bc3866bfe9d5dc818'
+        req.body = '{"issue": {"key": "ZADAR-1", "id": 10}}'
+        assert ordering_key('json:issue.key')(req) == 'ZADAR-1'
+        assert ordering_key('json:issue.id')(req) == '10'
+        assert ordering_key('json:issue.missing')(req) is None
+        assert ordering_key('json:issue.key.id')(req) is None
+        req.body = 'not json'
+        assert ordering_key('json:issue.key')(req) is None
 
-    def test_generate_inet_aton(self):
-        """
-        Test returning int value of ip address.
-        """
-        address = '127.0.0.1'
-        int_address = generate_inet_aton(address)
-        self.assertEqual(int_address, 2130706433)
+    def test_ordering_key_json_prefix(self):
+        req = webob.Request.blank('/')
+        req.body = '{"issue": {"id": 10, "key": "ZADAR-1"}, "body": "%s"}' % (
+            'x' * ORDER_KEY_PREFIX
+        )
+        assert ordering_key('json:issue.key')(req) == 'ZADAR-1'
+        assert ordering_key('json:issue.id')(req) == '10'
+        assert ordering_key('json:body')(req) is None
+        assert req.body_file_raw.tell() == 0
 
-        address = '192.168.1.10'
-        int_address = generate_inet_aton(address)
-        self.assertEqual(int_address, 3232235786)
+    def test_json_field(self):
+        string = '{"a": {"b": [1, {"c": 2}], "d": 12}, "e": "f"}'
+        assert json_field(string, ['a', 'd']) == 12
+        assert json_field(string, ['e']) == 'f'
+        assert json_field(string, ['a', 'b', 'c']) is None
+        assert json_field(string[:-11], ['a', 'd'], False) == 12
+        assert json_field(string[:-12], ['a', 'd'], False) is None
+        assert json_field(string[:-11], ['e'], False) is None
+        assert json_field('[1]', ['a']) is None
 
-        address = '192.168.1.11'
-        int_address = generate_inet_aton(address)
-        self.assertEqual(int_address, 3232235787)
+    def test_ordering_key_unknown_source(self):
+        with self.assertRaises(ValueError):
+            ordering_key('cookie:key')
 
     def test_check_remote_address_one_host(self):
         """
@@ -443,3 +1884,15 @@ class ApplicationTestCase(unittest.TestCase):
         hosts = '192.168.1.0/24'
         self.assertFalse(check_remote_address(hosts, address))
 
+    def test_check_remote_address_compiled(self):
+        hosts = AddressMatcher('192.168.1.0/24')
+        assert check_remote_address(hosts, '192.168.1.100')
+        assert not check_remote_address(hosts, '192.168.2.100')
+
+    def test_hook_matcher(self):
+        matcher = AddressMatcher('127.0.0.1')
+        hook_spec = {'src_host': '127.0.0.1', 'src_matcher': matcher}
+        assert hook_matcher(hook_spec) is matcher
+        del hook_spec['src_matcher']
+        assert hook_matcher(hook_spec) == matcher
+
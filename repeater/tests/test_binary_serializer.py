@@ -0,0 +1,143 @@
+import cPickle as pickle
+import StringIO as stringio
+import unittest
+
+import webob
+
+from repeater.binary_serializer import (
+    BinaryRequestSerializer,
+    SerializationError,
+)
+
+
+class BodyStoreMock(object):
+
+    def __init__(self):
+        self.bodies = {}
+
+    def put(self, body_file, size):
+        key = 'key%d' % len(self.bodies)
+        self.bodies[key] = body_file.read(size)
+        return key
+
+    def open(self, key, size):
+        return stringio.StringIO(self.bodies[key][:size])
+
+
+class BinaryRequestSerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = BinaryRequestSerializer()
+        self.request = webob.Request.blank(
+            '/src_path?a=1',
+            method='POST',
+            headers={
+                'X-REPEATER-SIG': 'sig',
+                'Content-Type': 'application/json',
+            },
+            remote_addr='127.0.0.1'
+        )
+        self.request.body = '{"key": "value"}'
+        self.request.environ['SERVER_SOFTWARE'] = 'gevent'
+        self.request.environ['repeater.received'] = 1234.5
+
+    def test_round_trip(self):
+        string = self.serializer.dumps(self.request)
+        req = self.serializer.loads(string)
+        assert req.method == 'POST'
+        assert req.path_info == '/src_path'
+        assert req.query_string == 'a=1'
+        assert req.remote_addr == '127.0.0.1'
+        assert req.headers['X-REPEATER-SIG'] == 'sig'
+        assert req.content_type == 'application/json'
+        assert req.content_length == len('{"key": "value"}')
+        assert req.body == '{"key": "value"}'
+        assert req.environ['repeater.received'] == 1234.5
+        assert 'SERVER_SOFTWARE' not in req.environ
+
+    def test_body_is_rereadable(self):
+        req = self.serializer.loads(self.serializer.dumps(self.request))
+        assert req.environ['wsgi.input'].read() == '{"key": "value"}'
+        req.body_file_raw.seek(0)
+        assert req.environ['wsgi.input'].read() == '{"key": "value"}'
+
+    def test_smaller_than_pickle(self):
+        string = self.serializer.dumps(self.request.copy())
+        legacy = self.serializer.legacy.dumps(self.request.copy())
+        assert len(string) < len(legacy)
+
+    def test_legacy_pickle(self):
+        string = pickle.dumps({
+            'key1': 'val1',
+            'X-REPEATER-BODY': 'body'
+        })
+        req = self.serializer.loads(string)
+        assert req.environ['key1'] == 'val1'
+        assert req.environ['wsgi.input'].read() == 'body'
+
+    def test_unknown_version(self):
+        string = self.serializer.dumps(self.request)
+        string = string[:2] + chr(255) + string[3:]
+        with self.assertRaises(SerializationError):
+            self.serializer.loads(string)
+
+    def test_truncated(self):
+        string = self.serializer.dumps(self.request)
+        with self.assertRaises(SerializationError):
+            self.serializer.loads(string[:-3])
+        with self.assertRaises(SerializationError):
+            self.serializer.loads(string[:20])
+
+
+class SpoolingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.body_store = BodyStoreMock()
+        self.serializer = BinaryRequestSerializer(self.body_store, 10)
+        self.request = webob.Request.blank('/src_path', method='POST')
+        self.request.body = 'x' * 11
+        # entries with the same time of receiving are the same
+        self.request.environ['repeater.received'] = 1500000000.
+
+    def test_round_trip(self):
+        string = self.serializer.dumps(self.request)
+        assert 'x' * 11 not in string
+        assert self.body_store.bodies == {'key0': 'x' * 11}
+        assert self.request.body_file_raw.tell() == 0
+        req = self.serializer.loads(string)
+        assert req.environ['repeater.body_key'] == 'key0'
+        assert req.content_length == 11
+        assert req.body == 'x' * 11
+
+    def test_below_threshold(self):
+        self.request.body = 'x' * 10
+        string = self.serializer.dumps(self.request)
+        assert not self.body_store.bodies
+        assert string == BinaryRequestSerializer().dumps(self.request)
+
+    def test_dumps_loaded_request(self):
+        req = self.serializer.loads(self.serializer.dumps(self.request))
+        string = self.serializer.dumps(req)
+        assert len(self.body_store.bodies) == 1
+        assert self.serializer.loads(string).body == 'x' * 11
+
+    def test_shared_body(self):
+        self.request.body = 'x' * 5
+        self.body_store.bodies['shared'] = 'x' * 5
+        self.request.environ['repeater.body_key'] = 'shared'
+        string = self.serializer.dumps(self.request)
+        assert 'x' * 5 not in string
+        assert list(self.body_store.bodies) == ['shared']
+        req = self.serializer.loads(string)
+        assert req.environ['repeater.body_key'] == 'shared'
+        assert req.body == 'x' * 5
+
+    def test_without_body_store(self):
+        string = self.serializer.dumps(self.request)
+        with self.assertRaises(SerializationError):
+            BinaryRequestSerializer().loads(string)
+
+    def test_truncated(self):
+        string = self.serializer.dumps(self.request)
+        with self.assertRaises(SerializationError):
+            self.serializer.loads(string[:-1])
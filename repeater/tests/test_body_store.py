@@ -0,0 +1,142 @@
+import StringIO as stringio
+import unittest
+
+import mock
+
+from repeater.body_store import (
+    ChunkedBody,
+    RedisBodyStore,
+    read_chunks,
+)
+
+
+class RedisMock(object):
+
+    def __init__(self):
+        self.lists = {}
+        self.lindex = mock.Mock(side_effect=self._lindex)
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+
+    def _lindex(self, key, index):
+        values = self.lists.get(key, [])
+        return values[index] if index < len(values) else None
+
+
+class ReadChunksTestCase(unittest.TestCase):
+
+    def test_chunks(self):
+        body_file = stringio.StringIO('0123456789tail')
+        chunks = list(read_chunks(body_file, 10, 4))
+        assert chunks == ['0123', '4567', '89']
+
+    def test_short_body(self):
+        body_file = stringio.StringIO('0123')
+        with self.assertRaises(IOError):
+            list(read_chunks(body_file, 10, 4))
+
+
+class ChunkedBodyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = RedisMock()
+        self.redis.lists['key'] = ['0123', '4567', '89']
+        self.body = ChunkedBody(self.redis, 'key', 10, 4)
+
+    def test_read(self):
+        assert self.body.read(3) == '012'
+        assert self.body.read(6) == '345678'
+        assert self.body.tell() == 9
+        assert self.body.read() == '9'
+        assert self.body.read(10) == ''
+        assert self.redis.lindex.call_count == 3
+
+    def test_seek(self):
+        self.body.read()
+        self.body.seek(0)
+        assert self.body.read(2) == '01'
+        self.body.seek(2, 1)
+        assert self.body.read(3) == '456'
+        self.body.seek(-1, 2)
+        assert self.body.read() == '9'
+
+    def test_current_chunk_is_kept(self):
+        self.body.read(1)
+        self.body.read(1)
+        assert self.redis.lindex.call_count == 1
+
+    def test_missing(self):
+        del self.redis.lists['key']
+        with self.assertRaises(IOError):
+            self.body.read()
+
+    def test_truncated(self):
+        self.redis.lists['key'][2] = '8'
+        with self.assertRaises(IOError):
+            self.body.read()
+
+
+class RedisBodyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'redis_host': 'localhost',
+            'redis_port': 6379,
+            'redis_db': 0,
+            'body_retention': 60,
+        }
+        self.store = RedisBodyStore(self.registry)
+        self.store.redis_mod = mock.Mock()
+        self.redis = self.store.redis_mod.Redis.return_value
+
+    def test_put(self):
+        body = 'x' * 100000
+        key = self.store.put(stringio.StringIO(body), len(body))
+        assert key.startswith('repeater:body:')
+        chunks = [call[1][1] for call in self.redis.rpush.mock_calls]
+        assert ''.join(chunks) == body
+        assert len(chunks) == 2
+        assert self.store.redis_mod.Redis.mock_calls[0][2] == {
+            'host': 'localhost',
+            'port': 6379,
+            'db': 0,
+        }
+
+    def test_put_failed(self):
+        self.redis.rpush.side_effect = [None, IOError()]
+        body_file = stringio.StringIO('x' * 100000)
+        with self.assertRaises(IOError):
+            self.store.put(body_file, 100000)
+        key = self.redis.rpush.mock_calls[0][1][0]
+        assert self.redis.delete.mock_calls == [
+            mock.call(key, '%s:refs' % key)
+        ]
+
+    def test_put_shared(self):
+        key = self.store.put(stringio.StringIO('body'), 4, 3)
+        assert self.redis.set.mock_calls == [mock.call('%s:refs' % key, 3)]
+        self.store.put(stringio.StringIO('body'), 4)
+        assert self.redis.set.call_count == 1
+
+    def test_open(self):
+        body = self.store.open('key', 10)
+        assert isinstance(body, ChunkedBody)
+        assert body.redis is self.redis
+        assert body.key == 'key'
+        assert body.size == 10
+
+    def test_release(self):
+        self.redis.decr.return_value = -1
+        self.store.release('key')
+        pipe = self.redis.pipeline.return_value
+        assert self.redis.decr.mock_calls == [mock.call('key:refs')]
+        assert pipe.delete.mock_calls == [mock.call('key:refs')]
+        assert pipe.expire.mock_calls == [mock.call('key', 60)]
+        assert pipe.execute.call_count == 1
+
+    def test_release_shared(self):
+        self.redis.decr.return_value = 1
+        self.store.release('key')
+        assert self.redis.pipeline.call_count == 0
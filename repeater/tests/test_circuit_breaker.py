@@ -0,0 +1,92 @@
+import unittest
+
+import mock
+
+from repeater.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.probe = mock.Mock()
+        self.probe.check.return_value = False
+        self.breaker = CircuitBreaker(self.probe, 10, 40, 3)
+
+    def _wait(self):
+        # wait in the open state, returns the waits
+        waits = []
+        while self.breaker.state == OPEN:
+            sec = self.breaker.next_wait()
+            waits.append(sec)
+            self.breaker.waited(sec)
+        return waits
+
+    def test_backoff(self):
+        assert self.breaker.state == CLOSED
+        backoffs = []
+        for _ in range(4):
+            self.breaker.failure()
+            assert self.breaker.state == OPEN
+            backoffs.append(self.breaker.backoff)
+            self._wait()
+            assert self.breaker.state == HALF_OPEN
+        assert backoffs == [10, 20, 40, 40]
+        self.breaker.success()
+        assert self.breaker.state == CLOSED
+        self.breaker.failure()
+        assert self.breaker.backoff == 10
+
+    def test_probing(self):
+        self.breaker.failure()
+        assert self._wait() == [3, 3, 3, 1]
+        assert self.probe.check.call_count == 3
+
+    def test_probe_succeeds(self):
+        self.probe.check.side_effect = [False, True]
+        self.breaker.failure()
+        assert self._wait() == [3, 3]
+        assert self.breaker.state == HALF_OPEN
+        self.breaker.success()
+        assert self.breaker.state == CLOSED
+
+    def test_trial_after_probe_fails(self):
+        self.probe.check.return_value = True
+        self.breaker.failure()
+        assert self._wait() == [3]
+        self.breaker.failure()
+        assert self._wait() == [20]
+        self.breaker.failure()
+        assert self._wait() == [3]
+        assert self.probe.check.call_count == 2
+
+    def test_without_probe(self):
+        breaker = CircuitBreaker(None, 10, 40, 3)
+        breaker.failure()
+        assert breaker.next_wait() == 10
+        assert breaker.waited(10)
+        assert breaker.state == HALF_OPEN
+
+    def test_reset(self):
+        self.breaker.reset()
+        assert self.breaker.state == CLOSED
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.reset()
+        assert self.breaker.state == HALF_OPEN
+        self.breaker.failure()
+        assert self.breaker.backoff == 10
+
+    def test_jitter(self):
+        breaker = CircuitBreaker(None, 10, 40, 3, 0.5)
+        breaker.random = lambda: 0.4
+        breaker.failure()
+        assert breaker.backoff == 10
+        assert breaker.next_wait() == 8
+        breaker.waited(8)
+        breaker.failure()
+        assert breaker.next_wait() == 16
@@ -0,0 +1,124 @@
+import json
+import os
+import unittest
+
+import mock
+import webob
+
+from repeater.binary_serializer import (
+    BinaryRequestSerializer,
+    SerializationError,
+)
+from repeater.compression import (
+    CompressingRequestSerializer,
+    CompressionStats,
+)
+
+
+class CompressingRequestSerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'compression': 'zlib',
+            'compression_threshold': 100,
+        }
+        concurrency = self.registry.get_concurrency_utils.return_value
+        concurrency.now.return_value = 0.
+        self.serializer = CompressingRequestSerializer(self.registry)
+        self.request = webob.Request.blank(
+            '/src_path',
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            remote_addr='127.0.0.1'
+        )
+        # entries with the same time of receiving are the same
+        self.request.environ['repeater.received'] = 1500000000.
+        self.body = json.dumps({
+            'issue': {'fields': [{'name': 'field', 'value': ''}] * 20}
+        })
+        self.request.body = self.body
+
+    def test_round_trip(self):
+        string = self.serializer.dumps(self.request)
+        assert string.startswith('WCz')
+        assert len(string) < len(self.body) / 2
+        req = self.serializer.loads(string)
+        assert req.path_info == '/src_path'
+        assert req.body == self.body
+
+    def test_below_threshold(self):
+        self.request.body = '{}'
+        entry = BinaryRequestSerializer().dumps(self.request)
+        # the threshold applies to the whole entry, not just the body
+        self.serializer.threshold = len(entry) + 1
+        string = self.serializer.dumps(self.request)
+        assert string == entry
+        assert self.serializer.loads(string).body == '{}'
+        assert self.serializer.stats.entries == 0
+
+    def test_incompressible(self):
+        self.request.body = os.urandom(4096)
+        string = self.serializer.dumps(self.request)
+        assert not string.startswith('WC')
+        assert self.serializer.stats.entries == 1
+        assert self.serializer.stats.compressed == 0
+
+    def test_off(self):
+        self.registry.settings['compression'] = 'off'
+        serializer = CompressingRequestSerializer(self.registry)
+        string = serializer.dumps(self.request)
+        assert not string.startswith('WC')
+        # compressed entries are still readable
+        string = self.serializer.dumps(self.request)
+        assert serializer.loads(string).body == self.body
+
+    def test_spooling_backends(self):
+        body_store = self.registry.get_body_store.return_value
+        assert self.serializer.serializer.body_store == body_store
+        for backend in ('wal', 'memory'):
+            self.registry.settings['queue_backend'] = backend
+            serializer = CompressingRequestSerializer(self.registry)
+            assert serializer.serializer.body_store is None
+        self.registry.settings['queue_backend'] = 'tiered'
+        serializer = CompressingRequestSerializer(self.registry)
+        assert serializer.serializer.body_store == body_store
+
+    def test_unavailable_codec(self):
+        self.registry.settings['compression'] = 'brotli'
+        serializer = CompressingRequestSerializer(self.registry)
+        assert serializer.dumps(self.request).startswith('WCz')
+
+    def test_unknown_tag(self):
+        with self.assertRaises(SerializationError):
+            self.serializer.loads('WCx' + 'data')
+
+    def test_corrupted(self):
+        string = self.serializer.dumps(self.request)
+        with self.assertRaises(SerializationError):
+            self.serializer.loads(string[:20])
+
+    def test_stats(self):
+        clock = self.serializer.clock = mock.Mock()
+        clock.side_effect = [1., 1.5]
+        string = self.serializer.dumps(self.request)
+        stats = self.serializer.stats
+        assert stats.entries == 1
+        assert stats.compressed == 1
+        assert stats.stored_bytes == len(string)
+        assert stats.raw_bytes > len(self.body)
+        assert stats.cpu_time == 0.5
+
+
+class CompressionStatsTestCase(unittest.TestCase):
+
+    def test_stats(self):
+        stats = CompressionStats()
+        assert stats.ratio() == 1.
+        stats.add(1000, 100, 0.001)
+        stats.add(1000, 1000, 0.003)
+        assert stats.ratio() == 2000 / 1100.
+        assert str(stats) == (
+            '2 entries (1 compressed), compression ratio 1.82, '
+            '2000.0 us of CPU per entry'
+        )
@@ -1,9 +1,12 @@
+import socket
 import unittest
 
 import mock
 
 from repeater.gevent_concurrency import (
     GEventConcurrencyUtils,
+    GEventEvent,
+    GEventFuture,
     GEventSemaphore,
 )
 
@@ -21,7 +24,8 @@ class GEventConcurrencyUtilsTestCase(unittest.TestCase):
 
     def test_spawn(self):
         func = object()
-        self.utils.spawn(func)
+        greenlet = self.utils.spawn(func)
+        assert greenlet == self.gevent_mod.spawn.return_value
         assert self.gevent_mod.spawn.call_count == 1
         assert self.gevent_mod.spawn.mock_calls[0][1] == (func, )
 
@@ -31,6 +35,42 @@ class GEventConcurrencyUtilsTestCase(unittest.TestCase):
         assert self.gevent_mod.sleep.call_count == 1
         assert self.gevent_mod.sleep.mock_calls[0][1] == (sec, )
 
+    def test_now(self):
+        time_mod = self.utils.time_mod = mock.Mock()
+        time_mod.time.return_value = 123.5
+        assert self.utils.now() == 123.5
+        assert time_mod.time.call_count == 1
+
+    def test_timeout(self):
+        timeout = self.utils.timeout(1.5)
+        assert timeout == self.gevent_mod.Timeout.return_value
+        sec, exc = self.gevent_mod.Timeout.mock_calls[0][1]
+        assert sec == 1.5
+        assert isinstance(exc, socket.timeout)
+
+    def test_signal(self):
+        func = object()
+        self.utils.signal(1, func)
+        assert self.gevent_mod.signal_handler.mock_calls == [
+            mock.call(1, func)
+        ]
+
+    def test_old_signal(self):
+        del self.gevent_mod.signal_handler
+        func = object()
+        self.utils.signal(1, func)
+        assert self.gevent_mod.signal.mock_calls == [mock.call(1, func)]
+
+    def test_future(self):
+        future_class = self.utils.future_class = mock.Mock()
+        assert self.utils.future() == future_class.return_value
+        assert future_class.mock_calls[0][1] == ()
+
+    def test_event(self):
+        event_class = self.utils.event_class = mock.Mock()
+        assert self.utils.event() == event_class.return_value
+        assert event_class.mock_calls[0][1] == ()
+
     def test_semaphore(self):
         expected_sem = self.semaphore_class.return_value
         sem = self.utils.semaphore()
@@ -64,3 +104,52 @@ class GEventSemaphoreTestCase(unittest.TestCase):
 
         assert self.semaphore_impl.acquire.mock_calls[0][1] == ()
         assert self.semaphore_impl.release.mock_calls[0][1] == ()
+
+
+class GEventFutureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_gevent_mod = GEventFuture.gevent_mod
+        self.gevent_mod = GEventFuture.gevent_mod = mock.Mock()
+        self.result = self.gevent_mod.event.AsyncResult.return_value
+        self.future = GEventFuture()
+
+    def tearDown(self):
+        GEventFuture.gevent_mod = self.orig_gevent_mod
+
+    def test_set(self):
+        self.future.set()
+        assert self.result.set.mock_calls[0][1] == (None, )
+
+    def test_set_exception(self):
+        error = IOError()
+        self.future.set_exception(error)
+        assert self.result.set_exception.mock_calls[0][1] == (error, )
+
+    def test_get(self):
+        assert self.future.get() == self.result.get.return_value
+
+
+class GEventEventTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_gevent_mod = GEventEvent.gevent_mod
+        self.gevent_mod = GEventEvent.gevent_mod = mock.Mock()
+        self.event_impl = self.gevent_mod.event.Event.return_value
+        self.event = GEventEvent()
+
+    def tearDown(self):
+        GEventEvent.gevent_mod = self.orig_gevent_mod
+
+    def test_set_clear(self):
+        self.event.set()
+        self.event.clear()
+        assert self.event_impl.set.call_count == 1
+        assert self.event_impl.clear.call_count == 1
+
+    def test_wait(self):
+        self.event_impl.is_set.return_value = False
+        assert self.event.wait(1.5) is False
+        assert self.event_impl.wait.mock_calls[0][1] == (1.5, )
+        self.event_impl.is_set.return_value = True
+        assert self.event.wait() is True
@@ -0,0 +1,189 @@
+import httplib
+import socket
+import StringIO as stringio
+import unittest
+
+import mock
+
+from repeater.http_client import (
+    ConnectionPool,
+    PooledProxyApp,
+    ProxyConstructor,
+)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.
+        self.pool = ConnectionPool(
+            'https',
+            'host:443',
+            2,
+            60,
+            30,
+            lambda: self.now
+        )
+        self.https = mock.Mock(side_effect=lambda *a, **kw: mock.Mock())
+        self.pool.connections = {'https': self.https}
+
+    def test_new_connection(self):
+        conn, reused = self.pool.get()
+        assert not reused
+        assert self.https.mock_calls[0][1] == ('host:443', )
+        assert self.https.mock_calls[0][2] == {'timeout': 30}
+
+    def test_reuse(self):
+        conn, _ = self.pool.get()
+        self.pool.put(conn)
+        self.now = 59.
+        conn2, reused = self.pool.get()
+        assert reused
+        assert conn2 is conn
+        assert self.https.call_count == 1
+
+    def test_idle_timeout(self):
+        conn, _ = self.pool.get()
+        self.pool.put(conn)
+        self.now = 60.
+        conn2, reused = self.pool.get()
+        assert not reused
+        assert conn2 is not conn
+        assert conn.close.call_count == 1
+
+    def test_size(self):
+        conns = [self.pool.get()[0] for i in range(3)]
+        for conn in conns:
+            self.pool.put(conn)
+        assert len(self.pool.idle) == 2
+        assert conns[2].close.call_count == 1
+
+
+class PooledProxyAppTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = mock.Mock()
+        self.pool.netloc = 'host:8080'
+        self.conn = mock.Mock()
+        self.pool.get.return_value = (self.conn, False)
+        self.response = self.conn.getresponse.return_value
+        self.response.status = 200
+        self.response.reason = 'OK'
+        self.response.will_close = False
+        self.response.read.return_value = 'response body'
+        self.response.getheaders.return_value = [
+            ('content-type', 'text/plain'),
+            ('connection', 'keep-alive'),
+        ]
+        self.app = PooledProxyApp('http://host:8080/dst/', self.pool)
+        self.body = stringio.StringIO('body')
+        self.environ = {
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': '/src path',
+            'QUERY_STRING': 'a=1',
+            'REMOTE_ADDR': '10.0.0.1',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': '4',
+            'HTTP_HOST': 'repeater',
+            'HTTP_CONNECTION': 'close',
+            'HTTP_X_REPEATER_SIG': 'sig',
+            'wsgi.input': self.body,
+            'wsgi.url_scheme': 'https',
+        }
+        self.start_response = mock.Mock()
+
+    def test_forward(self):
+        result = self.app(self.environ, self.start_response)
+        assert result == ['response body']
+        method, path, body, headers = self.conn.request.mock_calls[0][1]
+        assert method == 'POST'
+        assert path == '/dst/src%20path?a=1'
+        assert body is self.body
+        assert headers == {
+            'Host': 'host:8080',
+            'Content-Type': 'application/json',
+            'Content-Length': '4',
+            'X-Repeater-Sig': 'sig',
+            'X-Forwarded-For': '10.0.0.1',
+            'X-Forwarded-Server': 'repeater',
+            'X-Forwarded-Scheme': 'https',
+        }
+        assert self.start_response.mock_calls[0][1] == (
+            '200 OK',
+            [('content-type', 'text/plain')]
+        )
+        assert self.pool.put.mock_calls[0][1] == (self.conn, )
+        assert self.conn.close.call_count == 0
+
+    def test_will_close(self):
+        self.response.will_close = True
+        self.app(self.environ, self.start_response)
+        assert self.conn.close.call_count == 1
+        assert self.pool.put.call_count == 0
+
+    def test_connection_error(self):
+        self.conn.request.side_effect = socket.error('refused')
+        with self.assertRaises(IOError):
+            self.app(self.environ, self.start_response)
+        assert self.conn.close.call_count == 1
+        assert self.pool.connect.call_count == 0
+        assert self.pool.put.call_count == 0
+
+    def test_http_error(self):
+        self.conn.getresponse.side_effect = httplib.BadStatusLine('')
+        with self.assertRaises(IOError):
+            self.app(self.environ, self.start_response)
+
+    def test_retry_stale_connection(self):
+        self.pool.get.return_value = (self.conn, True)
+        self.conn.getresponse.side_effect = httplib.BadStatusLine('')
+        self.body.read()
+        new_conn = self.pool.connect.return_value
+        new_conn.getresponse.return_value = self.response
+        result = self.app(self.environ, self.start_response)
+        assert result == ['response body']
+        assert self.conn.close.call_count == 1
+        assert self.body.tell() == 0
+        assert self.pool.put.mock_calls[0][1] == (new_conn, )
+
+    def test_no_retry_after_timeout(self):
+        self.pool.get.return_value = (self.conn, True)
+        self.conn.getresponse.side_effect = socket.timeout('timed out')
+        with self.assertRaises(socket.timeout):
+            self.app(self.environ, self.start_response)
+        assert self.conn.close.call_count == 1
+        assert self.pool.connect.call_count == 0
+
+
+class ProxyConstructorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'http_pool_size': 8,
+            'http_pool_idle_timeout': 10,
+            'http_timeout': 5,
+        }
+        self.constructor = ProxyConstructor(self.registry)
+        self.pool = self.constructor.connection_pool = mock.Mock()
+        self.pool.side_effect = lambda *args: mock.Mock(args=args)
+
+    def test_pool_per_host(self):
+        proxy1 = self.constructor('http://host1:8080/path1')
+        proxy2 = self.constructor('http://host1:8080/path2')
+        proxy3 = self.constructor('https://host2/path')
+        assert proxy1.pool is proxy2.pool
+        assert proxy1.pool is not proxy3.pool
+        assert self.pool.call_count == 2
+        now = self.registry.get_concurrency_utils.return_value.now
+        assert proxy1.pool.args == ('http', 'host1:8080', 8, 10, 5, now)
+        assert proxy3.pool.args[:2] == ('https', 'host2')
+        assert proxy1.path == '/path1'
+
+    def test_wsgiproxy(self):
+        self.registry.settings['http_client'] = 'wsgiproxy'
+        wsgi_proxy = self.constructor.wsgi_proxy = mock.Mock()
+        proxy = self.constructor('http://host1:8080/path1')
+        assert proxy == wsgi_proxy.return_value
+        assert wsgi_proxy.mock_calls[0][1] == ('http://host1:8080/path1', )
+        assert self.pool.call_count == 0
@@ -0,0 +1,126 @@
+import unittest
+
+from repeater.ip_matcher import (
+    AddressMatcher,
+    client_address,
+    parse_address,
+    parse_network,
+)
+
+
+class ParseTestCase(unittest.TestCase):
+
+    def test_parse_address(self):
+        assert parse_address('127.0.0.1') == (32, 2130706433)
+        assert parse_address(' 192.168.1.10 ') == (32, 3232235786)
+        assert parse_address('::1') == (128, 1)
+        assert parse_address('::ffff:127.0.0.1') == (32, 2130706433)
+
+    def test_parse_invalid_address(self):
+        for address in ['', 'localhost', '256.0.0.1', '1.2.3', '::g']:
+            with self.assertRaises(ValueError):
+                parse_address(address)
+
+    def test_parse_network(self):
+        assert parse_network('10.0.0.0/8') == (32, 167772160, 8)
+        assert parse_network('10.0.0.1') == (32, 167772161, 32)
+        assert parse_network('2001:db8::/32') == (128, 0x20010db8 << 96, 32)
+
+    def test_parse_invalid_network(self):
+        for network in ['10.0.0.0/33', '10.0.0.0/-1', '10.0.0.0/x', '::/129']:
+            with self.assertRaises(ValueError):
+                parse_network(network)
+
+
+class AddressMatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = AddressMatcher(
+            '192.168.1.0/24, 127.0.0.1,10.0.1.0/29, 2001:db8::/32, fe80::1'
+        )
+
+    def test_ipv4(self):
+        assert '192.168.1.100' in self.matcher
+        assert '192.168.2.100' not in self.matcher
+        assert '127.0.0.1' in self.matcher
+        assert '127.0.0.2' not in self.matcher
+        assert '10.0.1.7' in self.matcher
+        assert '10.0.1.8' not in self.matcher
+
+    def test_ipv6(self):
+        assert '2001:db8:1::5' in self.matcher
+        assert '2001:db9::5' not in self.matcher
+        assert 'fe80::1' in self.matcher
+        assert 'fe80::2' not in self.matcher
+        assert '::ffff:192.168.1.1' in self.matcher
+
+    def test_families_do_not_mix(self):
+        matcher = AddressMatcher('::/1')
+        assert '0.0.0.1' not in matcher
+        assert '::1' in matcher
+
+    def test_invalid_address(self):
+        assert 'garbage' not in self.matcher
+        assert None not in self.matcher
+
+    def test_overlapping_networks(self):
+        matcher = AddressMatcher('10.0.0.1, 10.0.0.0/8, 10.1.0.0/16')
+        assert '10.200.0.1' in matcher
+        assert '11.0.0.1' not in matcher
+        assert len(matcher) == 3
+
+    def test_everything(self):
+        matcher = AddressMatcher('0.0.0.0/0')
+        assert '1.2.3.4' in matcher
+        assert '::1' not in matcher
+
+    def test_empty(self):
+        matcher = AddressMatcher('')
+        assert not matcher
+        assert '127.0.0.1' not in matcher
+        assert self.matcher
+
+    def test_invalid_network(self):
+        with self.assertRaises(ValueError):
+            AddressMatcher('127.0.0.1, localhost')
+
+    def test_equal(self):
+        assert AddressMatcher('127.0.0.1') == AddressMatcher('127.0.0.1')
+        assert AddressMatcher('127.0.0.1') != AddressMatcher('127.0.0.2')
+        assert AddressMatcher('127.0.0.1') != '127.0.0.1'
+
+
+class ClientAddressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trusted = AddressMatcher('127.0.0.1, 10.0.0.0/8')
+
+    def test_no_header(self):
+        assert client_address('1.2.3.4', None, self.trusted) == '1.2.3.4'
+        assert client_address('1.2.3.4', None, AddressMatcher('')) == \
+            '1.2.3.4'
+
+    def test_untrusted_remote(self):
+        assert client_address('1.2.3.4', '5.6.7.8', self.trusted) == \
+            '1.2.3.4'
+
+    def test_trusted_chain(self):
+        assert client_address(
+            '127.0.0.1',
+            '6.6.6.6, 5.6.7.8, 10.0.0.2',
+            self.trusted
+        ) == '5.6.7.8'
+
+    def test_all_trusted(self):
+        assert client_address(
+            '127.0.0.1',
+            '10.0.0.3, 10.0.0.2',
+            self.trusted
+        ) == '10.0.0.3'
+
+    def test_no_trusted_proxies(self):
+        assert client_address(
+            '127.0.0.1',
+            '6.6.6.6, 5.6.7.8',
+            AddressMatcher('')
+        ) == '5.6.7.8'
@@ -0,0 +1,114 @@
+import unittest
+
+import mock
+
+from repeater.lease import (
+    LeaseConstructor,
+    LocalLease,
+    RedisLease,
+)
+
+
+class RedisLeaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.
+        self.redis_inst = mock.Mock()
+        self.renew_script = mock.Mock()
+        self.release_script = mock.Mock()
+        self.lease = RedisLease(
+            'host',
+            9,
+            'token',
+            self.redis_inst,
+            (self.renew_script, self.release_script),
+            lambda: self.now
+        )
+
+    def test_acquire(self):
+        self.redis_inst.set.return_value = True
+        assert self.lease.acquire()
+        assert self.redis_inst.set.mock_calls[0][1] == (
+            'repeater:lease:host',
+            'token'
+        )
+        assert self.redis_inst.set.mock_calls[0][2] == {
+            'px': 9000,
+            'nx': True
+        }
+        assert self.renew_script.call_count == 0
+
+    def test_acquire_own_lease(self):
+        self.redis_inst.set.return_value = None
+        self.renew_script.return_value = 1
+        assert self.lease.acquire()
+        assert self.renew_script.mock_calls[0][2] == {
+            'keys': ['repeater:lease:host'],
+            'args': ['token', 9000],
+        }
+
+    def test_acquire_taken(self):
+        self.redis_inst.set.return_value = None
+        self.renew_script.return_value = 0
+        assert not self.lease.acquire()
+        assert not self.lease.keep()
+
+    def test_keep(self):
+        self.redis_inst.set.return_value = True
+        self.lease.acquire()
+        self.now += 2.9
+        assert self.lease.keep()
+        assert self.renew_script.call_count == 0
+        self.now += 0.1
+        self.renew_script.return_value = 1
+        assert self.lease.keep()
+        assert self.renew_script.call_count == 1
+        self.now += 3
+        self.renew_script.return_value = 0
+        assert not self.lease.keep()
+        assert not self.lease.keep()
+        assert self.renew_script.call_count == 2
+
+    def test_release(self):
+        self.redis_inst.set.return_value = True
+        self.lease.acquire()
+        self.lease.release()
+        assert self.release_script.mock_calls[0][2] == {
+            'keys': ['repeater:lease:host'],
+            'args': ['token'],
+        }
+        assert not self.lease.keep()
+
+
+class LeaseConstructorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'redis_host': 'host',
+            'redis_port': 1234,
+            'redis_db': 0,
+            'lease_ttl': 5,
+        }
+        self.constructor = LeaseConstructor(self.registry)
+        self.redis_mod = self.constructor.redis_mod = mock.Mock()
+        self.redis_inst = self.redis_mod.Redis.return_value
+
+    def test_local(self):
+        lease = self.constructor('name')
+        assert isinstance(lease, LocalLease)
+        assert lease.acquire()
+        assert lease.keep()
+        assert self.redis_mod.Redis.call_count == 0
+
+    def test_redis(self):
+        self.registry.settings['lease_backend'] = 'redis'
+        lease1 = self.constructor('name1')
+        lease2 = self.constructor('name2')
+        assert isinstance(lease1, RedisLease)
+        assert self.redis_mod.Redis.call_count == 1
+        assert self.redis_inst.register_script.call_count == 2
+        assert lease1.token == lease2.token
+        assert lease1.ttl == 5
+        assert lease2.key == 'repeater:lease:name2'
+        assert lease1.token != LeaseConstructor(self.registry).token
@@ -3,12 +3,15 @@ import cStringIO as stringio
 
 import mock
 
+from repeater.admin import AdminApp
 from repeater.main import (
     ConfigError,
     main,
     nodefault,
     parse_hooks,
     parse_settings,
+    reload_on_signal,
+    reloader,
 )
 
 
@@ -126,13 +129,13 @@ class ParseHookTestCase(unittest.TestCase):
         self.sections = {
             'section': [('item1', 'val1'), ('item2', 'val2')],
             'hook:name1': [
-                ('src_host', 'src_host1'),
+                ('src_host', '127.0.0.1'),
                 ('src_path', 'src_path1'),
                 ('dst_host', 'dst_host1'),
                 ('dst_path', 'dst_path1')
             ],
             'hook:name2': [
-                ('src_host', 'src_host2'),
+                ('src_host', '10.0.0.0/8, ::1'),
                 ('src_path', '/src_path2'),
                 ('dst_host', 'dst_host2'),
                 ('dst_path', 'dst_path2')
@@ -159,11 +162,12 @@ class ParseHookTestCase(unittest.TestCase):
         assert 'name2' in hooks
         assert len(hooks) == 2
         assert hooks['name1']['src_path'] == '/src_path1'
-        assert hooks['name1']['src_host'] == 'src_host1'
+        assert hooks['name1']['src_host'] == '127.0.0.1'
         assert hooks['name1']['dst_path'] == 'dst_path1'
         assert hooks['name1']['dst_host'] == 'dst_host1'
         assert hooks['name2']['src_path'] == '/src_path2'
-        assert hooks['name2']['src_host'] == 'src_host2'
+        assert hooks['name2']['src_host'] == '10.0.0.0/8, ::1'
+        assert '::1' in hooks['name2']['src_matcher']
         assert hooks['name2']['dst_path'] == 'dst_path2'
         assert hooks['name2']['dst_host'] == 'dst_host2'
 
@@ -183,6 +187,98 @@ class ParseHookTestCase(unittest.TestCase):
         with self.assertRaises(ConfigError):
             parse_hooks(self.config_parser)
 
+    def test_fan_out(self):
+        self.sections['hook:name1'] = list(self.sections['hook:name2'])
+        self.sections['hook:name1'][2] = ('dst_host', 'dst_host1')
+        self.sections['hook:name1'].append(('fan_out', 'yes'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+        self.sections['hook:name2'].append(('fan_out', 'on'))
+        hooks = parse_hooks(self.config_parser)
+        assert hooks['name1']['fan_out'] is True
+        assert hooks['name1']['src_path'] == hooks['name2']['src_path']
+
+    def test_fan_out_same_destination(self):
+        self.sections['hook:name1'] = list(self.sections['hook:name2'])
+        for hook in ['hook:name1', 'hook:name2']:
+            self.sections[hook].append(('fan_out', 'yes'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_bad_fan_out(self):
+        self.sections['hook:name2'].append(('fan_out', 'maybe'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_equivalent_source_paths(self):
+        self.sections['hook:name1'][1] = ('src_path', '/secret/{a}')
+        self.sections['hook:name2'][1] = ('src_path', '/secret/{b}')
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_template(self):
+        self.sections['hook:name2'][1] = ('src_path', '/secret/{project}')
+        self.sections['hook:name2'][3] = ('dst_path', '/api/{project}')
+        hooks = parse_hooks(self.config_parser)
+        assert hooks['name2']['src_path'] == '/secret/{project}'
+
+    def test_bad_template(self):
+        self.sections['hook:name2'][1] = ('src_path', '/secret/{project}')
+        self.sections['hook:name2'][3] = ('dst_path', '/api/{key}')
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_bad_src_path(self):
+        self.sections['hook:name2'][1] = ('src_path', '/secret/{project')
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_rate(self):
+        self.sections['hook:name2'].append(('rate', '2.5'))
+        self.sections['hook:name2'].append(('burst', '5'))
+        hooks = parse_hooks(self.config_parser)
+        assert hooks['name2']['rate'] == 2.5
+        assert hooks['name2']['burst'] == 5
+        assert 'rate' not in hooks['name1']
+
+    def test_bad_rate(self):
+        self.sections['hook:name2'].append(('rate', 'fast'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_bad_src_host(self):
+        self.sections['hook:name2'][0] = ('src_host', '10.0.0.0/33')
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_bad_order_key(self):
+        self.sections['hook:name2'].append(('order_key', 'cookie:key'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_bad_sign_digest(self):
+        self.sections['hook:name2'].append(('sign_digest', 'sha1'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_durability(self):
+        self.sections['hook:name2'].append(('durability', 'replicated'))
+        self.sections['hook:name2'].append(('durability_replicas', '2'))
+        hooks = parse_hooks(self.config_parser)
+        assert hooks['name2']['durability'] == 'replicated'
+        assert hooks['name2']['durability_replicas'] == 2
+        assert 'durability' not in hooks['name1']
+
+    def test_bad_durability(self):
+        self.sections['hook:name2'].append(('durability', 'forever'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
+    def test_bad_probe(self):
+        self.sections['hook:name2'].append(('probe', 'ping'))
+        with self.assertRaises(ConfigError):
+            parse_hooks(self.config_parser)
+
     def test_missing_options(self):
         section = list(self.sections['hook:name2'])
         for i in range(len(self.sections['hook:name2'])):
@@ -192,6 +288,40 @@ class ParseHookTestCase(unittest.TestCase):
             self.sections['hook:name2'] = list(section)
 
 
+class ReloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config_parser = mock.Mock()
+        self.parse_hooks = mock.Mock()
+        self.app = mock.Mock()
+        self.reload = reloader(
+            'config.ini',
+            self.app,
+            self.config_parser,
+            self.parse_hooks
+        )
+
+    def test_reload(self):
+        self.reload()
+        parser = self.config_parser.return_value
+        assert parser.read.mock_calls == [mock.call(['config.ini'])]
+        assert self.parse_hooks.mock_calls == [mock.call(parser)]
+        assert self.app.reload.mock_calls == [
+            mock.call(self.parse_hooks.return_value)
+        ]
+
+    def test_bad_hooks(self):
+        self.parse_hooks.side_effect = ConfigError('Error: No hooks\n')
+        with self.assertRaises(ValueError):
+            self.reload()
+        assert self.app.reload.call_count == 0
+
+    def test_reload_on_signal(self):
+        reload = mock.Mock(side_effect=ValueError('Error: No hooks'))
+        reload_on_signal(reload)()
+        assert reload.call_count == 1
+
+
 class MainTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -225,7 +355,14 @@ class MainTestCase(unittest.TestCase):
         )
 
     def test_serve_app(self):
-        app_cfg = {}
+        app_cfg = {
+            'trusted_proxies': '',
+            'probe': 'off',
+            'sign_digest': 'md5',
+            'durability': 'stored',
+            'metrics_port': 0,
+            'admin_port': 0,
+        }
         server_cfg = {'host': 'host', 'port': 1234}
         self.config_parser.has_section.return_value = False
         self.parse_settings.side_effect = [server_cfg, app_cfg]
@@ -242,3 +379,124 @@ class MainTestCase(unittest.TestCase):
         )
         assert self.server.serve_forever.call_count == 1
         assert self.logging_config.fileConfig.call_count == 1
+        signal = self.registry.get_concurrency_utils.return_value.signal
+        assert signal.mock_calls[0][1][0] == 1  # SIGHUP
+        signal.mock_calls[0][1][1]()
+        assert self.repeater.reload.mock_calls == [
+            mock.call(self.hooks)
+        ]
+
+    def test_serve_metrics(self):
+        app_cfg = {
+            'trusted_proxies': '',
+            'probe': 'off',
+            'sign_digest': 'md5',
+            'durability': 'stored',
+            'metrics_port': 9100,
+            'admin_port': 0,
+        }
+        server_cfg = {'host': 'host', 'port': 1234}
+        self.config_parser.has_section.return_value = False
+        self.parse_settings.side_effect = [server_cfg, app_cfg]
+        self.call_main()
+        assert self.registry.construct_server.call_count == 2
+        calls = self.registry.construct_server.call_args_list
+        assert calls[1][0][1:] == ('host', 9100)
+        spawn = self.registry.get_concurrency_utils.return_value.spawn
+        assert spawn.mock_calls == [mock.call(self.server.serve_forever)]
+        assert self.server.serve_forever.call_count == 1
+
+    def test_serve_admin(self):
+        app_cfg = {
+            'trusted_proxies': '',
+            'probe': 'off',
+            'sign_digest': 'md5',
+            'durability': 'stored',
+            'metrics_port': 0,
+            'admin_port': 9200,
+            'admin_host': '127.0.0.1',
+            'admin_token': 'token',
+        }
+        server_cfg = {'host': 'host', 'port': 1234}
+        self.config_parser.has_section.return_value = False
+        self.parse_settings.side_effect = [server_cfg, app_cfg]
+        self.registry.settings = app_cfg
+        self.call_main()
+        calls = self.registry.construct_server.call_args_list
+        assert len(calls) == 2
+        admin_app = calls[1][0][0]
+        assert isinstance(admin_app, AdminApp)
+        assert admin_app.repeater == self.repeater
+        admin_app.reload()
+        assert self.repeater.reload.call_count == 1
+        assert calls[1][0][1:] == ('127.0.0.1', 9200)
+        spawn = self.registry.get_concurrency_utils.return_value.spawn
+        assert spawn.mock_calls == [mock.call(self.server.serve_forever)]
+
+    def test_bad_app_probe(self):
+        app_cfg = {
+            'trusted_proxies': '',
+            'probe': 'get',
+            'sign_digest': 'md5',
+            'durability': 'stored',
+            'metrics_port': 0,
+            'admin_port': 0,
+        }
+        server_cfg = {'host': 'host', 'port': 1234}
+        self.config_parser.has_section.return_value = False
+        self.parse_settings.side_effect = [server_cfg, app_cfg]
+        self.stderr = stringio.StringIO()
+        self.call_main()
+        assert 'probe' in self.stderr.getvalue()
+        assert self.bootstrap.call_count == 0
+
+    def test_bad_sign_digest(self):
+        app_cfg = {
+            'trusted_proxies': '',
+            'probe': 'off',
+            'sign_digest': 'sha1',
+            'metrics_port': 0,
+            'admin_port': 0,
+        }
+        server_cfg = {'host': 'host', 'port': 1234}
+        self.config_parser.has_section.return_value = False
+        self.parse_settings.side_effect = [server_cfg, app_cfg]
+        self.stderr = stringio.StringIO()
+        self.call_main()
+        assert 'sign_digest' in self.stderr.getvalue()
+        assert self.bootstrap.call_count == 0
+
+    def test_bad_durability(self):
+        app_cfg = {
+            'trusted_proxies': '',
+            'probe': 'off',
+            'sign_digest': 'md5',
+            'durability': 'forever',
+            'metrics_port': 0,
+            'admin_port': 0,
+        }
+        server_cfg = {'host': 'host', 'port': 1234}
+        self.config_parser.has_section.return_value = False
+        self.parse_settings.side_effect = [server_cfg, app_cfg]
+        self.stderr = stringio.StringIO()
+        self.call_main()
+        assert 'durability' in self.stderr.getvalue()
+        assert self.bootstrap.call_count == 0
+
+    def test_admin_without_token(self):
+        app_cfg = {
+            'trusted_proxies': '',
+            'probe': 'off',
+            'sign_digest': 'md5',
+            'durability': 'stored',
+            'metrics_port': 0,
+            'admin_port': 9200,
+            'admin_token': '',
+        }
+        server_cfg = {'host': 'host', 'port': 1234}
+        self.config_parser.has_section.return_value = False
+        self.parse_settings.side_effect = [server_cfg, app_cfg]
+        self.stderr = stringio.StringIO()
+        self.call_main()
+        assert 'admin_token' in self.stderr.getvalue()
+        assert self.bootstrap.call_count == 0
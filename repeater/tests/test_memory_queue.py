@@ -0,0 +1,275 @@
+import unittest
+
+import mock
+
+from repeater.memory_queue import (
+    MemoryQueue,
+    MemoryQueueConstructor,
+    TieredQueue,
+    TieredQueueConstructor,
+    Unsynced,
+)
+
+
+class MemoryQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = MemoryQueue('name')
+
+    def test_fifo(self):
+        req1 = mock.Mock()
+        req2 = mock.Mock()
+        assert not self.queue
+        self.queue.append(req1)
+        self.queue.append(req2)
+        assert self.queue
+        assert self.queue.top() is req1
+        self.queue.pop()
+        assert self.queue.top() is req2
+        self.queue.pop()
+        assert not self.queue
+
+    def test_len(self):
+        assert len(self.queue) == 0
+        self.queue.append(mock.Mock())
+        self.queue.append(mock.Mock())
+        assert len(self.queue) == 2
+        self.queue.pop()
+        assert len(self.queue) == 1
+
+    def test_retry(self):
+        req = mock.Mock()
+        self.queue.append(req)
+        self.queue.top()
+        assert req.body_file_raw.seek.call_count == 0
+        assert self.queue.top() is req
+        assert req.body_file_raw.seek.mock_calls == [mock.call(0)]
+
+    def test_empty(self):
+        with self.assertRaises(IndexError):
+            self.queue.top()
+
+    def test_constructor(self):
+        constructor = MemoryQueueConstructor(object())
+        queue = constructor('name')
+        assert isinstance(queue, MemoryQueue)
+        assert constructor('name') is queue
+        assert constructor('name2') is not queue
+
+    def test_backlog(self):
+        constructor = MemoryQueueConstructor(object())
+        constructor('name1').append(object())
+        constructor('name2')
+        assert constructor.backlog(['name1', 'name2', 'name3']) == \
+            set(['name1'])
+
+
+class TieredQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.back = MemoryQueue('back')
+        self.back.append = mock.Mock(wraps=self.back.append)
+        self.unsynced = Unsynced(10)
+        self.clock = [0.]
+        self.queue = self._queue()
+
+    def _queue(self):
+        return TieredQueue(
+            'name',
+            self.back,
+            self.unsynced,
+            3,
+            1.,
+            lambda: self.clock[0]
+        )
+
+    def _drain(self):
+        reqs = []
+        while self.queue:
+            reqs.append(self.queue.top())
+            self.queue.pop()
+        return reqs
+
+    def test_memory(self):
+        reqs = [mock.Mock() for i in range(3)]
+        for req in reqs:
+            self.queue.append(req)
+        assert self.unsynced.count == 3
+        assert self._drain() == reqs
+        assert self.back.append.call_count == 0
+        assert self.unsynced.count == 0
+
+    def test_spill_size(self):
+        reqs = [mock.Mock() for i in range(5)]
+        for req in reqs:
+            self.queue.append(req)
+        assert self.back.append.call_count == 5
+        assert self.unsynced.count == 0
+        assert self._drain() == reqs
+
+    def test_replicated(self):
+        reqs = [mock.Mock() for i in range(3)]
+        self.queue.append(reqs[0])
+        self.queue.append(reqs[1], 1)
+        self.queue.append(reqs[2])
+        assert self.back.append.mock_calls == [
+            mock.call(reqs[0]),
+            mock.call(reqs[1], 1),
+            mock.call(reqs[2], 0),
+        ]
+        assert self.unsynced.count == 0
+        assert self._drain() == reqs
+
+    def test_len(self):
+        for i in range(5):
+            self.queue.append(mock.Mock())
+        assert len(self.queue) == 5
+        self.queue.pop()
+        assert len(self.queue) == 4
+
+    def test_spill_unsynced(self):
+        self.unsynced.add(9)
+        self.queue.append(mock.Mock())
+        assert self.back.append.call_count == 0
+        self.queue.append(mock.Mock())
+        assert self.back.append.call_count == 2
+        assert self.unsynced.count == 9
+
+    def test_spill_age(self):
+        req1 = mock.Mock()
+        self.queue.append(req1)
+        self.clock[0] = 1.5
+        self.queue.expire()
+        assert self.back.append.call_count == 1
+        assert req1.body_file_raw.seek.mock_calls == [mock.call(0)]
+        req2 = mock.Mock()
+        self.queue.append(req2)
+        assert self.back.append.call_count == 2
+        assert self._drain() == [req1, req2]
+
+    def test_spill_on_retry(self):
+        req1 = mock.Mock()
+        req2 = mock.Mock()
+        self.queue.append(req1)
+        self.queue.append(req2)
+        assert self.queue.top() is req1
+        assert self.back.append.call_count == 0
+        assert self.queue.top() is req1
+        assert self.back.append.call_count == 2
+        assert self.unsynced.count == 0
+
+    def test_keep_head_being_delivered(self):
+        req1 = mock.Mock()
+        req2 = mock.Mock()
+        self.queue.append(req1)
+        assert self.queue.top() is req1
+        self.clock[0] = 1.5
+        self.queue.append(req2)
+        assert self.back.append.mock_calls == [mock.call(req2)]
+        assert req1.body_file_raw.seek.call_count == 0
+        # retry, but req2 is already in Redis
+        assert self.queue.top() is req1
+        assert req1.body_file_raw.seek.mock_calls == [mock.call(0)]
+        assert self._drain() == [req1, req2]
+
+    def test_head_popped_while_spilling(self):
+        reqs = [mock.Mock() for i in range(3)]
+        for req in reqs:
+            self.queue.append(req)
+        assert self.queue.top() is reqs[0]
+        appended = []
+
+        def append(req, replicas=0):
+            # the head is delivered while Redis is being written to
+            if not appended:
+                self.queue.pop()
+            appended.append(req)
+        self.back.append = append
+        self.queue.spill()
+        assert appended == reqs[1:]
+        assert not self.queue.front
+        assert self.unsynced.count == 0
+
+    def test_spill_failed(self):
+        reqs = [mock.Mock() for i in range(3)]
+        for req in reqs:
+            self.queue.append(req)
+        self.back.append = mock.Mock(side_effect=[None, IOError()])
+        with self.assertRaises(IOError):
+            self.queue.spill()
+        assert [req for _, req in self.queue.front] == reqs[1:]
+        assert self.unsynced.count == 2
+
+    def test_back_to_memory(self):
+        self.back.append(mock.Mock())
+        self.queue = self._queue()
+        assert self.queue.spilled
+        req = mock.Mock()
+        self.queue.append(req)
+        assert len(self.back.requests) == 2
+        self._drain()
+        assert not self.queue.spilled
+        self.queue.append(req)
+        assert len(self.back.requests) == 0
+        assert self.queue.top() is req
+
+    def test_reload(self):
+        self.back.reload = mock.Mock()
+        self.queue.reload()
+        assert self.back.reload.call_count == 1
+
+
+class TieredQueueConstructorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'memory_queue_size': 10,
+            'memory_queue_max_age': 2.,
+            'memory_queue_max_unsynced': 100,
+        }
+        self.concurrency = self.registry.get_concurrency_utils.return_value
+        self.orig_back = TieredQueueConstructor.redis_queue_constructor
+        self.back = TieredQueueConstructor.redis_queue_constructor = \
+            mock.Mock()
+        self.constructor = TieredQueueConstructor(self.registry)
+        self.tiered_queue = self.constructor.tiered_queue = mock.Mock()
+
+    def tearDown(self):
+        TieredQueueConstructor.redis_queue_constructor = self.orig_back
+
+    def test_constructor(self):
+        queue = self.constructor('name')
+        assert queue == self.tiered_queue.return_value
+        assert self.back.mock_calls[0][1] == (self.registry, )
+        back = self.back.return_value
+        assert back.mock_calls[0][1] == ('name', )
+        assert self.tiered_queue.mock_calls[0][1] == (
+            'name',
+            back.return_value,
+            self.constructor.unsynced,
+            10,
+            2.,
+            self.concurrency.now
+        )
+        assert self.constructor.unsynced.limit == 100
+        self.constructor('name2')
+        assert self.concurrency.spawn.call_count == 1
+
+    def test_backlog(self):
+        back = self.back.return_value
+        assert self.constructor.backlog(['name']) == \
+            back.backlog.return_value
+        assert back.backlog.mock_calls[0][1] == (['name'], )
+
+    def test_expire(self):
+        queue1 = mock.Mock()
+        queue1.expire.side_effect = Exception()
+        queue2 = mock.Mock()
+        self.constructor.queues = [queue1, queue2]
+        self.concurrency.sleep.side_effect = [None, StopIteration()]
+        with self.assertRaises(StopIteration):
+            self.constructor._expire()
+        assert self.concurrency.sleep.mock_calls[0][1] == (1., )
+        assert queue1.expire.call_count == 1
+        assert queue2.expire.call_count == 1
@@ -0,0 +1,98 @@
+import unittest
+
+import webob
+
+from repeater.metrics import (
+    CONTENT_TYPE,
+    Metrics,
+    MetricsApp,
+)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(object())
+
+    def test_counter(self):
+        counter = self.metrics.counter(
+            'requests_total',
+            'Requests',
+            ('hook', )
+        )
+        counter.labels('hook1').inc()
+        counter.labels('hook1').inc(2)
+        counter.labels('hook"2').inc()
+        assert self.metrics.counter('requests_total', 'Requests') is counter
+        assert self.metrics.render() == (
+            '# HELP requests_total Requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{hook="hook\\"2"} 1.0\n'
+            'requests_total{hook="hook1"} 3.0\n'
+        )
+
+    def test_histogram(self):
+        histogram = self.metrics.histogram(
+            'latency_seconds',
+            'Latency',
+            buckets=(0.1, 1.)
+        )
+        child = histogram.labels()
+        child.observe(0.05)
+        child.observe(0.1)
+        child.observe(0.5)
+        child.observe(5)
+        assert self.metrics.render() == (
+            '# HELP latency_seconds Latency\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{le="0.1"} 2.0\n'
+            'latency_seconds_bucket{le="1.0"} 3.0\n'
+            'latency_seconds_bucket{le="+Inf"} 4.0\n'
+            'latency_seconds_sum 5.65\n'
+            'latency_seconds_count 4.0\n'
+        )
+
+    def test_gauge(self):
+        self.metrics.gauge(
+            'depth',
+            'Depth',
+            ('destination', ),
+            lambda: [(('host1', ), 3)]
+        )
+        self.metrics.gauge(
+            'depth',
+            'Depth',
+            ('destination', ),
+            lambda: [(('host2', ), 0)]
+        )
+        assert self.metrics.render() == (
+            '# HELP depth Depth\n'
+            '# TYPE depth gauge\n'
+            'depth{destination="host1"} 3.0\n'
+            'depth{destination="host2"} 0.0\n'
+        )
+
+    def test_failing_gauge(self):
+        def collect():
+            raise IOError('Redis is down')
+        self.metrics.gauge('depth', 'Depth', ('destination', ), collect)
+        self.metrics.gauge('depth', 'Depth', ('destination', ), lambda: [
+            (('host2', ), 1)
+        ])
+        assert self.metrics.render().endswith(
+            'depth{destination="host2"} 1.0\n'
+        )
+
+    def test_kind_conflict(self):
+        self.metrics.counter('name', 'Name')
+        with self.assertRaises(ValueError):
+            self.metrics.histogram('name', 'Name')
+
+    def test_app(self):
+        self.metrics.counter('requests_total', 'Requests').labels().inc()
+        response = webob.Request.blank('/metrics').get_response(
+            MetricsApp(self.metrics)
+        )
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith(CONTENT_TYPE)
+        assert 'requests_total 1.0\n' in response.body
@@ -0,0 +1,116 @@
+import httplib
+import socket
+import unittest
+
+import mock
+
+from repeater.probe import (
+    HTTPProbe,
+    ProbeConstructor,
+    TCPProbe,
+    parse_probe,
+)
+
+
+class ParseProbeTestCase(unittest.TestCase):
+
+    def test_parse(self):
+        assert parse_probe('') is None
+        assert parse_probe('off') is None
+        assert parse_probe('tcp') == ('tcp', None)
+        assert parse_probe('head') == ('head', '/')
+        assert parse_probe('head:/ping') == ('head', '/ping')
+        assert parse_probe('get:/health') == ('get', '/health')
+
+    def test_invalid(self):
+        for spec in ['ping', 'get', 'tcp:/path']:
+            with self.assertRaises(ValueError):
+                parse_probe(spec)
+
+
+class TCPProbeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.probe = TCPProbe('host', 8080, 5)
+        self.socket_mod = self.probe.socket_mod = mock.Mock()
+
+    def test_check(self):
+        assert self.probe.check()
+        assert self.socket_mod.create_connection.mock_calls[0][1] == (
+            ('host', 8080),
+            5
+        )
+        sock = self.socket_mod.create_connection.return_value
+        assert sock.close.call_count == 1
+
+    def test_refused(self):
+        self.socket_mod.create_connection.side_effect = socket.error()
+        assert not self.probe.check()
+
+
+class HTTPProbeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.probe = HTTPProbe('https', 'host:8443', 'GET', '/health', 5)
+        self.https = mock.Mock()
+        self.probe.connections = {'https': self.https}
+        self.conn = self.https.return_value
+
+    def test_check(self):
+        self.conn.getresponse.return_value.status = 404
+        assert self.probe.check()
+        assert self.https.mock_calls[0][1] == ('host:8443', )
+        assert self.https.mock_calls[0][2] == {'timeout': 5}
+        args = self.conn.request.mock_calls[0][1]
+        assert args[:2] == ('GET', '/health')
+        assert args[3]['Host'] == 'host:8443'
+        assert self.conn.close.call_count == 1
+
+    def test_server_error(self):
+        self.conn.getresponse.return_value.status = 503
+        assert not self.probe.check()
+
+    def test_failure(self):
+        for error in [socket.timeout(), httplib.BadStatusLine('')]:
+            self.conn.getresponse.side_effect = error
+            assert not self.probe.check()
+        assert self.conn.close.call_count == 2
+
+
+class ProbeConstructorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry = mock.Mock()
+        registry.settings = {'probe_timeout': 2.}
+        self.constructor = ProbeConstructor(registry)
+        self.constructor.tcp_probe = mock.Mock()
+        self.constructor.http_probe = mock.Mock()
+
+    def test_off(self):
+        assert self.constructor('http://host', 'off') is None
+
+    def test_tcp(self):
+        probe = self.constructor('https://host', 'tcp')
+        assert probe == self.constructor.tcp_probe.return_value
+        assert self.constructor.tcp_probe.mock_calls[0][1] == (
+            'host',
+            443,
+            2.
+        )
+        self.constructor('http://host:8080', 'tcp')
+        assert self.constructor.tcp_probe.mock_calls[1][1] == (
+            'host',
+            8080,
+            2.
+        )
+
+    def test_http(self):
+        probe = self.constructor('http://host:8080', 'head')
+        assert probe == self.constructor.http_probe.return_value
+        assert self.constructor.http_probe.mock_calls[0][1] == (
+            'http',
+            'host:8080',
+            'HEAD',
+            '/',
+            2.
+        )
@@ -0,0 +1,103 @@
+import unittest
+
+import mock
+
+from repeater.rate_limit import (
+    RateLimiterConstructor,
+    RedisTokenBucket,
+    TokenBucket,
+    UnlimitedRateLimiter,
+)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.
+        self.bucket = TokenBucket(2., 3, lambda: self.now)
+
+    def test_burst(self):
+        assert self.bucket.reserve() == 0
+        assert self.bucket.reserve() == 0
+        assert self.bucket.reserve() == 0
+        assert self.bucket.reserve() == 0.5
+        assert self.bucket.reserve() == 1.
+
+    def test_refill(self):
+        for i in range(3):
+            self.bucket.reserve()
+        self.now += 0.5
+        assert self.bucket.reserve() == 0
+        assert self.bucket.reserve() == 0.5
+
+    def test_idle_does_not_exceed_burst(self):
+        self.now += 3600
+        for i in range(3):
+            assert self.bucket.reserve() == 0
+        assert self.bucket.reserve() == 0.5
+
+    def test_rate(self):
+        waits = []
+        for i in range(103):
+            wait = self.bucket.reserve()
+            self.now += wait
+            waits.append(wait)
+        assert self.now == 150.
+
+
+class RedisTokenBucketTestCase(unittest.TestCase):
+
+    def test_reserve(self):
+        script = mock.Mock()
+        script.return_value = 250000
+        bucket = RedisTokenBucket('host', 4., 2, script)
+        assert bucket.reserve() == 0.25
+        assert script.mock_calls[0][2] == {
+            'keys': ['repeater:rate:host'],
+            'args': [0.25, 2],
+        }
+
+
+class RateLimiterConstructorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'redis_host': 'host',
+            'redis_port': 1234,
+            'redis_db': 0,
+        }
+        self.constructor = RateLimiterConstructor(self.registry)
+        self.redis_mod = self.constructor.redis_mod = mock.Mock()
+        self.redis_inst = self.redis_mod.Redis.return_value
+
+    def test_unlimited(self):
+        limiter = self.constructor('name', 0, 1)
+        assert isinstance(limiter, UnlimitedRateLimiter)
+        assert limiter.reserve() == 0
+
+    def test_local(self):
+        concurrency = self.registry.get_concurrency_utils.return_value
+        concurrency.now.return_value = 10.
+        limiter = self.constructor('name', 1., 1)
+        assert isinstance(limiter, TokenBucket)
+        assert limiter.reserve() == 0
+        assert limiter.reserve() == 1.
+        assert self.redis_mod.Redis.call_count == 0
+
+    def test_redis(self):
+        self.registry.settings['rate_limit_backend'] = 'redis'
+        limiter1 = self.constructor('name1', 1., 1)
+        limiter2 = self.constructor('name2', 1., 1)
+        assert isinstance(limiter1, RedisTokenBucket)
+        assert self.redis_mod.Redis.call_count == 1
+        assert self.redis_mod.Redis.mock_calls[0][2] == {
+            'host': 'host',
+            'port': 1234,
+            'db': 0
+        }
+        assert self.redis_inst.register_script.call_count == 1
+        script = self.redis_inst.register_script.return_value
+        assert limiter1.script == script
+        assert limiter2.script == script
+        assert limiter2.key == 'repeater:rate:name2'
@@ -1,9 +1,16 @@
 import mock
 import unittest
 
+from repeater.application import QueueBusy
 from repeater.redis_queue import (
+    ACK_SCRIPT,
+    GroupCommit,
+    PrefetchingRedisQueue,
     RedisQueue,
+    ReliableRedisQueue,
     RedisQueueConstructor,
+    RedisQueueEditor,
+    ReplicationTimeout,
 )
 
 
@@ -47,6 +54,153 @@ class RedisQueueConstructorTestCase(unittest.TestCase):
         )
         assert queue == expected_queue
 
+    def test_prefetching_constructor(self):
+        self.registry.settings['redis_prefetch'] = 10
+        self.registry.settings['redis_ack_batch'] = 5
+        prefetching_queue = self.constructor.prefetching_redis_queue = \
+            mock.Mock()
+        queue = self.constructor('name')
+        assert self.redis_queue.call_count == 0
+        assert prefetching_queue.mock_calls[0][1] == (
+            'name',
+            self.redis_inst,
+            self.registry,
+            10,
+            5
+        )
+        assert queue == prefetching_queue.return_value
+
+    def test_reliable_constructor(self):
+        self.registry.settings['redis_inflight'] = True
+        self.registry.settings['redis_prefetch'] = 10
+        self.registry.settings['redis_visibility_timeout'] = 60
+        reliable_queue = self.constructor.reliable_redis_queue = mock.Mock()
+        concurrency = self.registry.get_concurrency_utils.return_value
+        queue1 = self.constructor('name1')
+        queue2 = self.constructor('name2')
+        assert self.redis_queue.call_count == 0
+        assert reliable_queue.call_count == 2
+        args = reliable_queue.mock_calls[0][1]
+        assert args[:3] == ('name1', self.redis_inst, self.registry)
+        assert sorted(args[3].keys()) == [
+            'claim', 'extend', 'sweep', 'unclaim'
+        ]
+        assert args[4] == 60
+        assert self.redis_inst.register_script.call_count == 4
+        assert concurrency.spawn.call_count == 1
+        assert self.constructor.reliable_queues == [queue1, queue2]
+
+    def test_sweeper(self):
+        self.registry.settings['redis_visibility_timeout'] = 60
+        queue1 = mock.Mock()
+        queue1.sweep.return_value = 2
+        queue2 = mock.Mock()
+        queue2.sweep.side_effect = Exception()
+        self.constructor.reliable_queues = [queue1, queue2]
+        concurrency = self.registry.get_concurrency_utils.return_value
+        concurrency.sleep.side_effect = [None, None, StopIteration()]
+        with self.assertRaises(StopIteration):
+            self.constructor._sweep()
+        assert concurrency.sleep.mock_calls[0][1] == (30., )
+        assert queue1.sweep.call_count == 2
+        assert queue2.sweep.call_count == 2
+
+    def test_group_commit_constructor(self):
+        self.registry.settings['redis_commit_window'] = 0.01
+        self.registry.settings['redis_commit_batch'] = 50
+        group_commit_class = self.constructor.group_commit_class = mock.Mock()
+        queue1 = self.constructor('name1')
+        queue2 = self.constructor('name2')
+        assert group_commit_class.call_count == 1
+        assert group_commit_class.mock_calls[0][1] == (
+            self.redis_inst,
+            self.registry.get_concurrency_utils.return_value,
+            0.01,
+            50
+        )
+        assert queue1.group_commit == group_commit_class.return_value
+        assert queue2.group_commit == group_commit_class.return_value
+
+    def test_no_group_commit(self):
+        queue = self.constructor('name')
+        assert queue.group_commit is None
+
+    def test_backlog(self):
+        pipe = self.redis_inst.pipeline.return_value
+        pipe.execute.return_value = [0, 3, 1]
+        backlog = self.constructor.backlog(['name1', 'name2', 'name3'])
+        assert backlog == set(['name2', 'name3'])
+        assert self.redis_inst.pipeline.call_count == 1
+        assert pipe.llen.mock_calls == [
+            mock.call('name1'),
+            mock.call('name2'),
+            mock.call('name3'),
+        ]
+
+    def test_backlog_inflight(self):
+        self.registry.settings['redis_inflight'] = True
+        pipe = self.redis_inst.pipeline.return_value
+        pipe.execute.return_value = [0, 0, 0, 2]
+        assert self.constructor.backlog(['name1', 'name2']) == set(['name2'])
+        assert pipe.zcard.mock_calls[1] == mock.call('name2:inflight')
+
+
+class GroupCommitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_inst = mock.Mock()
+        self.pipe = self.redis_inst.pipeline.return_value
+        self.concurrency = mock.Mock()
+        self.future = self.concurrency.future.return_value
+        self.group_commit = GroupCommit(
+            self.redis_inst,
+            self.concurrency,
+            0.01,
+            3
+        )
+
+    def test_flush_after_window(self):
+        self.group_commit.rpush('name1', 'req1')
+        self.group_commit.rpush('name1', 'req2')
+        assert self.pipe.execute.call_count == 0
+        assert self.concurrency.spawn.call_count == 1
+
+        flusher = self.concurrency.spawn.mock_calls[0][1][0]
+        flusher()
+        assert self.concurrency.sleep.mock_calls[0][1] == (0.01, )
+        assert self.pipe.rpush.mock_calls == [
+            mock.call('name1', 'req1', 'req2')
+        ]
+        assert self.pipe.execute.call_count == 1
+        assert self.future.set.call_count == 1
+        assert self.future.get.call_count == 2
+
+        self.group_commit.rpush('name1', 'req3')
+        assert self.concurrency.spawn.call_count == 2
+
+    def test_flush_full_batch(self):
+        self.group_commit.rpush('name1', 'req1')
+        self.group_commit.rpush('name2', 'req2')
+        self.group_commit.rpush('name1', 'req3')
+        assert self.pipe.rpush.mock_calls == [
+            mock.call('name1', 'req1', 'req3'),
+            mock.call('name2', 'req2'),
+        ]
+        assert self.pipe.execute.call_count == 1
+        assert self.future.set.call_count == 1
+
+        flusher = self.concurrency.spawn.mock_calls[0][1][0]
+        flusher()
+        assert self.pipe.execute.call_count == 1
+
+    def test_error(self):
+        error = self.pipe.execute.side_effect = Exception()
+        self.group_commit.rpush('name1', 'req1')
+        flusher = self.concurrency.spawn.mock_calls[0][1][0]
+        flusher()
+        assert self.future.set_exception.mock_calls[0][1] == (error, )
+        assert self.future.set.call_count == 0
+
 
 class RedisQueueTestCase(unittest.TestCase):
 
@@ -66,6 +220,35 @@ class RedisQueueTestCase(unittest.TestCase):
         assert self.redis_inst.rpush.call_count == 1
         assert self.redis_inst.rpush.mock_calls[0][1] == ('name1', dump)
 
+    def test_append_group_commit(self):
+        self.queue.group_commit = mock.Mock()
+        dump = self.serializer.dumps.return_value
+        self.queue.append(object())
+        assert self.queue.group_commit.rpush.mock_calls[0][1] == (
+            'name1',
+            dump
+        )
+        assert self.redis_inst.rpush.call_count == 0
+
+    def test_append_replicated(self):
+        self.registry.settings = {'durability_timeout': 0.5}
+        self.queue.group_commit = mock.Mock()
+        pipe = self.redis_inst.pipeline.return_value
+        pipe.execute.return_value = [1, 2]
+        dump = self.serializer.dumps.return_value
+        self.queue.append(object(), 2)
+        assert pipe.rpush.mock_calls[0][1] == ('name1', dump)
+        assert pipe.execute_command.mock_calls[0][1] == ('WAIT', 2, 500)
+        assert self.queue.group_commit.rpush.call_count == 0
+
+    def test_append_not_replicated(self):
+        self.registry.settings = {}
+        pipe = self.redis_inst.pipeline.return_value
+        pipe.execute.return_value = [1, 1]
+        with self.assertRaises(ReplicationTimeout):
+            self.queue.append(object(), 2)
+        assert pipe.execute_command.mock_calls[0][1] == ('WAIT', 2, 1000)
+
     def test_pop(self):
         self.queue.pop()
         assert self.redis_inst.lpop.call_count == 1
@@ -93,3 +276,337 @@ class RedisQueueTestCase(unittest.TestCase):
         assert not bool(self.queue)
         assert self.redis_inst.llen.call_count == 2
         assert self.redis_inst.llen.mock_calls[1][1] == ('name1', )
+
+    def test_len(self):
+        self.redis_inst.llen.return_value = 10
+        assert len(self.queue) == 10
+        assert self.redis_inst.llen.mock_calls[0][1] == ('name1', )
+
+
+class PrefetchingRedisQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_inst = mock.Mock()
+        self.pipe = self.redis_inst.pipeline.return_value
+        self.registry = mock.Mock()
+        self.serializer = self.registry.get_request_serializer.return_value
+        self.serializer.loads.side_effect = lambda string: mock.Mock(
+            string=string
+        )
+        self.queue = PrefetchingRedisQueue(
+            'name1',
+            self.redis_inst,
+            self.registry,
+            3,
+            2
+        )
+
+    def test_fetch_window(self):
+        self.pipe.execute.return_value = [['req1', 'req2']]
+        assert bool(self.queue)
+        assert bool(self.queue)
+        assert self.redis_inst.pipeline.call_count == 1
+        assert self.pipe.lrange.mock_calls[0][1] == ('name1', 0, 2)
+        assert self.pipe.eval.call_count == 0
+        assert self.redis_inst.llen.call_count == 0
+
+    def test_top_is_cached(self):
+        self.pipe.execute.return_value = [['req1', 'req2']]
+        req = self.queue.top()
+        assert req.string == 'req1'
+        assert self.queue.top() is req
+        assert self.serializer.loads.call_count == 1
+        assert req.body_file_raw.seek.mock_calls[0][1] == (0, )
+
+    def test_batched_ack(self):
+        self.pipe.execute.return_value = [['req1', 'req2', 'req3']]
+        self.queue.pop()
+        assert self.redis_inst.eval.call_count == 0
+        assert self.queue.top().string == 'req2'
+        self.queue.pop()
+        assert self.redis_inst.eval.mock_calls == [
+            mock.call(ACK_SCRIPT, 1, 'name1', 2, 'req2')
+        ]
+        assert self.queue.top().string == 'req3'
+        assert self.redis_inst.pipeline.call_count == 1
+
+    def test_ack_with_next_fetch(self):
+        self.pipe.execute.side_effect = [[['req1']], [None, []]]
+        self.queue.pop()
+        assert not bool(self.queue)
+        assert self.redis_inst.pipeline.call_count == 2
+        assert self.pipe.eval.mock_calls == [
+            mock.call(ACK_SCRIPT, 1, 'name1', 1, 'req1')
+        ]
+        assert self.redis_inst.eval.call_count == 0
+
+    def test_reload_acks(self):
+        self.pipe.execute.return_value = [['req1', 'req2', 'req3']]
+        self.queue.pop()
+        self.queue.reload()
+        assert self.redis_inst.eval.mock_calls == [
+            mock.call(ACK_SCRIPT, 1, 'name1', 1, 'req1')
+        ]
+        assert self.queue.acked == 0
+        self.queue.flush()
+        assert self.redis_inst.eval.call_count == 1
+
+    def test_len_without_acked(self):
+        self.pipe.execute.return_value = [['req1', 'req2', 'req3']]
+        self.redis_inst.llen.return_value = 3
+        self.queue.pop()
+        assert len(self.queue) == 2
+
+
+class ReliableRedisQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_inst = mock.Mock()
+        self.pipe = self.redis_inst.pipeline.return_value
+        self.registry = mock.Mock()
+        self.serializer = self.registry.get_request_serializer.return_value
+        self.serializer.loads.side_effect = lambda string: mock.Mock(
+            string=string
+        )
+        self.scripts = {
+            'claim': mock.Mock(return_value=[7, 'req1']),
+            'extend': mock.Mock(return_value=1),
+            'unclaim': mock.Mock(),
+            'sweep': mock.Mock(return_value=0),
+        }
+        self.queue = ReliableRedisQueue(
+            'name1',
+            self.redis_inst,
+            self.registry,
+            self.scripts,
+            300
+        )
+        self.keys = [
+            'name1',
+            'name1:inflight',
+            'name1:inflight:requests',
+            'name1:inflight:seq',
+        ]
+
+    def test_top_claims(self):
+        req = self.queue.top()
+        assert req.string == 'req1'
+        assert self.scripts['claim'].mock_calls[0][2] == {
+            'keys': self.keys,
+            'args': [300],
+        }
+        assert bool(self.queue)
+        assert self.redis_inst.llen.call_count == 0
+
+    def test_len_with_claimed(self):
+        self.redis_inst.llen.return_value = 2
+        assert len(self.queue) == 2
+        self.queue.top()
+        assert len(self.queue) == 3
+
+    def test_retry_extends(self):
+        req = self.queue.top()
+        assert self.queue.top() is req
+        assert self.scripts['claim'].call_count == 1
+        assert self.scripts['extend'].mock_calls[0][2] == {
+            'keys': self.keys,
+            'args': [7, 300],
+        }
+        assert req.body_file_raw.seek.mock_calls[0][1] == (0, )
+
+    def test_retry_after_expiration(self):
+        self.queue.top()
+        self.scripts['extend'].return_value = 0
+        self.scripts['claim'].return_value = [8, 'req1']
+        self.queue.top()
+        assert self.scripts['claim'].call_count == 2
+        assert self.queue.claimed[0] == 8
+
+    def test_empty(self):
+        self.scripts['claim'].return_value = None
+        with self.assertRaises(IndexError):
+            self.queue.top()
+        self.redis_inst.llen.return_value = 0
+        assert not bool(self.queue)
+
+    def test_pop_acknowledges(self):
+        self.queue.top()
+        self.queue.pop()
+        assert self.pipe.zrem.mock_calls[0][1] == ('name1:inflight', 7)
+        assert self.pipe.hdel.mock_calls[0][1] == (
+            'name1:inflight:requests',
+            7
+        )
+        assert self.pipe.execute.call_count == 1
+        assert self.queue.claimed is None
+
+    def test_pop_without_claim(self):
+        self.queue.pop()
+        assert self.scripts['claim'].call_count == 0
+        assert self.pipe.execute.call_count == 0
+
+    def test_reload_unclaims(self):
+        self.queue.reload()
+        assert self.scripts['unclaim'].call_count == 0
+        self.queue.top()
+        self.queue.reload()
+        assert self.scripts['unclaim'].mock_calls[0][2] == {
+            'keys': self.keys,
+            'args': [7],
+        }
+        assert self.queue.claimed is None
+
+    def test_sweep(self):
+        self.scripts['sweep'].return_value = 3
+        assert self.queue.sweep() == 3
+        assert self.scripts['sweep'].mock_calls[0][2] == {
+            'keys': self.keys,
+            'args': [100],
+        }
+
+
+class RedisListsMock(object):
+    # Lists and the commands used by RedisQueueEditor
+
+    def __init__(self):
+        self.lists = {}
+        self.executed = 0
+
+    def llen(self, name):
+        return len(self.lists.get(name, []))
+
+    def lrange(self, name, start, end):
+        return self.lists.get(name, [])[start:end + 1]
+
+    def rpush(self, name, *values):
+        self.lists.setdefault(name, []).extend(values)
+
+    def delete(self, name):
+        self.lists.pop(name, None)
+
+    def pipeline(self, transaction=True):
+        redis = self
+        commands = []
+
+        class Pipeline(object):
+            def __getattr__(self, command):
+                return lambda *args: commands.append((command, args))
+
+            def execute(self):
+                redis.executed += 1
+                return [
+                    getattr(redis, command)(*args)
+                    for command, args in commands
+                ]
+        return Pipeline()
+
+    def register_script(self, script):
+        def replace(keys, args):
+            source, copy = keys
+            size, first, last = args
+            queue = self.lists.get(source, [])
+            if queue[:1] != [first] or queue[size - 1:size] != [last]:
+                self.delete(copy)
+                return -1
+            appended = queue[size:]
+            if appended:
+                self.rpush(copy, *appended)
+            if copy in self.lists:
+                self.lists[source] = self.lists.pop(copy)
+            else:
+                self.delete(source)
+            return len(appended)
+        return replace
+
+
+class RedisQueueEditorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'redis_host': 'localhost',
+            'redis_port': 6379,
+            'redis_db': 0,
+            'admin_chunk_size': 2,
+        }
+        self.serializer = self.registry.get_request_serializer.return_value
+        self.serializer.loads.side_effect = lambda string: mock.Mock(
+            path_info=string[0],
+            environ={'repeater.body_key': 'body:%s' % string}
+        )
+        self.redis = RedisListsMock()
+        self.redis.lists['name'] = ['a1', 'b2', 'a3', 'b4', 'a5']
+        self.editor = RedisQueueEditor(self.registry)
+        self.editor.redis_mod = mock.Mock()
+        self.editor.redis_mod.Redis.return_value = self.redis
+        self.sleep = self.registry.get_concurrency_utils.return_value.sleep
+
+    def _match(self, req):
+        return req.path_info == 'a'
+
+    def test_move(self):
+        assert self.editor.move('name', 'parked', self._match) == 3
+        assert self.redis.lists == {
+            'name': ['b2', 'b4'],
+            'parked': ['a1', 'a3', 'a5'],
+        }
+        assert self.redis.executed == 3
+        assert self.sleep.mock_calls == [mock.call(0)] * 3
+
+    def test_purge(self):
+        body_store = self.registry.get_body_store.return_value
+        assert self.editor.move('name', None, self._match) == 3
+        assert self.redis.lists == {'name': ['b2', 'b4']}
+        assert body_store.release.mock_calls == [
+            mock.call('body:a1'),
+            mock.call('body:a3'),
+            mock.call('body:a5'),
+        ]
+
+    def test_purge_failed(self):
+        body_store = self.registry.get_body_store.return_value
+        self.editor._redis()
+        self.editor.replace_script = mock.Mock(side_effect=IOError())
+        with self.assertRaises(IOError):
+            self.editor.move('name', None, self._match)
+        assert self.redis.lists['name'] == ['a1', 'b2', 'a3', 'b4', 'a5']
+        assert body_store.release.call_count == 0
+
+    def test_requests_put_back_meanwhile(self):
+        def sleep(sec):
+            # the sweeper puts back a request which was being delivered
+            if self.sleep.call_count == 1:
+                self.redis.lists['name'].insert(0, 'a0')
+        self.sleep.side_effect = sleep
+        body_store = self.registry.get_body_store.return_value
+        with self.assertRaises(QueueBusy):
+            self.editor.move('name', None, self._match)
+        assert self.redis.lists == {
+            'name': ['a0', 'a1', 'b2', 'a3', 'b4', 'a5'],
+        }
+        assert body_store.release.call_count == 0
+
+    def test_appended_meanwhile(self):
+        def sleep(sec):
+            self.redis.rpush('name', 'a6')
+        self.sleep.side_effect = sleep
+        assert self.editor.move('name', 'parked', self._match) == 3
+        assert self.redis.lists['name'] == ['b2', 'b4', 'a6', 'a6', 'a6']
+
+    def test_nothing_matched(self):
+        self.redis.lists['name:edited'] = ['stale']
+        assert self.editor.move('name', 'parked', lambda req: False) == 0
+        assert self.redis.lists == {'name': ['a1', 'b2', 'a3', 'b4', 'a5']}
+
+    def test_everything_matched(self):
+        assert self.editor.move('name', None, lambda req: True) == 5
+        assert self.redis.lists == {}
+
+    def test_unreadable(self):
+        self.serializer.loads.side_effect = ValueError()
+        assert self.editor.move('name', None, lambda req: True) == 0
+        assert len(self.redis.lists['name']) == 5
+
+    def test_empty(self):
+        assert self.editor.move('other', None, lambda req: True) == 0
+        assert self.redis.executed == 0
@@ -23,20 +23,74 @@ class RegistryTestCase(unittest.TestCase):
 
     def test_default_initialization(self):
         self.components.queryUtility.return_value = None
-        settings = object()
+        settings = {}
         registry = bootstrap(settings)
         assert self.components_class.call_count == 1
-        assert self.components.queryUtility.call_count == 4
-        assert self.components.registerUtility.call_count == 4
+        assert self.components.queryUtility.call_count == 13
+        assert self.components.registerUtility.call_count == 12
         calls = self.components.registerUtility.mock_calls
         calls = [call[1][0] for call in calls]
         default_components = self.default_components
+        assert default_components.Metrics.return_value in calls
         assert default_components.ConcurrencyUtils.return_value in calls
         assert default_components.ServerConstructor in calls
+        assert default_components.BodyStore.return_value in calls
         assert default_components.RequestSerializer.return_value in calls
+        assert default_components.RequestSigner.return_value in calls
         assert default_components.QueueConstructor.return_value in calls
+        assert default_components.QueueEditor.return_value in calls
+        assert default_components.Scheduler.call_count == 0
+        assert default_components.RateLimiterConstructor.return_value in calls
+        assert default_components.ProxyConstructor.return_value in calls
+        assert default_components.ProbeConstructor.return_value in calls
+        assert default_components.LeaseConstructor.return_value in calls
+        metrics = self.default_components.Metrics
+        assert metrics.mock_calls[0][1] == (registry, )
+        body_store = self.default_components.BodyStore
+        assert body_store.mock_calls[0][1] == (registry, )
+        serializer = self.default_components.RequestSerializer
+        assert serializer.mock_calls[0][1] == (registry, )
         queue_cons = self.default_components.QueueConstructor
         assert queue_cons.mock_calls[0][1] == (registry, )
+        queue_editor = self.default_components.QueueEditor
+        assert queue_editor.mock_calls[0][1] == (registry, )
+        limiter_cons = self.default_components.RateLimiterConstructor
+        assert limiter_cons.mock_calls[0][1] == (registry, )
+        proxy_cons = self.default_components.ProxyConstructor
+        assert proxy_cons.mock_calls[0][1] == (registry, )
+        probe_cons = self.default_components.ProbeConstructor
+        assert probe_cons.mock_calls[0][1] == (registry, )
+        lease_cons = self.default_components.LeaseConstructor
+        assert lease_cons.mock_calls[0][1] == (registry, )
+
+    def test_wal_queue_backend(self):
+        self.components.queryUtility.return_value = None
+        registry = bootstrap({'queue_backend': 'wal'})
+        calls = self.components.registerUtility.mock_calls
+        calls = [call[1][0] for call in calls]
+        default_components = self.default_components
+        assert default_components.WALQueueConstructor.return_value in calls
+        assert default_components.QueueConstructor.call_count == 0
+        queue_cons = default_components.WALQueueConstructor
+        assert queue_cons.mock_calls[0][1] == (registry, )
+        assert default_components.QueueEditor.call_count == 0
+
+    def test_heap_scheduler(self):
+        self.components.queryUtility.return_value = None
+        registry = bootstrap({'scheduler': 'heap'})
+        calls = self.components.registerUtility.mock_calls
+        calls = [call[1][0] for call in calls]
+        scheduler = self.default_components.Scheduler
+        assert scheduler.return_value in calls
+        assert scheduler.mock_calls[0][1] == (registry, )
+
+    def test_tiered_queue_backend(self):
+        self.components.queryUtility.return_value = None
+        registry = bootstrap({'queue_backend': 'tiered'})
+        queue_cons = self.default_components.TieredQueueConstructor
+        assert queue_cons.mock_calls[0][1] == (registry, )
+        assert self.default_components.QueueConstructor.call_count == 0
+        assert self.default_components.QueueEditor.call_count == 1
 
     def test_get_concurrency_utils(self):
         utils = object()
@@ -68,3 +122,77 @@ class RegistryTestCase(unittest.TestCase):
         assert server == constructor.return_value
         assert constructor.call_count == 1
         assert constructor.mock_calls[0][1] == ('name', )
+
+    def test_find_backlog(self):
+        constructor = mock.Mock()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = constructor
+        backlog = registry.find_backlog(['name'])
+        assert backlog == constructor.backlog.return_value
+        assert constructor.backlog.mock_calls[0][1] == (['name'], )
+
+    def test_construct_rate_limiter(self):
+        constructor = mock.Mock()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = constructor
+        limiter = registry.construct_rate_limiter('name', 10., 5)
+        assert limiter == constructor.return_value
+        assert constructor.call_count == 1
+        assert constructor.mock_calls[0][1] == ('name', 10., 5)
+
+    def test_construct_proxy(self):
+        constructor = mock.Mock()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = constructor
+        proxy = registry.construct_proxy('http://host/path')
+        assert proxy == constructor.return_value
+        assert constructor.call_count == 1
+        assert constructor.mock_calls[0][1] == ('http://host/path', )
+
+    def test_construct_probe(self):
+        constructor = mock.Mock()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = constructor
+        probe = registry.construct_probe('http://host', 'tcp')
+        assert probe == constructor.return_value
+        assert constructor.call_count == 1
+        assert constructor.mock_calls[0][1] == ('http://host', 'tcp')
+
+    def test_construct_lease(self):
+        constructor = mock.Mock()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = constructor
+        lease = registry.construct_lease('name')
+        assert lease == constructor.return_value
+        assert constructor.call_count == 1
+        assert constructor.mock_calls[0][1] == ('name', )
+
+    def test_get_body_store(self):
+        body_store = object()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = body_store
+        assert registry.get_body_store() == body_store
+
+    def test_get_metrics(self):
+        metrics = object()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = metrics
+        assert registry.get_metrics() == metrics
+
+    def test_get_scheduler(self):
+        scheduler = object()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = scheduler
+        assert registry.get_scheduler() == scheduler
+
+    def test_get_request_signer(self):
+        signer = object()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = signer
+        assert registry.get_request_signer() == signer
+
+    def test_get_queue_editor(self):
+        editor = object()
+        registry = bootstrap(object())
+        self.components.queryUtility.return_value = editor
+        assert registry.get_queue_editor() == editor
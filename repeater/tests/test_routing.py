@@ -0,0 +1,118 @@
+import unittest
+
+import mock
+
+from repeater.routing import (
+    RouteConflict,
+    RouteTrie,
+    TemplateProxy,
+    expand,
+    parse_route,
+    route_names,
+    template_names,
+)
+
+
+class ParseTestCase(unittest.TestCase):
+
+    def test_parse_route(self):
+        assert parse_route('/a/b') == ['', 'a', 'b']
+        assert parse_route('/a/{b}/c') == ['', 'a', ('b', ), 'c']
+        assert parse_route('/a/*') == ['', 'a', '*']
+        assert parse_route('/a/') == ['', 'a', '']
+
+    def test_parse_invalid_route(self):
+        for pattern in ['/a/{b', '/a/b}', '/a{b}', '/{1}', '/*/a', '/a*',
+                        '/{a}/{a}', '/{}']:
+            with self.assertRaises(ValueError):
+                parse_route(pattern)
+
+    def test_names(self):
+        assert route_names('/{secret}/x/{project}') == ['secret', 'project']
+        assert route_names('/a/*') == []
+        assert template_names('/api/{project}/{x}') == ['project', 'x']
+        assert template_names('/api') == []
+
+    def test_expand(self):
+        assert expand('/api/{project}', {'project': 'ZADAR'}) == '/api/ZADAR'
+        assert expand('/api/{p}', {'p': 'Hogarth Jira/x'}) == \
+            '/api/Hogarth%20Jira%2Fx'
+
+
+class RouteTrieTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.routes = RouteTrie()
+        for pattern in [
+            '/secret/Jira/ZADAR',
+            '/secret/Jira/{project}',
+            '/secret/{jira}/{project}',
+            '/secret/*',
+            '/other/',
+        ]:
+            self.routes.add(pattern, pattern)
+
+    def test_exact(self):
+        assert self.routes.get('/secret/Jira/ZADAR') == '/secret/Jira/ZADAR'
+        assert self.routes.match('/secret/Jira/ZADAR') == (
+            '/secret/Jira/ZADAR',
+            {}
+        )
+        assert self.routes.get('/other/') == '/other/'
+        assert self.routes.get('/other') is None
+
+    def test_template(self):
+        assert self.routes.match('/secret/Jira/HOG') == (
+            '/secret/Jira/{project}',
+            {'project': 'HOG'}
+        )
+        assert self.routes.match('/secret/Other Jira/HOG') == (
+            '/secret/{jira}/{project}',
+            {'jira': 'Other Jira', 'project': 'HOG'}
+        )
+
+    def test_prefix(self):
+        assert self.routes.get('/secret/x') == '/secret/*'
+        assert self.routes.get('/secret/Jira/HOG/1') == '/secret/*'
+        assert self.routes.get('/secret/Jira/') == '/secret/*'
+        assert self.routes.get('/secret') is None
+
+    def test_backtracking(self):
+        self.routes.add('/a/b/c', 1)
+        self.routes.add('/a/{x}/d', 2)
+        assert self.routes.match('/a/b/d') == (2, {'x': 'b'})
+        assert self.routes.get('/a/b/e') is None
+
+    def test_no_match(self):
+        assert self.routes.get('/unknown', 'default') == 'default'
+        assert self.routes.match('/unknown') is None
+        assert self.routes.match('') is None
+
+    def test_conflict(self):
+        with self.assertRaises(RouteConflict) as context:
+            self.routes.add('/secret/{x}/{y}', 'new')
+        assert context.exception.value == '/secret/{jira}/{project}'
+        with self.assertRaises(RouteConflict):
+            self.routes.add('/secret/*', 'new')
+        assert len(self.routes) == 5
+
+
+class TemplateProxyTestCase(unittest.TestCase):
+
+    def test_call(self):
+        construct_proxy = mock.Mock()
+        proxy = TemplateProxy(
+            '/secret/{project}',
+            'http://intranet/api/{project}',
+            construct_proxy
+        )
+        environ = {'PATH_INFO': '/secret/ZADAR'}
+        start_response = object()
+        result = proxy(environ, start_response)
+        assert construct_proxy.mock_calls[0] == mock.call(
+            'http://intranet/api/ZADAR'
+        )
+        assert construct_proxy.return_value.mock_calls == [
+            mock.call(environ, start_response)
+        ]
+        assert result == construct_proxy.return_value.return_value
@@ -0,0 +1,134 @@
+import unittest
+
+import mock
+
+from repeater.metrics import Metrics
+from repeater.scheduler import HeapScheduler
+
+
+class Blocked(Exception):
+    pass
+
+
+class EventMock(object):
+    # Waiting for the event moves the clock, waiting without timeout
+    # would block the test
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.flag = False
+
+    def set(self):
+        self.flag = True
+
+    def clear(self):
+        self.flag = False
+
+    def wait(self, sec=None):
+        if not self.flag:
+            if sec is None:
+                raise Blocked()
+            self.clock[0] += sec
+        return self.flag
+
+
+class HeapSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = [0.]
+        self.spawned = []
+        self.registry = mock.Mock()
+        self.registry.settings = {'scheduler_workers': 2}
+        self.metrics = Metrics(None)
+        self.registry.get_metrics.return_value = self.metrics
+        concurrency = self.registry.get_concurrency_utils.return_value
+        concurrency.now.side_effect = lambda: self.clock[0]
+
+        def spawn(func):
+            self.spawned.append(func)
+            return mock.Mock()
+        concurrency.spawn.side_effect = spawn
+        concurrency.event.side_effect = lambda: EventMock(self.clock)
+        self.scheduler = HeapScheduler(self.registry)
+        self.runs = []
+
+    def _task(self, name, delays=()):
+        delays = list(delays)
+
+        def task():
+            self.runs.append((name, self.clock[0]))
+            return delays.pop(0) if delays else None
+        return task
+
+    def _run(self):
+        # Run the runner and the workers it started, until the heap is
+        # empty. The runner blocked by busy workers runs again after them.
+        while self.spawned:
+            func = self.spawned.pop(0)
+            try:
+                func()
+            except Blocked:
+                self.spawned.append(func)
+
+    def test_order(self):
+        for name, delay in [('a', 3), ('b', 1), ('c', 2), ('d', 1)]:
+            self.scheduler.schedule(self._task(name), delay)
+        assert len(self.spawned) == 1  # the runner
+        self._run()
+        assert [name for name, _ in self.runs] == ['b', 'd', 'c', 'a']
+        assert self.clock[0] == 3
+        assert self.scheduler.runner is None
+        assert not self.scheduler.heap
+
+    def test_reschedule(self):
+        self.scheduler.schedule(self._task('a', [2, 0]))
+        self._run()
+        assert self.runs == [('a', 0), ('a', 2), ('a', 2)]
+
+    def test_sooner(self):
+        task = self._task('a')
+        self.scheduler.schedule(task, 5)
+        self.scheduler.schedule(task, 10)
+        self.scheduler.schedule(task, 1)
+        self._run()
+        assert self.runs == [('a', 1)]
+
+    def test_schedule_running(self):
+        def task():
+            self.runs.append(self.clock[0])
+            if len(self.runs) == 1:
+                self.scheduler.schedule(task, 1)
+                self.scheduler.schedule(task, 4)
+                return 3
+        self.scheduler.schedule(task)
+        self._run()
+        assert self.runs == [0, 1]
+
+    def test_workers(self):
+        for name in 'abc':
+            self.scheduler.schedule(self._task(name))
+        runner = self.spawned.pop(0)
+        with self.assertRaises(Blocked):
+            runner()
+        assert len(self.spawned) == 2
+        assert self.scheduler.busy == 2
+        lines = self.metrics.render().split('\n')
+        assert 'repeater_scheduler_busy_workers 2.0' in lines
+        assert 'repeater_scheduled_tasks 3.0' in lines
+        self.spawned.pop(0)()
+        assert self.scheduler.busy == 1
+        with self.assertRaises(Blocked):
+            runner()
+        assert len(self.spawned) == 2
+        self._run()
+        runner()
+        assert [name for name, _ in self.runs] == ['a', 'b', 'c']
+        assert self.scheduler.busy == 0
+
+    def test_task_failed(self):
+        task = mock.Mock(side_effect=ValueError())
+        self.scheduler.schedule(task)
+        self._run()
+        assert task.call_count == 1
+        assert self.scheduler.busy == 0
+        assert not self.scheduler.running
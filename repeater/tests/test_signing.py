@@ -0,0 +1,60 @@
+import hashlib
+import hmac
+import unittest
+
+import mock
+import webob
+
+from repeater.signing import (
+    HMACRequestSigner,
+    parse_digest,
+)
+
+
+class SigningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {'secret': 'secret'}
+        self.signer = HMACRequestSigner(self.registry)
+
+    def test_parse_digest(self):
+        assert parse_digest('sha256') == hashlib.sha256
+        with self.assertRaises(ValueError):
+            parse_digest('sha1')
+
+    def test_sign(self):
+        req = webob.Request.blank('/')
+        req.body = 'ala ma kota'
+        assert self.signer.sign(req) == {
+            'md5': '65a415c101d8103bc3866bfe9d5dc818',
+        }
+
+    def test_default_digest(self):
+        self.registry.settings['sign_digest'] = 'sha256'
+        signer = HMACRequestSigner(self.registry)
+        req = webob.Request.blank('/')
+        req.body = 'ala ma kota'
+        msg = req.content_type + '11ala ma kota'
+        assert signer.sign(req) == {
+            'sha256': hmac.new('secret', msg, hashlib.sha256).hexdigest(),
+        }
+
+    def test_large_body(self):
+        body = ''.join(chr(i % 256) for i in range(200000))
+        req = webob.Request.blank('/', method='POST')
+        req.body = body
+        msg = req.content_type + str(len(body)) + body
+        sigs = self.signer.sign(req, ['md5', 'sha256', 'sha512', 'md5'])
+        assert sigs == {
+            'md5': hmac.new('secret', msg).hexdigest(),
+            'sha256': hmac.new('secret', msg, hashlib.sha256).hexdigest(),
+            'sha512': hmac.new('secret', msg, hashlib.sha512).hexdigest(),
+        }
+        assert req.body == body
+
+    def test_key_state_reused(self):
+        req = webob.Request.blank('/')
+        req.body = 'ala ma kota'
+        first = self.signer.sign(req, ['sha256'])
+        assert self.signer.sign(req, ['sha256']) == first
@@ -0,0 +1,357 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import webob
+
+from repeater.compression import CompressingRequestSerializer
+from repeater.wal_queue import (
+    CURSOR_FILE,
+    RECORD,
+    WALQueue,
+    WALQueueConstructor,
+    undelivered,
+)
+
+
+class SerializerMock(object):
+
+    def dumps(self, req):
+        return req
+
+    def loads(self, string):
+        return mock.Mock(body=string)
+
+
+class WALQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'name')
+        self.registry = mock.Mock()
+        self.registry.get_request_serializer.return_value = SerializerMock()
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+        shutil.rmtree(self.dir)
+
+    def _queue(self, segment_size=1024, fsync_batch=1):
+        queue = WALQueue(
+            'name',
+            self.path,
+            self.registry,
+            segment_size,
+            fsync_batch
+        )
+        self.queues.append(queue)
+        return queue
+
+    def _close(self, queue):
+        self.queues.remove(queue)
+        queue.close()
+
+    def _reopen(self, queue, **kwargs):
+        self._close(queue)
+        return self._queue(**kwargs)
+
+    def _drain(self, queue):
+        bodies = []
+        while queue:
+            bodies.append(queue.top().body)
+            queue.pop()
+        return bodies
+
+    def _segments(self):
+        return sorted(
+            filename for filename in os.listdir(self.path)
+            if filename != CURSOR_FILE
+        )
+
+    def test_undelivered(self):
+        assert not undelivered(self.path)
+        queue = self._queue(segment_size=RECORD.size + 4)
+        assert not undelivered(self.path)
+        queue.append('req1')
+        queue.append('req2')
+        assert undelivered(self.path)
+        queue.top()
+        queue.pop()
+        assert undelivered(self.path)
+        queue.top()
+        queue.pop()
+        assert not undelivered(self.path)
+        queue.append('req3')
+        self._close(queue)
+        assert undelivered(self.path)
+
+    def test_fifo(self):
+        queue = self._queue()
+        assert not queue
+        queue.append('req1')
+        queue.append('req2')
+        assert queue
+        assert queue.top().body == 'req1'
+        queue.pop()
+        queue.append('req3')
+        assert self._drain(queue) == ['req2', 'req3']
+        assert not queue
+
+    def test_top_is_cached(self):
+        queue = self._queue()
+        queue.append('req1')
+        req = queue.top()
+        assert queue.top() is req
+        assert req.body_file_raw.seek.mock_calls == [mock.call(0)]
+
+    def test_empty(self):
+        queue = self._queue()
+        with self.assertRaises(IndexError):
+            queue.top()
+
+    def test_len(self):
+        queue = self._queue(segment_size=64)
+        for i in range(5):
+            queue.append('request %d' % i)
+        queue.top()
+        queue.pop()
+        queue = self._reopen(queue, segment_size=64)
+        assert len(self._segments()) > 1
+        assert len(queue) == 4
+        queue.append('request 5')
+        queue.top()
+        queue.pop()
+        assert len(queue) == 4
+        assert len(self._drain(queue)) == 4
+        assert len(queue) == 0
+
+    def test_recover(self):
+        queue = self._queue()
+        for i in range(3):
+            queue.append('req%d' % i)
+        queue.pop()
+        queue = self._reopen(queue)
+        assert self._drain(queue) == ['req1', 'req2']
+
+    def test_recover_without_close(self):
+        # the process died, nothing was closed
+        queue = self._queue()
+        queue.append('req1')
+        queue.append('req2')
+        queue.top()
+        queue.pop()
+        queue2 = self._queue()
+        assert self._drain(queue2) == ['req2']
+
+    def test_segments(self):
+        queue = self._queue(segment_size=64)
+        for i in range(10):
+            queue.append('request %d' % i)
+        assert len(self._segments()) == 4
+        for i in range(6):
+            queue.pop()
+        assert len(self._segments()) == 2
+        queue = self._reopen(queue, segment_size=64)
+        assert self._drain(queue) == ['request %d' % i for i in range(6, 10)]
+        assert len(self._segments()) == 1
+
+    def test_large_request(self):
+        queue = self._queue(segment_size=64)
+        queue.append('small')
+        queue.append('x' * 100)
+        queue.append('small again')
+        queue = self._reopen(queue, segment_size=64)
+        assert self._drain(queue) == ['small', 'x' * 100, 'small again']
+
+    def test_torn_write(self):
+        """
+        Test incomplete record (the process died while writing it)
+        ends the queue and is overwritten by next request.
+        """
+        queue = self._queue()
+        queue.append('req1')
+        queue.append('req2')
+        end = queue.write_pos
+        self._close(queue)
+        segment = os.path.join(self.path, self._segments()[0])
+        with open(segment, 'r+b') as f:
+            f.seek(end - 2)
+            f.write('XX')
+        queue = self._queue()
+        assert self._drain(queue) == ['req1']
+        queue.append('req3')
+        queue = self._reopen(queue)
+        queue.append('req4')
+        assert self._drain(queue) == ['req3', 'req4']
+
+    def test_torn_header(self):
+        queue = self._queue()
+        queue.append('req1')
+        end = queue.write_pos
+        self._close(queue)
+        segment = os.path.join(self.path, self._segments()[0])
+        with open(segment, 'r+b') as f:
+            f.seek(end)
+            f.write(RECORD.pack(1000, 0)[:6])
+        queue = self._queue()
+        assert self._drain(queue) == ['req1']
+        queue.append('req2')
+        queue = self._reopen(queue)
+        assert self._drain(queue) == ['req2']
+
+    def test_corrupted_cursor(self):
+        """
+        Test undelivered requests are delivered once again, if the cursor
+        is corrupted.
+        """
+        queue = self._queue()
+        queue.append('req1')
+        queue.append('req2')
+        queue.pop()
+        self._close(queue)
+        with open(os.path.join(self.path, CURSOR_FILE), 'r+b') as f:
+            f.write('X')
+        queue = self._queue()
+        assert self._drain(queue) == ['req1', 'req2']
+
+    def test_cursor_ahead_of_data(self):
+        """
+        Test requests appended after power failure are not lost if the
+        cursor was saved, but delivered requests were not.
+        """
+        queue = self._queue()
+        queue.append('req1')
+        queue.pop()
+        self._close(queue)
+        segment = os.path.join(self.path, self._segments()[0])
+        with open(segment, 'r+b') as f:
+            f.write('\0' * RECORD.size)
+        queue = self._queue()
+        assert not queue
+        queue.append('req2')
+        assert self._drain(queue) == ['req2']
+
+    def test_empty_segment(self):
+        # the process died right after creating new segment
+        queue = self._queue()
+        queue.append('req1')
+        self._close(queue)
+        open(os.path.join(self.path, '%020d.seg' % 2), 'w').close()
+        queue = self._queue()
+        queue.append('req2')
+        assert self._drain(queue) == ['req1', 'req2']
+
+    def test_fsync_batch(self):
+        queue = self._queue(fsync_batch=3)
+        writer = queue.writer = mock.Mock(wraps=queue.writer)
+        queue.append('req1')
+        queue.append('req2')
+        assert writer.flush.call_count == 0
+        queue.append('req3')
+        assert writer.flush.call_count == 1
+        queue.append('req4')
+        queue.flush()
+        assert writer.flush.call_count == 2
+        queue.flush()
+        assert writer.flush.call_count == 2
+
+    def test_replicated_flushed(self):
+        queue = self._queue(fsync_batch=3)
+        with mock.patch.object(
+            queue.writer,
+            'flush',
+            wraps=queue.writer.flush
+        ) as flush:
+            queue.append('req1')
+            queue.append('req2', 1)
+        assert flush.call_count == 1
+        assert self._drain(queue) == ['req1', 'req2']
+
+    def test_body_not_spooled(self):
+        self.registry.settings = {
+            'queue_backend': 'wal',
+            'body_spool_threshold': 1,
+        }
+        self.registry.get_request_serializer.return_value = \
+            CompressingRequestSerializer(self.registry)
+        req = webob.Request.blank('/path', method='POST')
+        req.body = 'body'
+        queue = self._queue()
+        queue.append(req)
+        assert queue.top().body == 'body'
+        assert self.registry.get_body_store.call_count == 0
+
+
+class WALQueueConstructorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.registry.settings = {
+            'wal_dir': '/var/lib/wal',
+            'wal_segment_size': 4096,
+            'wal_fsync_batch': 1,
+        }
+        self.constructor = WALQueueConstructor(self.registry)
+        self.wal_queue = self.constructor.wal_queue = mock.Mock()
+        self.concurrency = self.registry.get_concurrency_utils.return_value
+
+    def test_constructor(self):
+        queue = self.constructor('http://host:8080')
+        assert queue == self.wal_queue.return_value
+        assert self.wal_queue.mock_calls[0][1] == (
+            'http://host:8080',
+            '/var/lib/wal/http%3A%2F%2Fhost%3A8080',
+            self.registry,
+            4096,
+            1
+        )
+        assert self.concurrency.spawn.call_count == 0
+
+    def test_backlog(self):
+        wal_dir = tempfile.mkdtemp()
+        try:
+            self.registry.settings['wal_dir'] = wal_dir
+            self.registry.get_request_serializer.return_value = \
+                SerializerMock()
+            for name in ('host1', 'host2'):
+                queue = WALQueue(
+                    'http://%s' % name,
+                    os.path.join(wal_dir, 'http%%3A%%2F%%2F%s' % name),
+                    self.registry,
+                    1024,
+                    1
+                )
+                queue.append('req1')
+                if name == 'host2':
+                    queue.top()
+                    queue.pop()
+                queue.close()
+            os.mkdir(os.path.join(wal_dir, 'http%3A%2F%2Fhost3'))
+            assert self.constructor.backlog([
+                'http://host1',
+                'http://host2',
+                'http://host3',
+                'http://host4',
+            ]) == set(['http://host1'])
+        finally:
+            shutil.rmtree(wal_dir)
+        assert self.constructor.backlog(['http://host1']) == set()
+        assert self.wal_queue.call_count == 0
+
+    def test_flusher(self):
+        self.registry.settings['wal_fsync_batch'] = 10
+        self.registry.settings['wal_fsync_interval'] = 0.5
+        self.wal_queue.side_effect = [mock.Mock(), mock.Mock()]
+        queue1 = self.constructor('host1')
+        queue2 = self.constructor('host2')
+        assert self.concurrency.spawn.call_count == 1
+        queue1.flush.side_effect = Exception()
+        self.concurrency.sleep.side_effect = [None, StopIteration()]
+        with self.assertRaises(StopIteration):
+            self.constructor._flush()
+        assert self.concurrency.sleep.mock_calls[0][1] == (0.5, )
+        assert queue1.flush.call_count == 1
+        assert queue2.flush.call_count == 1
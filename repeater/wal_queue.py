@@ -0,0 +1,429 @@
+"""
+This module provides persistance layer which doesn't need Redis: requests
+are stored in local files. See interfaces.py for documentation.
+
+Each queue is a directory with segment files and a cursor file:
+
+    <wal_dir>/<quoted queue name>/00000000000000000001.seg
+                                  00000000000000000002.seg
+                                  cursor
+
+Segments are preallocated files of `wal_segment_size` bytes, memory-mapped
+and filled with records:
+
+    length of the entry (4 bytes) | CRC32 of the entry (4 bytes) | entry
+
+A record with zero length (i.e. the preallocated zeros) ends the segment.
+Records are only appended; when the next one doesn't fit, a new segment
+is started. The cursor file holds the position of the first request
+which was not delivered yet (segment number, offset and CRC32 of both).
+Segments behind the cursor are deleted.
+
+After a crash the queue is recovered from the files: the last segment is
+scanned and the first record which is not complete (its CRC32 doesn't
+match) ends the queue. Appended records are flushed to disk (msync) after
+each `wal_fsync_batch` appends and every `wal_fsync_interval` seconds, so
+with a batch greater than 1 the last requests may be lost on power
+failure (but not when just the process dies). The cursor is not flushed,
+so after power failure a few requests may be delivered once again.
+
+The queue assumes it is the only user of its directory (only one Repeater
+process can use the same `wal_dir`).
+"""
+
+import mmap
+import os
+import struct
+import urllib
+import zlib
+
+from zope.interface import implementer
+
+from repeater.interfaces import (
+    IRequestQueue,
+    IRequestQueueConstructor,
+)
+from repeater.log import webhook_logger
+
+RECORD = struct.Struct('!II')
+CURSOR = struct.Struct('!QII')
+
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+
+def crc32(string):
+    return zlib.crc32(string) & 0xffffffff
+
+
+def segment_path(path, number):
+    return os.path.join(path, '%020d%s' % (number, SEGMENT_SUFFIX))
+
+
+def parse_cursor(data):
+    """
+    Returns (segment number, offset) stored in the cursor file or (None, 0)
+    if `data` is not a valid cursor
+    """
+    if len(data) == CURSOR.size:
+        number, pos, checksum = CURSOR.unpack(data)
+        if crc32(data[:-4]) == checksum:
+            return number, pos
+    return None, 0
+
+
+def undelivered(path):
+    """
+    Returns True if the queue in directory `path` holds requests which were
+    not delivered yet. The files are only read, so the queue doesn't have
+    to be opened.
+    """
+    if not os.path.isdir(path):
+        return False
+    numbers = sorted(
+        int(filename[:-len(SEGMENT_SUFFIX)])
+        for filename in os.listdir(path)
+        if filename.endswith(SEGMENT_SUFFIX)
+    )
+    if not numbers:
+        return False
+    try:
+        with open(os.path.join(path, CURSOR_FILE), 'rb') as cursor:
+            number, pos = parse_cursor(cursor.read(CURSOR.size))
+    except IOError:
+        number, pos = None, 0
+    if number not in numbers:
+        number, pos = numbers[0], 0
+    for number in numbers[numbers.index(number):]:
+        with open(segment_path(path, number), 'rb') as segment:
+            segment.seek(pos)
+            header = segment.read(RECORD.size)
+            if len(header) == RECORD.size:
+                length, checksum = RECORD.unpack(header)
+                entry = segment.read(length)
+                if length and len(entry) == length and \
+                        crc32(entry) == checksum:
+                    return True
+        pos = 0
+    return False
+
+
+class Segment(object):
+    # Memory-mapped segment file
+
+    def __init__(self, path, number, size=None):
+        self.path = path
+        self.number = number
+        if size is None:
+            self.file = open(path, 'r+b')
+            if not os.fstat(self.file.fileno()).st_size:
+                # crashed right after it was created
+                self.file.truncate(RECORD.size)
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.size = len(self.map)
+
+    def read(self, pos):
+        """
+        Returns (entry, position of the next record) or (None, pos) if there
+        is no valid record at `pos`
+        """
+        if pos + RECORD.size > self.size:
+            return None, pos
+        length, checksum = RECORD.unpack_from(self.map, pos)
+        end = pos + RECORD.size + length
+        if not length or end > self.size:
+            return None, pos
+        entry = self.map[pos + RECORD.size:end]
+        if crc32(entry) != checksum:
+            return None, pos
+        return entry, end
+
+    def write(self, pos, entry):
+        """
+        Returns position of the next record or None if `entry` doesn't fit
+        """
+        end = pos + RECORD.size + len(entry)
+        if end > self.size:
+            return None
+        self.map[pos:end] = RECORD.pack(len(entry), crc32(entry)) + entry
+        return end
+
+    def scan(self):
+        """
+        Returns position after the last valid record. Leftovers of
+        an incomplete record behind it are cleared.
+        """
+        pos = 0
+        while True:
+            entry, end = self.read(pos)
+            if entry is None:
+                break
+            pos = end
+        if pos + RECORD.size <= self.size:
+            length, _ = RECORD.unpack_from(self.map, pos)
+            if length:
+                end = min(pos + RECORD.size + length, self.size)
+                self.map[pos:end] = '\0' * (end - pos)
+        return pos
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+@implementer(IRequestQueue)
+class WALQueue(object):
+
+    segment_class = Segment  # for tests
+
+    def __init__(self, name, path, registry, segment_size, fsync_batch):
+        self.name = name
+        self.path = path
+        self.registry = registry
+        self.segment_size = segment_size
+        self.fsync_batch = fsync_batch
+        self.unflushed = 0
+        self.head = None
+        self.count = None  # see __len__
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.cursor_fd = os.open(
+            os.path.join(path, CURSOR_FILE),
+            os.O_RDWR | os.O_CREAT
+        )
+        self._recover()
+
+    def append(self, req, replicas=0):
+        # There are no replicas, but the request is flushed to disk at once
+        serializer = self.registry.get_request_serializer()
+        entry = serializer.dumps(req)
+        end = self.writer.write(self.write_pos, entry)
+        if end is None:
+            self._roll(RECORD.size + len(entry))
+            end = self.writer.write(self.write_pos, entry)
+        self.write_pos = end
+        if self.count is not None:
+            self.count += 1
+        self.unflushed += 1
+        if self.unflushed >= self.fsync_batch or replicas:
+            self.flush()
+
+    def pop(self):
+        if not self:
+            return
+        _, self.read_pos = self.reader.read(self.read_pos)
+        self.head = None
+        if self.count is not None:
+            self.count -= 1
+        self._skip_drained()
+        self._save_cursor()
+
+    def top(self):
+        if self.head is None:
+            if not self:
+                raise IndexError('Queue %s is empty' % self.name)
+            entry, _ = self.reader.read(self.read_pos)
+            serializer = self.registry.get_request_serializer()
+            self.head = serializer.loads(entry)
+        else:
+            # retry of the same request, its body was already read
+            self.head.body_file_raw.seek(0)
+        return self.head
+
+    def __nonzero__(self):
+        return self.reader is not self.writer or \
+            self.read_pos < self.write_pos
+
+    def __len__(self):
+        # The records are counted when it is called for the first time,
+        # then the count is kept up to date
+        if self.count is None:
+            self.count = self._count()
+        return self.count
+
+    def reload(self):
+        pass
+
+    def flush(self):
+        if self.unflushed:
+            self.writer.flush()
+            self.unflushed = 0
+
+    def close(self):
+        self.flush()
+        if self.reader is not self.writer:
+            self.reader.close()
+        self.writer.close()
+        os.close(self.cursor_fd)
+
+    def _recover(self):
+        numbers = sorted(
+            int(filename[:-len(SEGMENT_SUFFIX)])
+            for filename in os.listdir(self.path)
+            if filename.endswith(SEGMENT_SUFFIX)
+        )
+        if not numbers:
+            numbers = [1]
+            self.writer = self._segment(1, self.segment_size)
+        else:
+            self.writer = self._segment(numbers[-1])
+        self.write_pos = self.writer.scan()
+
+        number, pos = self._load_cursor()
+        if number not in numbers:
+            number, pos = numbers[0], 0
+        for old in numbers[:numbers.index(number)]:
+            os.remove(self._segment_path(old))
+        self.segments = numbers[numbers.index(number):]
+        if number == self.writer.number:
+            self.reader = self.writer
+            # the cursor may be ahead of what was flushed before the crash
+            pos = min(pos, self.write_pos)
+        else:
+            self.reader = self._segment(number)
+        self.read_pos = pos
+        self._skip_drained()
+
+    def _count(self):
+        count = 0
+        for number in self.segments:
+            if number == self.reader.number:
+                segment, pos = self.reader, self.read_pos
+            elif number == self.writer.number:
+                segment, pos = self.writer, 0
+            else:
+                segment, pos = self._segment(number), 0
+            try:
+                while True:
+                    entry, pos = segment.read(pos)
+                    if entry is None:
+                        break
+                    count += 1
+            finally:
+                if segment is not self.reader and segment is not self.writer:
+                    segment.close()
+        return count
+
+    def _skip_drained(self):
+        # Delete segments which are read to the end
+        while self.reader is not self.writer:
+            entry, _ = self.reader.read(self.read_pos)
+            if entry is not None:
+                return
+            if self.read_pos < self.reader.size:
+                webhook_logger.error(
+                    'Corrupted record in %s at %d, rest of the segment '
+                    'is skipped' % (self.reader.path, self.read_pos)
+                )
+            self.reader.remove()
+            self.segments.pop(0)
+            number = self.segments[0]
+            if number == self.writer.number:
+                self.reader = self.writer
+            else:
+                self.reader = self._segment(number)
+            self.read_pos = 0
+
+    def _roll(self, record_size):
+        self.flush()
+        number = self.writer.number + 1
+        if self.reader is not self.writer:
+            self.writer.close()
+        self.writer = self._segment(
+            number,
+            max(self.segment_size, record_size)
+        )
+        self.write_pos = 0
+        self.segments.append(number)
+        # make the new file durable as well
+        dir_fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _load_cursor(self):
+        os.lseek(self.cursor_fd, 0, os.SEEK_SET)
+        data = os.read(self.cursor_fd, CURSOR.size)
+        number, pos = parse_cursor(data)
+        if number is None and len(data) == CURSOR.size:
+            webhook_logger.error(
+                'Corrupted cursor of queue %s, it is read from the '
+                'beginning' % self.name
+            )
+        return number, pos
+
+    def _save_cursor(self):
+        # Overwritten in place, CRC32 protects against partial writes
+        data = CURSOR.pack(self.reader.number, self.read_pos, 0)[:-4]
+        os.lseek(self.cursor_fd, 0, os.SEEK_SET)
+        os.write(self.cursor_fd, CURSOR.pack(
+            self.reader.number,
+            self.read_pos,
+            crc32(data)
+        ))
+
+    def _segment(self, number, size=None):
+        return self.segment_class(self._segment_path(number), number, size)
+
+    def _segment_path(self, number):
+        return segment_path(self.path, number)
+
+
+@implementer(IRequestQueueConstructor)
+class WALQueueConstructor(object):
+
+    wal_queue = WALQueue  # for tests
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.queues = []
+
+    def __call__(self, name):
+        settings = self.registry.settings
+        fsync_batch = settings.get('wal_fsync_batch', 1)
+        if fsync_batch > 1 and not self.queues:
+            concurrency = self.registry.get_concurrency_utils()
+            concurrency.spawn(self._flush)
+        queue = self.wal_queue(
+            name,
+            os.path.join(settings['wal_dir'], urllib.quote(name, safe='')),
+            self.registry,
+            settings.get('wal_segment_size', 16 * 1024 * 1024),
+            fsync_batch
+        )
+        self.queues.append(queue)
+        return queue
+
+    def backlog(self, names):
+        # Queues are not opened (their directories may be opened only once,
+        # by the handler), their files are only read (see undelivered)
+        wal_dir = self.registry.settings['wal_dir']
+        return set(
+            name for name in names
+            if undelivered(os.path.join(wal_dir, urllib.quote(name, safe='')))
+        )
+
+    def _flush(self):
+        # This is executed in separate thread/coroutine
+        concurrency = self.registry.get_concurrency_utils()
+        interval = self.registry.settings.get('wal_fsync_interval', 1)
+        while True:
+            concurrency.sleep(interval)
+            for queue in self.queues:
+                try:
+                    queue.flush()
+                except Exception as error:
+                    webhook_logger.exception(
+                        'Flushing %s failed\n%s' % (queue.name, error)
+                    )
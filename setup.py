@@ -63,6 +63,7 @@ setup(
         ],
     },
     install_requires=dependencies,
+    extras_require={'lz4': ['lz4']},
     tests_require=test_dependencies,
     cmdclass = {'test': PyTest},
 )